@@ -0,0 +1,282 @@
+import threading
+from multiprocessing.pool import ThreadPool
+from fs import FSWalker, DoesNotExist, NotAFile, ReadOutOfBounds
+
+# Non-blocking front end for an FS10. Every call returns a Future right away and the work
+# runs on a fixed-size pool of threads (FS10 is thread-safe), so callers driven by an event
+# loop never wait on image I/O. Where concurrent.futures exists (python 3, or the `futures`
+# backport), these are its Futures: asyncio.wrap_future() turns one into an awaitable, e.g.
+#   data = await asyncio.wrap_future(afs.read('/logs/today'))
+#
+# Reads and writes queued against the same file are batched: whichever worker picks the
+# file up takes everything queued for it, reads each run of overlapping or nearby ranges
+# with one read, and applies back-to-back writes as one write.
+
+DEFAULT_WORKERS = 4
+# queued reads whose ranges are within this many bytes of each other are served by one read
+READ_MERGE_GAP = 4096
+
+try:
+  from concurrent.futures import Future
+except ImportError:
+  class TimeoutError(Exception):
+    pass
+  
+  class Future:
+    """The parts of concurrent.futures.Future that AsyncFS's callers need."""
+    
+    def __init__(self):
+      self.cond = threading.Condition()
+      self.finished = False
+      self.value = None
+      self.error = None
+      self.callbacks = []
+    
+    def __repr__(self):
+      return '<Future %s>' % ('finished' if self.finished else 'pending')
+    
+    def done(self):
+      return self.finished
+    
+    def result(self, timeout=None):
+      self.wait(timeout)
+      if self.error is not None:
+        raise self.error
+      return self.value
+    
+    def exception(self, timeout=None):
+      self.wait(timeout)
+      return self.error
+    
+    def wait(self, timeout):
+      with self.cond:
+        if not self.finished:
+          self.cond.wait(timeout)
+        if not self.finished:
+          raise TimeoutError()
+    
+    def add_done_callback(self, fn):
+      with self.cond:
+        if not self.finished:
+          self.callbacks.append(fn)
+          return
+      fn(self)
+    
+    def set_result(self, value):
+      self.finish(value, None)
+    
+    def set_exception(self, error):
+      self.finish(None, error)
+    
+    def finish(self, value, error):
+      with self.cond:
+        self.value, self.error = value, error
+        self.finished = True
+        self.cond.notify_all()
+        callbacks, self.callbacks = self.callbacks, []
+      for fn in callbacks:
+        fn(self)
+
+
+class AsyncFS:
+  
+  def __init__(self, fs, workers=DEFAULT_WORKERS):
+    self.fs = fs
+    self.pool = ThreadPool(workers)
+    self.local = threading.local() # each worker's FSWalker
+    self.lock = threading.Lock() # guards queued and closed
+    self.closed = False
+    # path => [(kind, args, future)] waiting for a worker. A path stays in here while a worker
+    # is busy with it, so there's only ever one worker per file and requests run in order.
+    self.queued = {}
+  
+  def __repr__(self):
+    return '<AsyncFS over %r>' % self.fs
+  
+  def __enter__(self):
+    return self
+  
+  def __exit__(self, exc_type, exc_value, tb):
+    self.close()
+  
+  def close(self):
+    # waits for everything already submitted; doesn't close the FS10
+    with self.lock:
+      self.closed = True
+      self.pool.close()
+    self.pool.join()
+  
+  def check_open(self):
+    # (like a closed file; the pool would only fail an assert)
+    if self.closed:
+      raise ValueError('AsyncFS is closed')
+  
+  def walker(self):
+    try:
+      return self.local.walker
+    except AttributeError:
+      self.local.walker = FSWalker(self.fs)
+      return self.local.walker
+  
+  def submit(self, func, *args):
+    self.check_open()
+    future = Future()
+    def run():
+      try:
+        result = func(*args)
+      except Exception as e:
+        future.set_exception(e)
+      else:
+        future.set_result(result)
+    self.pool.apply_async(run)
+    return future
+  
+  # whole-call operations, each run as-is on a worker
+  
+  def open(self, path):
+    return self.submit(lambda: self.walker().open(path))
+  
+  def stat(self, path):
+    return self.submit(lambda: self.walker().stat(path))
+  
+  def exists(self, path):
+    return self.submit(lambda: self.walker().exists(path))
+  
+  def listdir(self, path='/'):
+    return self.submit(lambda: self.walker().listdir(path))
+  
+  def mkdir(self, path):
+    return self.submit(lambda: self.walker().create_dir(path))
+  
+  def makedirs(self, path):
+    return self.submit(lambda: self.walker().makedirs(path))
+  
+  def remove(self, path):
+    return self.submit(lambda: self.walker().remove(path))
+  
+  def move(self, src, dst):
+    return self.submit(lambda: self.walker().move(src, dst))
+  
+  # reads and writes, batched per file
+  
+  def read(self, path, offset=0, amt=None):
+    # amt=None: to the end of the file
+    return self.enqueue(path, 'read', (offset, amt))
+  
+  def write(self, path, data, offset=None):
+    # offset=None appends; creates the file if it doesn't exist
+    return self.enqueue(path, 'write', (offset, data))
+  
+  def enqueue(self, path, kind, args):
+    future = Future()
+    with self.lock:
+      self.check_open()
+      queue = self.queued.get(path)
+      if queue is None:
+        # (first: if it raises, nothing's left queued that no worker will ever take. The
+        # worker can't look at queued before we let go of the lock.)
+        self.pool.apply_async(self.run_queue, (path,))
+        queue = self.queued[path] = []
+      queue.append((kind, args, future))
+    return future
+  
+  def run_queue(self, path):
+    while True:
+      with self.lock:
+        requests = self.queued[path]
+        if not requests:
+          del self.queued[path]
+          return
+        self.queued[path] = []
+      self.run_requests(path, requests)
+  
+  def run_requests(self, path, requests):
+    try:
+      handle = self.walker().lookup(path)
+    except Exception as e:
+      for kind, args, future in requests:
+        future.set_exception(e)
+      return
+    # keep reads and writes in the order they were made: batch each stretch of one kind
+    start = 0
+    while start < len(requests):
+      end = start
+      while end < len(requests) and requests[end][0] == requests[start][0]:
+        end += 1
+      batch = requests[start:end]
+      try:
+        if batch[0][0] == 'read':
+          self.do_reads(path, handle, batch)
+        else:
+          handle = self.do_writes(path, handle, batch)
+      except Exception as e:
+        for kind, args, future in batch:
+          if not future.done():
+            future.set_exception(e)
+      start = end
+  
+  def do_reads(self, path, handle, batch):
+    if handle is None:
+      raise DoesNotExist(path)
+    if handle.is_dir():
+      raise NotAFile(path)
+    length = handle.length()
+    wanted = []
+    for kind, (offset, amt), future in batch:
+      if amt is None:
+        amt = length - offset
+      if offset < 0 or amt < 0 or offset + amt > length:
+        future.set_exception(ReadOutOfBounds('%d bytes at %d of %s (length %d)' %
+                                             (amt, offset, path, length)))
+      else:
+        wanted.append((offset, amt, future))
+    wanted.sort(key=lambda w: w[0])
+    # one read per run of ranges that overlap or are within READ_MERGE_GAP of each other
+    i = 0
+    while i < len(wanted):
+      span_start = wanted[i][0]
+      span_end = span_start + wanted[i][1]
+      j = i + 1
+      while j < len(wanted) and wanted[j][0] <= span_end + READ_MERGE_GAP:
+        span_end = max(span_end, wanted[j][0] + wanted[j][1])
+        j += 1
+      handle.seek_abs(span_start)
+      data = handle.read(span_end - span_start)
+      for offset, amt, future in wanted[i:j]:
+        future.set_result(data[offset - span_start:offset - span_start + amt])
+      i = j
+  
+  def do_writes(self, path, handle, batch):
+    if handle is None:
+      handle = self.walker().create_file(path)
+    elif handle.is_dir():
+      raise NotAFile(path)
+    # writes that pick up where the previous one left off go out as one write
+    run = []
+    run_start = None
+    pos = 0 # where the run so far ends
+    for kind, (offset, data), future in batch:
+      if offset is None:
+        offset = max(handle.length(), pos if run else 0)
+      if run and offset != pos:
+        self.write_run(handle, run_start, run)
+        run = []
+      if not run:
+        run_start = offset
+      run.append((data, future))
+      pos = offset + len(data)
+    if run:
+      self.write_run(handle, run_start, run)
+    return handle
+  
+  def write_run(self, handle, offset, run):
+    try:
+      handle.seek_abs(offset)
+      handle.write(''.join(data for data, future in run))
+    except Exception as e:
+      for data, future in run:
+        future.set_exception(e)
+    else:
+      for data, future in run:
+        future.set_result(len(data))
+  
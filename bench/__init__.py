@@ -0,0 +1,109 @@
+import fs, os, subprocess, tempfile, time
+from collections import OrderedDict
+
+# Benchmark harness. Each benchmark (see cases.py) is a function taking a Config and returning
+# a dict of measurements; run() runs a set of them and returns everything as one JSON-able
+# dict, which `python -m bench` prints or saves, and can compare with an earlier run.
+
+BENCHMARKS = OrderedDict() # name => function(config) -> {metric: value}
+
+def benchmark(name):
+  def register(func):
+    BENCHMARKS[name] = func
+    return func
+  return register
+
+class Config:
+  
+  def __init__(self, block_size=1024, num_blocks=8192, backend='file', cache_blocks=None,
+               journal_blocks=0, scale=1.0, repeat=3, seed=0, inline_data=False, compression=None):
+    self.block_size = block_size
+    self.num_blocks = num_blocks
+    self.backend = backend
+    self.cache_blocks = cache_blocks
+    self.journal_blocks = journal_blocks
+    self.scale = scale # multiplies the size of every workload
+    self.repeat = repeat # timings are the best of this many runs
+    self.seed = seed
+    self.inline_data = inline_data # images with FEATURE_INLINE_DATA
+    self.compression = compression # codec images compress new files with (None: they don't)
+  
+  def as_dict(self):
+    return dict(self.__dict__)
+  
+  def scaled(self, n):
+    return max(1, int(n * self.scale))
+  
+  def capacity(self):
+    # bytes of file contents an image can hold, roughly (the bitmap covers block_size * 8)
+    usable = min(self.num_blocks, self.block_size * 8) - 3 - self.journal_blocks
+    return usable * self.block_size
+  
+  def new_image(self, compression=None):
+    # a fresh, empty image as an open FS10 (opened the way the config says); remove it with
+    # remove_image. compression: a codec for it even if the config has none.
+    fd, path = tempfile.mkstemp(suffix='.fs')
+    os.close(fd)
+    fs.create_fs(path, self.block_size, self.num_blocks, features=self.features(),
+                 journal_blocks=self.journal_blocks,
+                 compression=self.compression or compression).close()
+    return self.open_image(path)
+  
+  def features(self):
+    if self.inline_data:
+      return fs.DEFAULT_FEATURES | fs.FEATURE_INLINE_DATA
+    return fs.DEFAULT_FEATURES
+  
+  def open_image(self, path):
+    return fs.open_fs(path, backend=self.backend, cache_blocks=self.cache_blocks)
+  
+
+def remove_image(f):
+  path = f.handle.name
+  f.close()
+  os.remove(path)
+
+def best_time(config, func, setup=None):
+  # seconds taken by the fastest of config.repeat calls of func(setup())
+  best = None
+  for i in xrange(config.repeat):
+    arg = setup() if setup is not None else None
+    start = time.time()
+    func(arg)
+    elapsed = time.time() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return max(best, 1e-9)
+
+def git_commit():
+  try:
+    with open(os.devnull, 'w') as devnull:
+      out = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=devnull,
+                                    cwd=os.path.dirname(os.path.abspath(fs.__file__)))
+    return out.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def run(config, names=None, progress=None):
+  """runs the named benchmarks (all of them by default); progress(name) is called before
+     each one starts"""
+  results = OrderedDict()
+  for name in names or BENCHMARKS:
+    if progress is not None:
+      progress(name)
+    results[name] = BENCHMARKS[name](config)
+  return OrderedDict([('commit', git_commit()), ('time', time.time()),
+                      ('config', config.as_dict()), ('results', results)])
+
+def compare(old, new):
+  # (benchmark, metric, old value, new value, new / old) for every number in both
+  rows = []
+  for name, metrics in new['results'].items():
+    for metric, value in metrics.items():
+      before = old['results'].get(name, {}).get(metric)
+      if isinstance(value, (int, float)) and isinstance(before, (int, float)):
+        rows.append((name, metric, before, value, float(value) / before if before else None))
+  return rows
+
+# (at the end: cases.py uses the above)
+from . import cases
@@ -0,0 +1,62 @@
+import argparse, json, sys
+import fs
+from bench import BENCHMARKS, Config, run, compare
+
+# python -m bench [options] [benchmark ...]
+#   runs the benchmarks and prints the results as JSON (or saves them with --output)
+# python -m bench --compare old.json new.json
+#   how each number changed between two saved runs
+
+def print_comparison(old_path, new_path):
+  with open(old_path) as h:
+    old = json.load(h)
+  with open(new_path) as h:
+    new = json.load(h)
+  print 'from %s (%s) to %s (%s)' % (old_path, old.get('commit'), new_path, new.get('commit'))
+  for name, metric, before, after, ratio in compare(old, new):
+    print '%-22s %-24s %14.6g %14.6g %s' % (name, metric, before, after,
+                                            '%.2fx' % ratio if ratio is not None else '-')
+
+def main(benchmarks, block_size, num_blocks, backend, cache_blocks, journal_blocks, inline_data,
+         compression, scale, repeat, seed, output, compare, quiet):
+  if compare:
+    print_comparison(*compare)
+    return 0
+  unknown = [name for name in benchmarks if name not in BENCHMARKS]
+  if unknown:
+    print 'unknown benchmark(s): %s (expected some of %s)' % (', '.join(unknown), ', '.join(BENCHMARKS))
+    return 1
+  config = Config(block_size, num_blocks, backend, cache_blocks, journal_blocks, scale, repeat, seed,
+                  inline_data, compression)
+  def progress(name):
+    if not quiet:
+      sys.stderr.write('%s...\n' % name)
+  results = run(config, benchmarks, progress)
+  text = json.dumps(results, indent=2, sort_keys=True, separators=(',', ': '))
+  if output:
+    with open(output, 'w') as h:
+      h.write(text + '\n')
+  else:
+    print text
+  return 0
+
+if __name__ == '__main__':
+  p = argparse.ArgumentParser(prog='python -m bench', description='benchmark fs.py')
+  p.add_argument('benchmarks', nargs='*', help='which to run (default: all of %s)' % ', '.join(BENCHMARKS))
+  p.add_argument('--block-size', '-bs', type=int, help='block size', default=1024)
+  p.add_argument('--num-blocks', '-nb', type=int, help='number of blocks', default=8192)
+  p.add_argument('--backend', choices=sorted(fs.BACKENDS), default='file')
+  p.add_argument('--cache-blocks', type=int, help='put a BlockCache of this many blocks in front')
+  p.add_argument('--journal-blocks', '-j', type=int, help='give the images a journal this big', default=0)
+  p.add_argument('--inline-data', action='store_true',
+                 help='give the images FEATURE_INLINE_DATA (small contents in the inode block)')
+  p.add_argument('--compression', choices=sorted(fs.CODEC_IDS),
+                 help='compress the files in the images with this codec')
+  p.add_argument('--scale', '-s', type=float, help='multiply the size of every workload by this', default=1.0)
+  p.add_argument('--repeat', '-r', type=int, help='timings are the best of this many runs', default=3)
+  p.add_argument('--seed', type=int, default=0)
+  p.add_argument('--output', '-o', help='save the results (JSON) here instead of printing them')
+  p.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two saved runs instead')
+  p.add_argument('--quiet', '-q', action='store_true', help="don't print progress to stderr")
+  ns = p.parse_args(sys.argv[1:])
+  sys.exit(main(**vars(ns)))
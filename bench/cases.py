@@ -0,0 +1,353 @@
+import fs, os, random, tempfile, time
+from bench import benchmark, best_time, remove_image
+
+# The benchmarks. Sizes are scaled by config.scale, and capped so they fit in the image.
+
+MB = float(1 << 20)
+
+def fill_file(h, size, chunk_size):
+  data = '\xa5' * chunk_size
+  done = 0
+  while done < size:
+    h.write(data[:min(chunk_size, size - done)])
+    done += chunk_size
+
+@benchmark('create_fs')
+def bench_create_fs(config):
+  fd, path = tempfile.mkstemp(suffix='.fs')
+  os.close(fd)
+  try:
+    def create(arg):
+      fs.create_fs(path, config.block_size, config.num_blocks, features=config.features(),
+                   journal_blocks=config.journal_blocks).close()
+    return {'seconds': best_time(config, create)}
+  finally:
+    os.remove(path)
+
+@benchmark('alloc_block')
+def bench_alloc_block(config):
+  f = config.new_image()
+  try:
+    n = min(config.scaled(4000), f.num_free - 1)
+    allocated = []
+    def give_back():
+      for block_ind in allocated:
+        f.free_block(block_ind)
+      del allocated[:]
+    def before_alloc():
+      give_back()
+      return allocated
+    def alloc(blocks):
+      for i in xrange(n):
+        blocks.append(f.alloc_block())
+    def before_free():
+      give_back()
+      allocated.extend(f.alloc_block() for i in xrange(n))
+      return list(allocated)
+    def free(blocks):
+      for block_ind in blocks:
+        f.free_block(block_ind)
+      del allocated[:]
+    alloc_time = best_time(config, alloc, before_alloc)
+    free_time = best_time(config, free, before_free)
+    return {'blocks': n, 'alloc_blocks_per_sec': n / alloc_time, 'free_blocks_per_sec': n / free_time}
+  finally:
+    remove_image(f)
+
+def seq_size(config, f):
+  return min(config.scaled(4 << 20), f.num_free * f.block_size / 2)
+
+@benchmark('write_seq')
+def bench_write_seq(config):
+  f = config.new_image()
+  try:
+    size = seq_size(config, f)
+    chunk_size = 64 << 10
+    w = fs.FSWalker(f)
+    def setup():
+      if w.exists('/seq'):
+        w.remove('/seq')
+      return w.create_file('/seq')
+    def write(h):
+      fill_file(h, size, chunk_size)
+      f.flush()
+    t = best_time(config, write, setup)
+    return {'bytes': size, 'chunk_size': chunk_size, 'mb_per_sec': size / MB / t}
+  finally:
+    remove_image(f)
+
+@benchmark('read_seq')
+def bench_read_seq(config):
+  f = config.new_image()
+  try:
+    size = seq_size(config, f)
+    w = fs.FSWalker(f)
+    fill_file(w.create_file('/seq'), size, 64 << 10)
+    f.flush()
+    ans = {'bytes': size}
+    for chunk_size in (config.block_size, 64 << 10):
+      def read(h):
+        h.seek_to_beg()
+        while h.read(min(chunk_size, h.length() - h.cursor)):
+          pass
+      t = best_time(config, read, lambda: w.open('/seq'))
+      ans['mb_per_sec_%d' % chunk_size] = size / MB / t
+    return ans
+  finally:
+    remove_image(f)
+
+@benchmark('small_io')
+def bench_small_io(config):
+  # streaming a file in small pieces: reads go through read-ahead, writes are coalesced
+  f = config.new_image()
+  try:
+    size = min(config.scaled(1 << 20), f.num_free * f.block_size / 2)
+    io_size = 100
+    data = '\xa5' * io_size
+    w = fs.FSWalker(f)
+    def setup():
+      if w.exists('/small'):
+        w.remove('/small')
+      return w.create_file('/small')
+    def write(h):
+      with h.coalescing():
+        for i in xrange(size / io_size):
+          h.write(data)
+      f.flush()
+    write_time = best_time(config, write, setup)
+    stats = []
+    def read(h):
+      h.seek_to_beg()
+      for i in xrange(size / io_size):
+        h.read(io_size)
+      stats.append(h.readahead_stats())
+    read_time = best_time(config, read, lambda: w.open('/small'))
+    return {'bytes': size / io_size * io_size, 'io_size': io_size,
+            'write_mb_per_sec': size / MB / write_time, 'read_mb_per_sec': size / MB / read_time,
+            'readahead_hit_rate': stats[-1]['hit_rate']}
+  finally:
+    remove_image(f)
+
+@benchmark('compressed_io')
+def bench_compressed_io(config):
+  # a compressible file stored compressed and as is: how much it takes, streaming it, and
+  # reading a block's worth at random offsets (which only decompresses the chunks it touches)
+  f = config.new_image(compression=True)
+  try:
+    size = seq_size(config, f) / 2
+    rnd = random.Random(config.seed)
+    words = ['block', 'inode', 'pointer', 'journal', 'bitmap', 'extent', 'chunk', '\n']
+    text = ' '.join(rnd.choice(words) for i in xrange(size / 6 + 1))[:size]
+    bs = f.block_size
+    offsets = [rnd.randrange(size / bs) * bs for i in xrange(config.scaled(2000))]
+    w = fs.FSWalker(f)
+    ans = {'bytes': size}
+    for name, compress in (('compressed', True), ('plain', False)):
+      path = '/' + name
+      def setup():
+        if w.exists(path):
+          w.remove(path)
+        return w.create_file(path, compress=compress)
+      def write(h):
+        for i in xrange(0, size, 64 << 10):
+          h.write(text[i:i + (64 << 10)])
+        f.flush()
+      write_time = best_time(config, write, setup)
+      def read(h):
+        f.chunks.clear() # (decompressing is part of what's being timed)
+        h.seek_to_beg()
+        h.read()
+      read_time = best_time(config, read, lambda: w.open(path))
+      def random_read(h):
+        f.chunks.clear()
+        for offset in offsets:
+          h.seek_abs(offset)
+          h.read(bs)
+      random_time = best_time(config, random_read, lambda: w.open(path))
+      h = w.open(path)
+      ans.update({name + '_blocks': h.blocks_used(), name + '_write_mb_per_sec': size / MB / write_time,
+                  name + '_read_mb_per_sec': size / MB / read_time,
+                  name + '_random_reads_per_sec': len(offsets) / random_time})
+    ans['ratio'] = float(ans['compressed_blocks']) / ans['plain_blocks']
+    return ans
+  finally:
+    remove_image(f)
+
+@benchmark('random_io')
+def bench_random_io(config):
+  # reads and writes of one block's worth at random (block-aligned) offsets
+  f = config.new_image()
+  try:
+    size = seq_size(config, f)
+    bs = f.block_size
+    w = fs.FSWalker(f)
+    fill_file(w.create_file('/rand'), size, 64 << 10)
+    f.flush()
+    rnd = random.Random(config.seed)
+    ops = config.scaled(5000)
+    offsets = [rnd.randrange(size / bs) * bs for i in xrange(ops)]
+    data = ''.join(chr(rnd.randrange(256)) for i in xrange(bs))
+    def read(h):
+      for offset in offsets:
+        h.seek_abs(offset)
+        h.read(bs)
+    def write(h):
+      for offset in offsets:
+        h.seek_abs(offset)
+        h.write(data)
+      f.flush()
+    open_it = lambda: w.open('/rand')
+    read_time = best_time(config, read, open_it)
+    write_time = best_time(config, write, open_it)
+    return {'ops': ops, 'io_size': bs,
+            'read_ops_per_sec': ops / read_time, 'write_ops_per_sec': ops / write_time}
+  finally:
+    remove_image(f)
+
+@benchmark('wide_dir')
+def bench_wide_dir(config):
+  # creating, listing and looking up entries in one big directory
+  f = config.new_image()
+  try:
+    n = min(config.scaled(2000), (f.num_free - 64) / 2)
+    w = fs.FSWalker(f)
+    d = w.create_dir('/wide')
+    names = ['entry-%06d' % i for i in xrange(n)]
+    start = time.time()
+    for name in names:
+      d.create_file(name)
+    create_time = max(time.time() - start, 1e-9)
+    f.flush()
+    get_time = best_time(config, lambda arg: w.open('/wide').get_entries())
+    iter_time = best_time(config, lambda arg: list(w.open('/wide').iter_entries(names_only=True)))
+    rnd = random.Random(config.seed)
+    wanted = [rnd.choice(names) for i in xrange(config.scaled(2000))]
+    # each lookup with a fresh FS10, so it's the directory (or its index) being searched, not
+    # the dentry cache
+    f.close()
+    f = config.open_image(f.handle.name)
+    d = fs.FSWalker(f).open('/wide')
+    start = time.time()
+    for name in wanted:
+      d.lookup_block(name)
+    lookup_time = max(time.time() - start, 1e-9)
+    return {'entries': n, 'creates_per_sec': n / create_time,
+            'get_entries_per_sec': n / get_time, 'iter_entries_per_sec': n / iter_time,
+            'cold_lookups_per_sec': len(wanted) / lookup_time}
+  finally:
+    remove_image(f)
+
+def make_deep(w, depth):
+  path = '/deep' + ''.join('/level%03d' % i for i in xrange(depth))
+  w.makedirs(path)
+  return path
+
+@benchmark('deep_walk')
+def bench_deep_walk(config):
+  # resolving a long path, and walking down and back up it a directory at a time
+  f = config.new_image()
+  try:
+    depth = min(config.scaled(64), (f.num_free - 16) / 2)
+    path = make_deep(fs.FSWalker(f), depth)
+    f.flush()
+    rounds = config.scaled(200)
+    def resolve(arg):
+      w = fs.FSWalker(f)
+      for i in xrange(rounds):
+        w.stat(path)
+    def step(arg):
+      w = fs.FSWalker(f)
+      for i in xrange(rounds / 10 or 1):
+        for name in path.split('/')[1:]:
+          w.enter_dir(name)
+        while not w.at_root():
+          w.cd_up()
+    resolve_time = best_time(config, resolve)
+    step_time = best_time(config, step)
+    return {'depth': depth, 'resolves_per_sec': rounds / resolve_time,
+            'steps_per_sec': (rounds / 10 or 1) * depth * 2 / step_time}
+  finally:
+    remove_image(f)
+
+def make_tree(w, root, fanout, depth, files_per_dir):
+  # a tree of directories `fanout` wide and `depth` deep with files_per_dir files in each;
+  # returns how many entries that is
+  d = w.makedirs(root)
+  count = 0
+  for i in xrange(files_per_dir):
+    d.create_file('file%d' % i).write('x' * 100)
+    count += 1
+  if depth > 0:
+    for i in xrange(fanout):
+      count += 1 + make_tree(w, '%s/dir%d' % (root, i), fanout, depth - 1, files_per_dir)
+  return count
+
+def tree_shape(config, f):
+  # fanout, depth, files per directory that fit
+  fanout, depth, files = 4, 3, max(1, config.scaled(10))
+  while (fanout ** (depth + 1)) * (files + 1) * 3 > f.num_free and files > 1:
+    files /= 2
+  return fanout, depth, files
+
+@benchmark('tiny_files')
+def bench_tiny_files(config):
+  # lots of files of a few dozen bytes: creating them, the blocks they take, reading them back
+  f = config.new_image()
+  try:
+    n = min(config.scaled(2000), (f.num_free - 64) / 3)
+    w = fs.FSWalker(f)
+    d = w.create_dir('/tiny')
+    free = f.num_free
+    start = time.time()
+    for i in xrange(n):
+      d.create_file('t%05d' % i).write('tiny file %05d' % i)
+    create_time = max(time.time() - start, 1e-9)
+    blocks = free - f.num_free
+    f.flush()
+    # reading them all back with a fresh FS10, so nothing's cached
+    f.close()
+    f = config.open_image(f.handle.name)
+    d = fs.FSWalker(f).open('/tiny')
+    start = time.time()
+    for entry in d.iter_entries():
+      fs.handle_for(f, f.read_inode(entry.block_ind)).read()
+    read_time = max(time.time() - start, 1e-9)
+    return {'files': n, 'blocks_per_file': float(blocks) / n,
+            'creates_per_sec': n / create_time, 'reads_per_sec': n / read_time}
+  finally:
+    remove_image(f)
+
+@benchmark('tree_walk')
+def bench_tree_walk(config):
+  # visiting every entry of a tree
+  f = config.new_image()
+  try:
+    w = fs.FSWalker(f)
+    count = make_tree(w, '/tree', *tree_shape(config, f))
+    f.flush()
+    def walk(d):
+      for entry in d.iter_entries():
+        if entry.is_dir:
+          walk(fs.DirHandle(f, f.read_inode(entry.block_ind)))
+    t = best_time(config, lambda arg: walk(fs.FSWalker(f).open('/tree')))
+    return {'entries': count, 'entries_per_sec': count / t}
+  finally:
+    remove_image(f)
+
+@benchmark('remove_dir_recursive')
+def bench_remove_dir_recursive(config):
+  f = config.new_image()
+  try:
+    w = fs.FSWalker(f)
+    shape = tree_shape(config, f)
+    counts = []
+    def setup():
+      counts.append(make_tree(w, '/tree', *shape))
+      f.flush()
+    def remove(arg):
+      w.remove_dir_recursive('/tree')
+      f.flush()
+    t = best_time(config, remove, setup)
+    return {'entries': counts[0], 'entries_per_sec': counts[0] / t}
+  finally:
+    remove_image(f)
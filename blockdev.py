@@ -0,0 +1,414 @@
+import mmap
+import os
+import threading
+from collections import OrderedDict
+from os import SEEK_SET
+
+# Storage layer underneath FS10. A device is anything with read_at/view/write_at/pack_into/
+# flush/sync/close; FS10 does all of its I/O through one.
+#  view(offset, amt): read-only buffer over those bytes, for struct.unpack_from (may be a copy)
+#  pack_into(st, offset, *values): write st.pack(*values) at offset (in place where possible)
+#  sync(): flush, then wait until everything written so far is on stable storage (fsync)
+# All of them are safe to call from several threads at once.
+
+class FileDevice:
+  """Positional I/O on the image (pread/pwrite), so there's no shared file position and
+     reads from several threads can run at once. Where the os module doesn't have them
+     (python 2), each seek + read/write pair is done under a lock instead.
+  """
+  
+  def __init__(self, handle):
+    self.handle = handle
+    self.name = handle.name
+    self.fd = handle.fileno()
+    self.lock = threading.Lock()
+  
+  def __repr__(self):
+    return "<FileDevice '%s'>" % self.name
+  
+  if hasattr(os, 'pread'):
+    def read_at(self, offset, amt):
+      return os.pread(self.fd, amt, offset)
+    
+    def write_at(self, offset, data):
+      done = os.pwrite(self.fd, data, offset)
+      while done < len(data):
+        done += os.pwrite(self.fd, data[done:], offset + done)
+  else:
+    def read_at(self, offset, amt):
+      with self.lock:
+        self.handle.seek(offset, SEEK_SET)
+        return self.handle.read(amt)
+    
+    def write_at(self, offset, data):
+      with self.lock:
+        self.handle.seek(offset, SEEK_SET)
+        self.handle.write(data)
+  
+  def view(self, offset, amt):
+    return self.read_at(offset, amt)
+  
+  def pack_into(self, st, offset, *values):
+    self.write_at(offset, st.pack(*values))
+  
+  def flush(self):
+    self.handle.flush()
+  
+  def sync(self):
+    self.handle.flush()
+    os.fsync(self.fd)
+  
+  def close(self):
+    self.handle.close()
+  
+
+class MmapDevice:
+  """The whole image mapped into memory. Reads and writes are memory copies (no syscalls once
+     the pages are resident), view() hands out zero-copy windows onto the mapping, and
+     pack_into() encodes straight into it.
+  """
+  
+  def __init__(self, handle):
+    self.handle = handle
+    self.name = handle.name
+    self.map = mmap.mmap(handle.fileno(), 0)
+  
+  def __repr__(self):
+    return "<MmapDevice '%s' %d bytes>" % (self.name, len(self.map))
+  
+  def read_at(self, offset, amt):
+    return self.map[offset:offset + amt]
+  
+  def view(self, offset, amt):
+    return map_view(self.map, offset, amt)
+  
+  def write_at(self, offset, data):
+    self.map[offset:offset + len(data)] = data
+  
+  def pack_into(self, st, offset, *values):
+    st.pack_into(self.map, offset, *values)
+  
+  def flush(self):
+    self.map.flush()
+  
+  def sync(self):
+    self.map.flush() # msync
+  
+  def close(self):
+    self.map.flush()
+    self.map.close()
+    self.handle.close()
+  
+
+class BlockCache:
+  """LRU cache of whole blocks in front of another device.
+     write_back=False: writes go straight through to the device (and update any cached copy).
+     write_back=True: writes only dirty the cached block; dirty blocks are written out
+     when they are evicted or on flush().
+     One lock covers the cache; the device underneath is only called with it held.
+  """
+  
+  def __init__(self, dev, block_size, capacity=None, capacity_bytes=None, write_back=False):
+    self.dev = dev
+    self.name = dev.name
+    self.block_size = block_size
+    if capacity is None:
+      if capacity_bytes is None:
+        capacity = DEFAULT_CACHE_BLOCKS
+      else:
+        capacity = capacity_bytes / block_size
+    self.capacity = max(1, capacity)
+    self.write_back = write_back
+    self.blocks = OrderedDict() # block ind => bytearray, least recently used first
+    self.dirty = set()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.writebacks = 0
+    self.lock = threading.Lock()
+  
+  def __repr__(self):
+    return "<BlockCache of %r %d/%d blocks %s>" % (self.dev, len(self.blocks), self.capacity,
+                                                   'write-back' if self.write_back else 'write-through')
+  
+  def stats(self):
+    return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+            'writebacks': self.writebacks, 'cached': len(self.blocks), 'dirty': len(self.dirty),
+            'capacity': self.capacity}
+  
+  def get_block(self, block_ind, load=True):
+    try:
+      block = self.blocks.pop(block_ind)
+      self.hits += 1
+    except KeyError:
+      self.misses += 1
+      if load:
+        data = self.dev.read_at(block_ind * self.block_size, self.block_size)
+        block = bytearray(data)
+        if len(block) < self.block_size: # past the end of the image file
+          block.extend('\x00' * (self.block_size - len(block)))
+      else:
+        block = bytearray(self.block_size)
+      self.make_room()
+    self.blocks[block_ind] = block # (re)insert as most recently used
+    return block
+  
+  def make_room(self):
+    while len(self.blocks) >= self.capacity:
+      block_ind, block = self.blocks.popitem(last=False)
+      self.evictions += 1
+      if block_ind in self.dirty:
+        self.dirty.remove(block_ind)
+        self.dev.write_at(block_ind * self.block_size, str(block))
+        self.writebacks += 1
+  
+  def read_at(self, offset, amt):
+    block_size = self.block_size
+    first = offset / block_size
+    with self.lock:
+      if (offset + amt - 1) / block_size == first:
+        # common case: within one block
+        start = offset - first * block_size
+        return str(self.get_block(first)[start:start + amt])
+      buf = bytearray()
+      end = offset + amt
+      while offset < end:
+        block_ind, start = offset / block_size, offset % block_size
+        seg = min(block_size - start, end - offset)
+        buf += self.get_block(block_ind)[start:start + seg]
+        offset += seg
+      return str(buf)
+  
+  def view(self, offset, amt):
+    return self.read_at(offset, amt)
+  
+  def write_at(self, offset, data):
+    with self.lock:
+      self.write_blocks(offset, data)
+  
+  def write_blocks(self, offset, data):
+    block_size = self.block_size
+    if not self.write_back:
+      self.dev.write_at(offset, data)
+    done = 0
+    while done < len(data):
+      block_ind, start = (offset + done) / block_size, (offset + done) % block_size
+      seg = min(block_size - start, len(data) - done)
+      if self.write_back:
+        # a whole-block overwrite doesn't need the old contents
+        block = self.get_block(block_ind, load=seg < block_size)
+        self.dirty.add(block_ind)
+      elif block_ind in self.blocks:
+        block = self.get_block(block_ind)
+      else:
+        block = None # write-through doesn't allocate cache space on write
+      if block is not None:
+        block[start:start + seg] = data[done:done + seg]
+      done += seg
+  
+  def pack_into(self, st, offset, *values):
+    self.write_at(offset, st.pack(*values))
+  
+  def flush(self):
+    with self.lock:
+      self.write_dirty()
+    self.dev.flush()
+  
+  def sync(self):
+    with self.lock:
+      self.write_dirty()
+    self.dev.sync()
+  
+  def write_dirty(self):
+    write_runs(self.dev, self.block_size, sorted(self.dirty), self.blocks)
+    self.writebacks += len(self.dirty)
+    self.dirty.clear()
+  
+  def close(self):
+    self.flush()
+    self.dev.close()
+  
+
+class BatchDevice:
+  """Holds every write in memory, as whole blocks, until write_out(); then writes the dirty
+     blocks in block order, one write per run of adjacent blocks. FS10.batch() puts one on
+     top of the device stack for the length of a batch. If more than max_blocks pile up they
+     are written out early (max_blocks=0: never; the journal writes them out between
+     operations instead).
+     write_data() is for file contents; write_out() passes those on to the device's own
+     write_data, if it has one, and the rest (metadata) to its write_at.
+  """
+  
+  def __init__(self, dev, block_size, max_blocks=None):
+    self.dev = dev
+    self.name = dev.name
+    self.block_size = block_size
+    if max_blocks is None:
+      max_blocks = BATCH_MAX_BLOCKS
+    self.max_blocks = max_blocks
+    self.overlay = Overlay(dev, block_size)
+    self.metadata = set() # blocks with something other than file contents written to them
+    self.lock = threading.Lock()
+    self.writes = 0
+    self.written = 0
+  
+  def __repr__(self):
+    return '<BatchDevice over %r, %d blocks held>' % (self.dev, len(self.overlay))
+  
+  def read_at(self, offset, amt):
+    with self.lock:
+      if self.overlay.covers(offset, amt):
+        return self.overlay.patch(offset, amt, '')
+      data = self.dev.read_at(offset, amt)
+      if not self.overlay:
+        return data
+      return self.overlay.patch(offset, amt, data)
+  
+  def view(self, offset, amt):
+    return self.read_at(offset, amt)
+  
+  def write_at(self, offset, data):
+    bs = self.block_size
+    with self.lock:
+      self.overlay.write(offset, data)
+      self.metadata.update(xrange(offset / bs, (offset + len(data) - 1) / bs + 1))
+      self.writes += 1
+      if self.max_blocks and len(self.overlay) > self.max_blocks:
+        self.write_blocks()
+  
+  def write_data(self, offset, data):
+    with self.lock:
+      self.overlay.write(offset, data)
+      self.writes += 1
+      if self.max_blocks and len(self.overlay) > self.max_blocks:
+        self.write_blocks()
+  
+  def pack_into(self, st, offset, *values):
+    self.write_at(offset, st.pack(*values))
+  
+  def write_out(self):
+    with self.lock:
+      self.write_blocks()
+  
+  def write_blocks(self):
+    # with lock held
+    blocks = sorted(self.overlay.images)
+    if hasattr(self.dev, 'write_data'):
+      write_runs(self.dev, self.block_size, [b for b in blocks if b in self.metadata],
+                 self.overlay.images)
+      write_runs(DataWriter(self.dev), self.block_size, [b for b in blocks if b not in self.metadata],
+                 self.overlay.images)
+    else:
+      write_runs(self.dev, self.block_size, blocks, self.overlay.images)
+    self.written += len(blocks)
+    self.overlay.clear()
+    self.metadata.clear()
+  
+  def flush(self):
+    self.write_out()
+    self.dev.flush()
+  
+  def sync(self):
+    self.write_out()
+    self.dev.sync()
+  
+  def close(self):
+    self.write_out()
+    self.dev.close()
+  
+
+class DataWriter:
+  # lets write_runs write file contents through a device's write_data
+  
+  def __init__(self, dev):
+    self.write_at = dev.write_data
+  
+
+class Overlay:
+  """Whole-block images held in memory in front of a device: blocks as changed by writes
+     that haven't been passed on to it yet. Not locked; its owner does that.
+  """
+  
+  def __init__(self, dev, block_size):
+    self.dev = dev
+    self.block_size = block_size
+    self.images = {} # block ind => bytearray
+  
+  def __len__(self):
+    return len(self.images)
+  
+  def __contains__(self, block_ind):
+    return block_ind in self.images
+  
+  def clear(self):
+    self.images = {}
+  
+  def covers(self, offset, amt):
+    # whether every block in the range is held here
+    bs = self.block_size
+    images = self.images
+    for block_ind in xrange(offset / bs, (offset + amt - 1) / bs + 1):
+      if block_ind not in images:
+        return False
+    return True
+  
+  def write(self, offset, data):
+    bs = self.block_size
+    done = 0
+    while done < len(data):
+      block_ind, start = (offset + done) / bs, (offset + done) % bs
+      seg = min(bs - start, len(data) - done)
+      image = self.images.get(block_ind)
+      if image is None:
+        # a whole-block overwrite doesn't need the old contents
+        image = bytearray(bs) if seg == bs else bytearray(self.dev.read_at(block_ind * bs, bs))
+        if len(image) < bs: # past the end of the image file
+          image.extend('\x00' * (bs - len(image)))
+        self.images[block_ind] = image
+      image[start:start + seg] = data[done:done + seg]
+      done += seg
+  
+  def patch(self, offset, amt, data):
+    # data read from the device at offset, with any blocks held here copied over it
+    bs = self.block_size
+    first, last = offset / bs, (offset + amt - 1) / bs
+    buf = None
+    for block_ind in xrange(first, last + 1):
+      image = self.images.get(block_ind)
+      if image is not None:
+        if buf is None:
+          buf = bytearray(data)
+          buf.extend('\x00' * (amt - len(buf)))
+        lo, hi = max(offset, block_ind * bs), min(offset + amt, (block_ind + 1) * bs)
+        buf[lo - offset:hi - offset] = image[lo - block_ind * bs:hi - block_ind * bs]
+    if buf is None:
+      return data
+    return str(buf)
+  
+
+def write_runs(dev, block_size, blocks, images):
+  # write images[b] for each b in blocks (sorted), one write per run of adjacent blocks
+  run_start = None
+  run = []
+  for block_ind in blocks:
+    if run and block_ind != run_start + len(run):
+      dev.write_at(run_start * block_size, ''.join(run))
+      run = []
+    if not run:
+      run_start = block_ind
+    run.append(str(images[block_ind]))
+  if run:
+    dev.write_at(run_start * block_size, ''.join(run))
+
+DEFAULT_CACHE_BLOCKS = 1024
+BATCH_MAX_BLOCKS = 65536
+
+try:
+  buffer
+except NameError:
+  def map_view(m, offset, amt):
+    return memoryview(m)[offset:offset + amt]
+else:
+  def map_view(m, offset, amt):
+    # python 2's mmap only has the old buffer interface, so no memoryview
+    return buffer(m, offset, amt)
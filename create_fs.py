@@ -1,10 +1,18 @@
 import fs, argparse
 
-def main(path, block_size, num_blocks):
+def main(path, block_size, num_blocks, dense, preallocate, no_dir_index, journal_blocks,
+         inline_data, compression, chunk_size):
+  features = fs.DEFAULT_FEATURES
+  if no_dir_index:
+    features &= ~fs.FEATURE_DIR_INDEX
+  if inline_data:
+    features |= fs.FEATURE_INLINE_DATA
   try:
-    f = fs.create_fs(path, block_size, num_blocks)
+    f = fs.create_fs(path, block_size, num_blocks, sparse=not dense, preallocate=preallocate,
+                     features=features, journal_blocks=journal_blocks, compression=compression,
+                     chunk_size=chunk_size)
     print f, 'created'
-  except IOError as e:
+  except (IOError, OSError, ValueError) as e:
     print str(e)
 
 if __name__ == '__main__':
@@ -12,6 +20,20 @@ if __name__ == '__main__':
   p.add_argument('path', help='path at which to create the filesystem')
   p.add_argument('--block-size', '-bs', type=int, help='block size', default=fs.DEFAULT_BLOCK_SIZE)
   p.add_argument('--num-blocks', '-nb', type=int, help='number of blocks')
+  p.add_argument('--dense', action='store_true',
+                 help='write out zeroed blocks instead of creating a sparse image')
+  p.add_argument('--preallocate', action='store_true',
+                 help='reserve disk space for the whole image up front (posix_fallocate)')
+  p.add_argument('--no-dir-index', action='store_true',
+                 help="don't give large directories a name-hash index")
+  p.add_argument('--journal-blocks', '-j', type=int, default=0,
+                 help='reserve this many blocks for a write-ahead journal of metadata updates')
+  p.add_argument('--inline-data', action='store_true',
+                 help='keep small files and directories inside their inode block')
+  p.add_argument('--compression', nargs='?', const=fs.DEFAULT_CODEC, metavar='CODEC',
+                 help='compress new files (with %s unless a codec is given)' % fs.DEFAULT_CODEC)
+  p.add_argument('--chunk-size', type=int, default=fs.COMPRESS_CHUNK_SIZE,
+                 help='compressed files are compressed this many bytes at a time')
   import sys
   ns = p.parse_args(sys.argv[1:])
   main(**vars(ns))
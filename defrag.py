@@ -0,0 +1,195 @@
+import fs, argparse, os, struct, sys
+
+# Defragmenter. Goes through the tree in order (a directory's contents, then its index, then
+# its entries) and moves each file whose contents are in more than one run of blocks, or that
+# could sit earlier in the image, into the first run of free blocks big enough for all of it
+# (Handle.relocate). Run on a quiet image, that packs the files towards the start in tree
+# order, so reading a file, or a directory's files one after another, is one sequential
+# sweep. It can be run on an image that's in use: each move holds the file's lock, and with a
+# journal is one transaction.
+#
+# Inode blocks stay where they are (their block is their identity: directories, indexes and
+# open handles all refer to it), so shrink_image can only cut the image back to the last
+# block in use, which may be an inode.
+
+DEFAULT_PASSES = 4
+
+class FragReport:
+  
+  def __init__(self):
+    self.files = 0 # files and directories (and directory indexes), with their contents
+    self.fragmented = 0 # those in more than one run of blocks
+    self.extents = 0 # runs of blocks, over all of them
+    self.blocks = 0
+    self.free_runs = 0
+    self.largest_free_run = 0
+    self.last_used = 0 # last block in use
+  
+  def __repr__(self):
+    return '<FragReport %d/%d fragmented>' % (self.fragmented, self.files)
+  
+  def extents_per_file(self):
+    return float(self.extents) / self.files if self.files else 0.0
+  
+  def lines(self):
+    return ['%d of %d files fragmented; %.2f runs of blocks per file' %
+            (self.fragmented, self.files, self.extents_per_file()),
+            'free space in %d runs, the largest %d blocks; last block in use %d' %
+            (self.free_runs, self.largest_free_run, self.last_used)]
+  
+
+class DefragReport:
+  
+  def __init__(self, before):
+    self.before = before
+    self.after = None
+    self.moved_files = 0
+    self.moved_blocks = 0
+    self.stuck = 0 # fragmented files no free run was big enough for
+  
+  def lines(self):
+    return (['before: ' + line for line in self.before.lines()] +
+            ['after:  ' + line for line in self.after.lines()] +
+            ['moved %d files (%d blocks)%s' %
+             (self.moved_files, self.moved_blocks,
+              '; %d fragmented files left where they were (no room)' % self.stuck if self.stuck else '')])
+  
+
+def count_extents(blocks):
+  return sum(1 for i, b in enumerate(blocks) if i == 0 or b != blocks[i - 1] + 1)
+
+def iter_handles(f, d=None):
+  # every Handle with contents, in tree order
+  if d is None:
+    d = fs.DirHandle(f, f.read_inode(fs.ROOT_INODE_BLOCK))
+  yield d
+  if d.inode.index != 0:
+    yield d.index_handle()
+  dirs = []
+  for entry in d.iter_entries():
+    h = fs.handle_for(f, f.read_inode(entry.block_ind))
+    if entry.is_dir:
+      dirs.append(h)
+    else:
+      yield h
+  for child in dirs:
+    for h in iter_handles(f, child):
+      yield h
+
+def fragmentation(f):
+  report = FragReport()
+  for h in iter_handles(f):
+    extents = count_extents(h.block_list())
+    report.files += 1
+    report.extents += extents
+    report.blocks += h.blocks_used()
+    if extents > 1:
+      report.fragmented += 1
+  for run_start, run_len in f.free_runs():
+    report.free_runs += 1
+    report.largest_free_run = max(report.largest_free_run, run_len)
+  report.last_used = last_used_block(f)
+  return report
+
+def last_used_block(f):
+  for byte_ind in xrange(len(f.bitmap) - 1, -1, -1):
+    byte = f.bitmap[byte_ind]
+    if byte:
+      return byte_ind * 8 + max(bit for bit in xrange(8) if byte & (1 << bit))
+  return 0
+
+def first_fit(f, n):
+  # where alloc_extent(n) would put n blocks, or None if there's no room
+  for run_start, run_len in f.free_runs(f.free_hint * 8):
+    if run_len >= n:
+      return run_start
+  return None
+
+def defrag(f, passes=DEFAULT_PASSES):
+  """defragments the FS10 f (see above); returns a DefragReport with the fragmentation
+     before and after. Moving files out of the way opens up room earlier in the image, so it
+     goes over the tree again (up to `passes` times in all) while that lets files move."""
+  report = DefragReport(fragmentation(f))
+  for i in xrange(passes):
+    report.stuck = 0
+    if not defrag_pass(f, report):
+      break
+  f.flush()
+  report.after = fragmentation(f)
+  return report
+
+def defrag_pass(f, report):
+  # returns whether anything moved
+  moved = False
+  for h in iter_handles(f):
+    blocks = h.block_list()
+    if not blocks:
+      continue # (contents inline in the inode)
+    fragmented = count_extents(blocks) > 1
+    target = first_fit(f, len(blocks))
+    if target is None:
+      if fragmented:
+        report.stuck += 1
+      continue
+    if not fragmented and target > blocks[0]:
+      continue # contiguous already, and there's nowhere earlier to put it
+    if h.relocate() is None: # (someone else took the space meanwhile)
+      if fragmented:
+        report.stuck += 1
+      continue
+    moved = True
+    report.moved_files += 1
+    report.moved_blocks += len(blocks)
+  return moved
+
+def shrink_image(path):
+  """cuts the image at path (which nothing may have open) back to its last block in use;
+     returns the new number of blocks. Not for images with a journal, which is kept in
+     the last blocks."""
+  f = fs.open_fs(path)
+  try:
+    if f.journal is not None:
+      raise ValueError("%s has a journal at its end; can't shrink it" % path)
+    num_blocks = last_used_block(f) + 1
+    block_size = f.block_size
+    old_num_blocks = f.num_blocks
+  finally:
+    f.close()
+  if num_blocks >= old_num_blocks:
+    return old_num_blocks
+  # num_blocks is in the header, after the two version bytes and block_size
+  h = open(path, 'r+b', 0)
+  try:
+    h.seek(2 + 4)
+    h.write(struct.pack('i', num_blocks))
+    h.truncate(num_blocks * block_size)
+    os.fsync(h.fileno())
+  finally:
+    h.close()
+  return num_blocks
+
+
+def main(image, shrink):
+  f = fs.open_fs(image)
+  try:
+    report = defrag(f)
+  finally:
+    f.close()
+  for line in report.lines():
+    print line
+  if shrink:
+    try:
+      num_blocks = shrink_image(image)
+    except ValueError as e:
+      print str(e)
+      return 1
+    print 'image is now %d blocks' % num_blocks
+  return 0
+
+if __name__ == '__main__':
+  p = argparse.ArgumentParser(description='defragment a filesystem image')
+  p.add_argument('image', help='filesystem image')
+  p.add_argument('--shrink', '-s', action='store_true',
+                 help='afterwards, cut the image back to its last block in use')
+  ns = p.parse_args(sys.argv[1:])
+  sys.exit(main(**vars(ns)))
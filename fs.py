@@ -1,157 +1,957 @@
 import struct
 import re
-from os import SEEK_SET, SEEK_CUR
+import os
+import io
+import errno
+import weakref
+import zlib
+import threading
+import functools
+from contextlib import contextmanager
+from collections import OrderedDict, namedtuple
+from os import SEEK_SET
+from blockdev import FileDevice, MmapDevice, BlockCache, BatchDevice
+from journal import JournalDevice
+from iostats import IOStats, CountingDevice
+try:
+  from thread import get_ident
+except ImportError:
+  from threading import get_ident
 
 DEFAULT_BLOCK_SIZE = 128
 HEADER_SIZE = 1 + 1 + 4 + 4
 NUM_POINTERS = 12
-INODE_HEADER_SIZE = 1 + 4 + NUM_POINTERS * 4
-VERSION = (1, 0)
-VALID_NAME_RE = re.compile(r'^[^\t\n\r\f\v/]+$')
+INODE_HEADER_SIZE = 1 + 4 + NUM_POINTERS * 4 # as of version 1.0
+# is_dir, length, pointers; '=' so the fields are packed with no alignment padding
+INODE_FORMAT = '=?i%di' % NUM_POINTERS
+# version 1.1 adds single- and double-indirect pointers after the direct ones
+INDIRECT_FORMAT = 'ii'
+# version 1.2 adds a word of feature flags to the header, after num_blocks
+FEATURES_STRUCT = struct.Struct('=I')
+# FEATURE_DIR_INDEX: directories that outgrow one block of pointers get a name-hash index.
+# Adds the index inode's block (0 = no index) to every inode, after the pointers.
+FEATURE_DIR_INDEX = 1 << 0
+INDEX_FORMAT = 'i'
+# FEATURE_JOURNAL: metadata updates go through a write-ahead journal (see journal.py) kept in
+# the last blocks of the image. Adds its first block and length to the header, after features.
+FEATURE_JOURNAL = 1 << 1
+JOURNAL_STRUCT = struct.Struct('=II')
+# FEATURE_INLINE_DATA: small contents (a file's data, a directory's pointers) are kept in the
+# inode block, after the name, until they outgrow the room there. The inode's first byte
+# becomes flags instead of just is_dir.
+FEATURE_INLINE_DATA = 1 << 2
+INODE_DIR = 1
+INODE_INLINE = 2
+# FEATURE_COMPRESSION: files can be stored compressed (see CompressedFileHandle), with their
+# chunk table as their index (so it needs FEATURE_DIR_INDEX). Adds the length of what's
+# stored to every inode, after the index; makes the inode's first byte flags, as with inline
+# data; and adds to the header, after the journal's fields, the codec new files are
+# compressed with by default (0 = they aren't, unless asked) and the chunk size they get.
+FEATURE_COMPRESSION = 1 << 3
+INODE_COMPRESSED = 4
+STORED_FORMAT = 'I'
+COMPRESSION_STRUCT = struct.Struct('=BI')
+DEFAULT_FEATURES = FEATURE_DIR_INDEX
+FEATURE_NAMES = [(FEATURE_DIR_INDEX, 'dir_index'), (FEATURE_JOURNAL, 'journal'),
+                 (FEATURE_INLINE_DATA, 'inline_data'), (FEATURE_COMPRESSION, 'compression')]
+KNOWN_FEATURES = FEATURE_DIR_INDEX | FEATURE_JOURNAL | FEATURE_INLINE_DATA | FEATURE_COMPRESSION
+VERSION = (1, 2)
+POINTER_STRUCT = struct.Struct('=i')
+POINTER_CACHE_SIZE = 256
+ZERO_CHUNK_SIZE = 1 << 20
+RELOCATE_CHUNK_BLOCKS = 256
+# read-ahead (see Handle.read): the window starts at READAHEAD_MIN_BLOCKS and doubles up to
+# FS10.readahead_blocks, READAHEAD_BLOCKS unless open_fs says otherwise (0 turns it off)
+READAHEAD_BLOCKS = 64
+READAHEAD_MIN_BLOCKS = 4
+# how much Handle.coalescing gathers before writing it out, by default
+COALESCE_BLOCKS = 64
+BYTE_STRUCT = struct.Struct('B')
+INODE_CACHE_SIZE = 1024
+INDEX_HEADER_STRUCT = struct.Struct('=II')
+INDEX_SLOT_STRUCT = struct.Struct('=Iii')
+INDEX_MIN_CAPACITY = 16
+# a compressed file's chunk table (the contents of its index inode):
+# | codec for new chunks (1 byte) | chunk size (4) | entry per chunk |
+# entry: | offset in the stored stream (4) | stored length (4) | codec (1; 0 = stored as is) |
+CHUNK_TABLE_HEADER_STRUCT = struct.Struct('=BI')
+CHUNK_ENTRY_STRUCT = struct.Struct('=IIB')
+COMPRESS_CHUNK_SIZE = 32 << 10
+CHUNK_CACHE_SIZE = 128 # decompressed chunks FS10 keeps
+DENTRY_CACHE_SIZE = 4096
+ROOT_INODE_BLOCK = 2
+# (not '.' or '..': paths use those for the directory itself and its parent)
+VALID_NAME_RE = re.compile(r'^(?!\.\.?$)[^\t\n\r\f\v/]+$')
 
 # FIXME: currently can't have spaces in filenames (but make sure they're not all spaces!)
-# FIXME: VALID_NAME_RE doesn't exclude ".."
-# TODO: walker should work with path names with slashes
-# TODO: FSWalker#move (with paths)
 # TODO: FS10#open
 
-def create_fs(path, block_size=DEFAULT_BLOCK_SIZE, num_blocks=None, fs_version=VERSION):
+def create_fs(path, block_size=DEFAULT_BLOCK_SIZE, num_blocks=None, fs_version=VERSION,
+              sparse=True, preallocate=False, features=DEFAULT_FEATURES, journal_blocks=0,
+              compression=None, chunk_size=COMPRESS_CHUNK_SIZE):
+  """sparse: just extend the image to its final size and let the OS hand back zeroes
+     for the empty blocks. Otherwise (or with preallocate) the space is actually
+     reserved, via posix_fallocate where the platform has it.
+     journal_blocks: reserve that many blocks at the end of the image for a journal.
+     compression: a codec name (or True for DEFAULT_CODEC) to compress new files with, in
+     chunks of chunk_size bytes, unless create_file says otherwise. (FEATURE_COMPRESSION in
+     features without it: files are only compressed when create_file asks.) A compressed
+     file takes two blocks more than a plain one for its chunk table, so it's not worth it
+     for tiny files."""
   if not num_blocks:
     num_blocks = block_size
+  if fs_version < (1, 2):
+    features = 0 # no room for them in the header
+    journal_blocks = 0
+    compression = None
+  if compression:
+    features |= FEATURE_COMPRESSION
+  if features & FEATURE_COMPRESSION and not features & FEATURE_DIR_INDEX:
+    raise ValueError("compression needs dir_index (a compressed file's chunk table is its index)")
+  journal = None
+  if journal_blocks:
+    features |= FEATURE_JOURNAL
+    # (the bitmap can't cover blocks past the first block_size * 8)
+    end = min(num_blocks, block_size * 8)
+    if not 3 <= journal_blocks <= end - 4:
+      raise ValueError('a journal needs at least 3 blocks, and at most %d fit' % (end - 4))
+    journal = (end - journal_blocks, journal_blocks)
+  else:
+    features &= ~FEATURE_JOURNAL
   # create (doesn't create in r+b mode)
   h = open(path, 'w')
   h.close()
   # open for real
   h = open(path, 'r+b', 0) # unbuffered
   # write fs information block (block 0)
-  # major version (1 byte) | minor version (1) | block_size (4 bytes) | num_blocks (4 bytes) | empty |
-  h.write(chr(fs_version[0]))
-  h.write(chr(fs_version[1]))
-  h.write(struct.pack('ii', block_size, num_blocks))
-  for i in xrange(block_size - HEADER_SIZE):
-    h.write('\x00')
-  # write block allocation bitmap (block 1)
+  # major version (1 byte) | minor version (1) | block_size (4 bytes) | num_blocks (4 bytes) |
+  #   features (4 bytes, v1.2+) | journal start, length (4 + 4, FEATURE_JOURNAL) |
+  #   default codec, chunk size (1 + 4, FEATURE_COMPRESSION) | empty |
+  header = chr(fs_version[0]) + chr(fs_version[1]) + struct.pack('ii', block_size, num_blocks)
+  if fs_version >= (1, 2):
+    header += FEATURES_STRUCT.pack(features)
+  if journal is not None:
+    header += JOURNAL_STRUCT.pack(*journal)
+  compressed = None
+  if features & FEATURE_COMPRESSION:
+    compressed = (codec_id(compression), chunk_size)
+    header += COMPRESSION_STRUCT.pack(*compressed)
+  h.write(header + '\x00' * (block_size - len(header)))
+  # write block allocation bitmap (block 1); blocks 0 and 1 are in use
   bools = [True, True]
   bools.extend([False for i in xrange(8-2)])
-  h.write(bools_to_char(bools))
-  all_false = bools_to_char([False for i in xrange(8)])
-  for byte in xrange(block_size - 1):
-    h.write(all_false)
-  # write empty blocks
-  for block in xrange(num_blocks - 2):
-    for byte in xrange(block_size):
-      h.write('\x00')
+  h.write(bools_to_char(bools) + '\x00' * (block_size - 1))
+  # empty blocks
+  size = block_size * num_blocks
+  if preallocate:
+    allocate_zeroed(h, 2 * block_size, size)
+  elif sparse:
+    h.truncate(size)
+  else:
+    write_zeroes(h, 2 * block_size, size)
   # new fs object
-  fs = FS10(h, block_size, num_blocks)
+  fs = FS10(h, block_size, num_blocks, version=fs_version, features=features, journal=journal,
+            compression=compressed)
   # write inode for root directory
   root_block_ind = fs.alloc_block()
-  blocks = [fs.alloc_block()]
-  blocks.extend([0 for i in range(NUM_POINTERS - 1)])
-  fs.write_inode(Inode(root_block_ind, '', True, 0, blocks))
+  fs.write_inode(fs.new_inode(root_block_ind, '', True))
+  if journal is not None:
+    fs.mark_allocated(*journal)
   # return the fs
   return fs
 
-def open_fs(path):
+def allocate_zeroed(h, start, end):
+  try:
+    posix_fallocate = os.posix_fallocate
+  except AttributeError:
+    # not available on this platform/python; writing the zeroes reserves the space too
+    write_zeroes(h, start, end)
+  else:
+    posix_fallocate(h.fileno(), start, end - start)
+
+def write_zeroes(h, start, end):
+  h.seek(start, SEEK_SET)
+  chunk = '\x00' * ZERO_CHUNK_SIZE
+  for offset in xrange(start, end, ZERO_CHUNK_SIZE):
+    h.write(chunk[:min(ZERO_CHUNK_SIZE, end - offset)])
+
+def open_fs(path, backend='file', cache_blocks=None, cache_bytes=None, write_back=False,
+            inode_cache_size=INODE_CACHE_SIZE, instrument=False, trace=None,
+            readahead_blocks=READAHEAD_BLOCKS):
+  """backend: 'file' (seek + read/write on the image) or 'mmap' (map the whole image).
+     With cache_blocks or cache_bytes, I/O goes through an LRU BlockCache of that size
+     (write-through unless write_back=True).
+     instrument: count I/O and the work behind it, per operation, in FS10.stats (an IOStats;
+     see iostats.py). trace (implies instrument): called as trace(kind, block ind, operation)
+     for every block read or written.
+     readahead_blocks: the most a sequential reader reads ahead (see Handle.read); 0 for none.
+     If the image has a journal, anything committed to it but not yet written in place
+     (after a crash) is replayed first."""
   h = open(path, 'r+b', 0)
   version = (ord(h.read(1)), ord(h.read(1)))
   block_size, num_blocks = struct.unpack('ii', h.read(8))
-  h.read(block_size - HEADER_SIZE)
-  return FS10(h, block_size, num_blocks)
+  features = 0
+  if version >= (1, 2):
+    features = FEATURES_STRUCT.unpack(h.read(FEATURES_STRUCT.size))[0]
+  if version > VERSION:
+    h.close()
+    raise UnsupportedVersion('%s is format version %d.%d; this only reads up to %d.%d' %
+                             ((path,) + version + VERSION))
+  if features & ~KNOWN_FEATURES:
+    h.close()
+    raise UnsupportedVersion('%s uses features this does not support (flags 0x%x)' %
+                             (path, features & ~KNOWN_FEATURES))
+  journal = None
+  if features & FEATURE_JOURNAL:
+    journal = JOURNAL_STRUCT.unpack(h.read(JOURNAL_STRUCT.size))
+  compression = None
+  if features & FEATURE_COMPRESSION:
+    compression = COMPRESSION_STRUCT.unpack(h.read(COMPRESSION_STRUCT.size))
+  try:
+    dev = BACKENDS[backend](h)
+  except KeyError:
+    h.close()
+    raise ValueError('unknown backend %r (expected one of %s)' % (backend, ', '.join(sorted(BACKENDS))))
+  stats = None
+  if instrument or trace is not None:
+    stats = IOStats(block_size, trace)
+    dev = CountingDevice(dev, stats)
+  if cache_blocks or cache_bytes:
+    dev = BlockCache(dev, block_size, cache_blocks, cache_bytes, write_back)
+  return FS10(h, block_size, num_blocks, dev, inode_cache_size, version, features, journal, stats,
+              readahead_blocks, compression)
+
+BACKENDS = {'file': FileDevice, 'mmap': MmapDevice}
 
 class FS10:
   
-  def __init__(self, handle, block_size, num_blocks):
+  def __init__(self, handle, block_size, num_blocks, dev=None, inode_cache_size=INODE_CACHE_SIZE,
+               version=VERSION, features=0, journal=None, stats=None,
+               readahead_blocks=READAHEAD_BLOCKS, compression=None):
     self.handle = handle
+    # an IOStats if the FS is instrumented (every use checks for None first)
+    self.stats = stats
+    self.readahead_blocks = readahead_blocks
+    if dev is None:
+      dev = FileDevice(handle)
+    # the BlockCache in front of the image, if there is one (for its hit/miss counters)
+    self.cache = dev if isinstance(dev, BlockCache) else None
+    # journal: (first block, number of blocks) of the journal region, with FEATURE_JOURNAL
+    self.journal = None
+    if journal is not None:
+      self.journal = JournalDevice(dev, block_size, *journal)
+      self.journal.replay()
+      dev = self.journal
+    self.dev = dev
     self.block_size = block_size
     self.num_blocks = num_blocks
-    self.MAX_FILE_LENGTH = NUM_POINTERS * block_size
+    self.version = version
+    self.features = features
+    self.has_indirect = version >= (1, 1)
+    self.has_dir_index = bool(features & FEATURE_DIR_INDEX)
+    self.has_inline_data = bool(features & FEATURE_INLINE_DATA)
+    self.has_compression = bool(features & FEATURE_COMPRESSION)
+    # the codec new files are compressed with unless create_file says otherwise (0 = none),
+    # and the chunk size they get: from the header, but can be changed for this FS10
+    self.compress_codec, self.chunk_size = compression or (0, COMPRESS_CHUNK_SIZE)
+    self.pointers_per_block = block_size / 4
+    inode_format = INODE_FORMAT
+    if self.has_inline_data or self.has_compression:
+      inode_format = inode_format.replace('?', 'B') # (flags)
+    max_blocks = NUM_POINTERS
+    if self.has_indirect:
+      inode_format += INDIRECT_FORMAT
+      max_blocks += self.pointers_per_block + self.pointers_per_block ** 2
+    if self.has_dir_index:
+      inode_format += INDEX_FORMAT
+    if self.has_compression:
+      inode_format += STORED_FORMAT
+    self.MAX_FILE_LENGTH = max_blocks * block_size
     self.CAPACITY = block_size * (num_blocks - 2) # doesn't include inodes
     self.MAX_DIR_ENTRIES = self.MAX_FILE_LENGTH / 4
-    self.MAX_NAME_LENGTH = self.block_size - INODE_HEADER_SIZE
+    self.MAX_NAME_LENGTH = self.block_size - struct.calcsize(inode_format)
+    self.inode_struct = struct.Struct(inode_format + '%ds' % self.MAX_NAME_LENGTH)
+    self.name_struct = struct.Struct('%ds' % self.MAX_NAME_LENGTH)
+    self.pointer_block_struct = struct.Struct('=%di' % self.pointers_per_block)
+    self.pointer_blocks = OrderedDict() # block ind => list of pointers, least recently used first
+    self.inode_cache_size = inode_cache_size
+    self.live_inodes = weakref.WeakValueDictionary() # block ind => Inode
+    self.inode_lru = OrderedDict() # block ind => Inode, least recently used first
+    self.dentry_cache_size = DENTRY_CACHE_SIZE
+    self.dentries = OrderedDict() # (dir inode block, name) => entry's inode block or None
+    self.chunk_cache_size = CHUNK_CACHE_SIZE
+    self.chunks = OrderedDict() # (inode block, chunk) => decompressed chunk, LRU first
+    # Threads: any number can use one FS10 at once, each through its own Handles/FSWalker.
+    # bitmap_lock covers block allocation, cache_lock the inode/dentry/pointer block/chunk caches,
+    # and each Inode has a reader/writer lock for its contents (see Handle).
+    self.bitmap_lock = threading.Lock()
+    self.cache_lock = threading.Lock()
+    self.batch_lock = threading.Lock()
+    self.batch_depth = 0
+    self.writers = Gate() # threads in operations that write
+    self.load_bitmap()
+    if self.journal is not None:
+      self.journal.committed = self.release_freed
+      self.journal.borrow_blocks = self.borrow_blocks
+      self.journal.return_blocks = self.return_blocks
   
   def __repr__(self):
-    return "<FS10 from '%s' block_size=%d num_blocks=%d>" % (self.handle.name, self.block_size, self.num_blocks)
+    return "<FS10 from '%s' v%d.%d block_size=%d num_blocks=%d>" % ((self.handle.name,) + self.version +
+                                                                  (self.block_size, self.num_blocks))
+  
+  def __enter__(self):
+    return self
+  
+  def __exit__(self, exc_type, exc_value, tb):
+    self.close()
+  
+  def flush(self):
+    if self.journal is not None and self.batch_depth:
+      self.journal.flush() # (a commit writes the batch out, between operations)
+    else:
+      self.dev.flush()
+  
+  def sync(self):
+    # everything so far on stable storage (commits the journal's pending group, if any)
+    if self.journal is not None and self.batch_depth:
+      self.journal.sync()
+    else:
+      self.dev.sync()
+  
+  def close(self):
+    self.dev.close()
+  
+  @contextmanager
+  def batch(self, max_blocks=None):
+    """For bulk loading: while the batch is open, nothing is written to the image. Inodes,
+       the bitmap, directory contents and file contents all change in memory, and on the way
+       out the dirty blocks are written in block order, one write per run of adjacent ones
+       (early, if more than max_blocks pile up). With a journal, they're written out into
+       each group the journal commits instead (max_blocks doesn't apply), so only ever
+       between operations, never halfway through one. Applies to every thread using this
+       FS10 (it waits for the operations writing to finish before it starts and ends);
+       batches nest."""
+    with self.batch_lock:
+      if self.batch_depth == 0:
+        with self.writers.closed():
+          if self.journal is not None:
+            max_blocks = 0
+          self.dev = BatchDevice(self.dev, self.block_size, max_blocks)
+          if self.journal is not None:
+            self.journal.batch = self.dev
+      self.batch_depth += 1
+    try:
+      yield self
+    finally:
+      with self.batch_lock:
+        self.batch_depth -= 1
+        if self.batch_depth == 0:
+          with self.writers.closed():
+            batch = self.dev
+            with self.transaction():
+              batch.write_out()
+            if self.journal is not None:
+              self.journal.batch = None
+            self.dev = batch.dev
+  
+  def transaction(self):
+    # context manager around an operation that writes: with a journal, the metadata writes
+    # made inside it reach the image all or not at all. (batch() waits for the ones in
+    # progress.)
+    return Transaction(self)
+  
+  def read_at(self, offset, amt):
+    return self.dev.read_at(offset, amt)
+  
+  def view(self, offset, amt):
+    # read-only buffer over those bytes (zero-copy on the mmap backend), good until the next
+    # write to them
+    return self.dev.view(offset, amt)
+  
+  def write_at(self, offset, data):
+    self.dev.write_at(offset, data)
+  
+  def write_data(self, offset, data):
+    # file contents, which the journal doesn't need to hold (see journal.py)
+    if self.journal is None and self.batch_depth == 0:
+      self.dev.write_at(offset, data)
+    else:
+      self.dev.write_data(offset, data)
+  
+  def read_block(self, block_ind):
+    return self.read_at(block_ind * self.block_size, self.block_size)
   
-  def seek_to_block(self, block_ind):
-    self.handle.seek(block_ind * self.block_size, SEEK_SET)
+  def view_block(self, block_ind):
+    # zero-copy on the mmap backend; only good until the next write to the block
+    return self.dev.view(block_ind * self.block_size, self.block_size)
+  
+  def load_bitmap(self):
+    # block allocation bitmap lives in block 1; bit i of byte j covers block j*8 + i
+    num_bytes = min(self.block_size, (self.num_blocks + 7) / 8)
+    self.bitmap = bytearray(self.read_at(self.block_size, num_bytes))
+    # every byte before free_hint is known to be full
+    self.free_hint = 0
+    self.num_free = min(self.num_blocks, num_bytes * 8) - sum(POPCOUNT[b] for b in self.bitmap)
+    # byte ind => bits set in the bitmap here but clear on disk: blocks freed in transactions
+    # the journal hasn't committed yet (`freed`, see free_block), and blocks it's borrowed
+    self.held = {}
+    self.freed = []
+  
+  def disk_byte(self, byte_ind):
+    # the bitmap byte as it's written
+    return self.bitmap[byte_ind] & ~self.held.get(byte_ind, 0) & 0xff
+  
+  def written_bitmap(self):
+    # the bitmap as it's written (what a checker should compare against)
+    if not self.held:
+      return self.bitmap
+    return bytearray(self.disk_byte(byte_ind) for byte_ind in xrange(len(self.bitmap)))
+  
+  def write_bitmap_byte(self, byte_ind):
+    self.dev.pack_into(BYTE_STRUCT, self.block_size + byte_ind, self.disk_byte(byte_ind))
+  
+  def is_allocated(self, block_ind):
+    return bool(self.bitmap[block_ind / 8] & (1 << (block_ind % 8)))
   
   def alloc_block(self):
-    self.seek_to_block(1)
-    for byte_ind in xrange(self.block_size):
-      bools = char_to_bools(self.handle.read(1))
-      for b in xrange(len(bools)):
-        block_ind = byte_ind * 8 + b
-        val = bools[b]
-        if not val:
+    with self.bitmap_lock:
+      bitmap = self.bitmap
+      for byte_ind in xrange(self.free_hint, len(bitmap)):
+        byte = bitmap[byte_ind]
+        if byte != 0xff:
+          bit = FIRST_FREE_BIT[byte]
+          block_ind = byte_ind * 8 + bit
+          if block_ind >= self.num_blocks:
+            break
           # mark full
-          bools[b] = True
-          self.handle.seek(-1, SEEK_CUR)
-          self.handle.write(bools_to_char(bools))
+          bitmap[byte_ind] = byte | (1 << bit)
+          self.free_hint = byte_ind
+          self.num_free -= 1
+          self.write_bitmap_byte(byte_ind)
+          if self.stats is not None:
+            self.stats.count('blocks_allocated')
           return block_ind
+      self.free_hint = len(bitmap)
+      raise FSFull()
+  
+  def free_runs(self, start=0):
+    # yields (first block ind, length) of each run of free blocks from block `start` on
+    bitmap = self.bitmap
+    end = min(self.num_blocks, len(bitmap) * 8)
+    run_start = None
+    block_ind = start
+    while block_ind < end:
+      if block_ind & 7 == 0 and block_ind + 8 <= end:
+        # whole byte at a time where we can
+        byte = bitmap[block_ind >> 3]
+        if byte == 0xff:
+          if run_start is not None:
+            yield run_start, block_ind - run_start
+            run_start = None
+          block_ind += 8
+          continue
+        elif byte == 0:
+          if run_start is None:
+            run_start = block_ind
+          block_ind += 8
+          continue
+      if bitmap[block_ind >> 3] & (1 << (block_ind & 7)):
+        if run_start is not None:
+          yield run_start, block_ind - run_start
+          run_start = None
+      elif run_start is None:
+        run_start = block_ind
+      block_ind += 1
+    if run_start is not None:
+      yield run_start, end - run_start
+  
+  def mark_allocated(self, start, n):
+    for block_ind in xrange(start, start + n):
+      self.bitmap[block_ind >> 3] |= 1 << (block_ind & 7)
+    self.num_free -= n
+    if self.stats is not None:
+      self.stats.count('blocks_allocated', n)
+    first_byte, last_byte = start / 8, (start + n - 1) / 8
+    if self.held:
+      data = bytearray(self.disk_byte(byte_ind) for byte_ind in xrange(first_byte, last_byte + 1))
+    else:
+      data = self.bitmap[first_byte:last_byte + 1]
+    self.write_at(self.block_size + first_byte, str(data))
+  
+  def alloc_extent(self, n, near=None):
+    # allocates n contiguous blocks and returns the first one's index. Looks for a run at or
+    # after `near` first, then anywhere (first fit). Raises FSFull if there's no such run.
+    with self.bitmap_lock:
+      return self.take_extent(n, near)
+  
+  def take_extent(self, n, near):
+    # alloc_extent, for callers already holding bitmap_lock
+    starts = [self.free_hint * 8]
+    if near is not None and near > starts[0]:
+      starts.insert(0, near)
+    for start in starts:
+      for run_start, run_len in self.free_runs(start):
+        if run_len >= n:
+          self.mark_allocated(run_start, n)
+          return run_start
     raise FSFull()
   
+  def alloc_blocks(self, n, near=None):
+    # allocates n blocks, contiguous if possible, otherwise in as few runs as first fit finds
+    with self.bitmap_lock:
+      if n > self.num_free:
+        raise FSFull()
+      try:
+        start = self.take_extent(n, near)
+        return range(start, start + n)
+      except FSFull:
+        pass
+      blocks = []
+      for run_start, run_len in self.free_runs(self.free_hint * 8):
+        take = min(run_len, n - len(blocks))
+        self.mark_allocated(run_start, take)
+        blocks.extend(xrange(run_start, run_start + take))
+        if len(blocks) == n:
+          break
+      return blocks
+  
   def free_block(self, block_ind):
-    self.seek_to_block(1)
-    self.handle.seek(block_ind / 8, SEEK_CUR)
-    bools = char_to_bools(self.handle.read(1))
-    self.handle.seek(-1, SEEK_CUR)
-    bools[block_ind % 8] = False
-    self.handle.write(bools_to_char(bools))
+    byte_ind = block_ind / 8
+    with self.bitmap_lock:
+      if self.journal is not None and self.journal.in_transaction():
+        # free on disk as of this transaction, but not reusable until the journal has
+        # committed it: until then the committed state still has the block in use, and
+        # file contents written to it go straight to the image
+        self.held[byte_ind] = self.held.get(byte_ind, 0) | 1 << (block_ind % 8)
+        self.freed.append(block_ind)
+      else:
+        self.unset_bit(block_ind)
+      self.write_bitmap_byte(byte_ind)
+    if self.stats is not None:
+      self.stats.count('blocks_freed')
+    self.forget_inode(block_ind)
+    with self.cache_lock:
+      self.pointer_blocks.pop(block_ind, None)
+  
+  def unset_bit(self, block_ind):
+    # (with bitmap_lock held) makes block_ind allocatable
+    byte_ind = block_ind / 8
+    bit = 1 << (block_ind % 8)
+    self.bitmap[byte_ind] &= ~bit & 0xff
+    held = self.held.get(byte_ind, 0) & ~bit
+    if held:
+      self.held[byte_ind] = held
+    else:
+      self.held.pop(byte_ind, None)
+    if byte_ind < self.free_hint:
+      self.free_hint = byte_ind
+    self.num_free += 1
+  
+  def release_freed(self):
+    # the journal has committed the blocks freed so far: they can be reused now
+    with self.bitmap_lock:
+      for block_ind in self.freed:
+        self.unset_bit(block_ind)
+      self.freed = []
+  
+  def borrow_blocks(self, n):
+    # n free blocks for the journal to stage a big group in (or None if there aren't that
+    # many): allocated here, but not on disk, where they stay free
+    with self.bitmap_lock:
+      if n > self.num_free:
+        return None
+      blocks = []
+      for run_start, run_len in self.free_runs(self.free_hint * 8):
+        for block_ind in xrange(run_start, run_start + min(run_len, n - len(blocks))):
+          byte_ind, bit = block_ind / 8, 1 << (block_ind % 8)
+          self.bitmap[byte_ind] |= bit
+          self.held[byte_ind] = self.held.get(byte_ind, 0) | bit
+          blocks.append(block_ind)
+        if len(blocks) == n:
+          break
+      self.num_free -= len(blocks)
+      return blocks
+  
+  def return_blocks(self, blocks):
+    with self.bitmap_lock:
+      for block_ind in blocks:
+        self.unset_bit(block_ind)
+  
+  def read_pointer_block(self, block_ind):
+    # decoded pointer blocks are cached, so walking a big file doesn't keep re-reading them
+    with self.cache_lock:
+      try:
+        pointers = self.pointer_blocks.pop(block_ind)
+      except KeyError:
+        pointers = list(self.pointer_block_struct.unpack_from(self.view_block(block_ind)))
+        if len(self.pointer_blocks) >= POINTER_CACHE_SIZE:
+          self.pointer_blocks.popitem(last=False)
+      self.pointer_blocks[block_ind] = pointers
+      return pointers
+  
+  def write_pointer(self, block_ind, i, value):
+    self.read_pointer_block(block_ind)[i] = value
+    self.dev.pack_into(POINTER_STRUCT, block_ind * self.block_size + i * 4, value)
+  
+  def alloc_pointer_block(self):
+    block_ind = self.alloc_block()
+    self.write_at(block_ind * self.block_size, '\x00' * self.block_size)
+    return block_ind
+  
+  def get_block_ptr(self, inode, n):
+    # block holding logical block n of the inode's contents (0 if it hasn't been allocated)
+    if n < NUM_POINTERS:
+      return inode.blocks[n]
+    n -= NUM_POINTERS
+    per_block = self.pointers_per_block
+    if n < per_block:
+      if inode.indirect == 0:
+        return 0
+      return self.read_pointer_block(inode.indirect)[n]
+    n -= per_block
+    if inode.double_indirect == 0:
+      return 0
+    indirect = self.read_pointer_block(inode.double_indirect)[n / per_block]
+    if indirect == 0:
+      return 0
+    return self.read_pointer_block(indirect)[n % per_block]
+  
+  def set_block_ptr(self, inode, n, block_ind):
+    # allocates any pointer blocks needed along the way; caller writes the inode
+    if n < NUM_POINTERS:
+      inode.blocks[n] = block_ind
+      return
+    n -= NUM_POINTERS
+    per_block = self.pointers_per_block
+    if n < per_block:
+      if inode.indirect == 0:
+        inode.indirect = self.alloc_pointer_block()
+      self.write_pointer(inode.indirect, n, block_ind)
+      return
+    n -= per_block
+    if inode.double_indirect == 0:
+      inode.double_indirect = self.alloc_pointer_block()
+    indirect = self.read_pointer_block(inode.double_indirect)[n / per_block]
+    if indirect == 0:
+      indirect = self.alloc_pointer_block()
+      self.write_pointer(inode.double_indirect, n / per_block, indirect)
+    self.write_pointer(indirect, n % per_block, block_ind)
+  
+  def pointer_blocks_needed(self, inode, first, end):
+    # how many pointer blocks set_block_ptr would have to allocate to give the inode logical
+    # blocks first..end-1
+    n = 0
+    per_block = self.pointers_per_block
+    first, end = max(first, NUM_POINTERS) - NUM_POINTERS, end - NUM_POINTERS
+    if first < min(end, per_block) and inode.indirect == 0:
+      n += 1
+    first, end = max(first, per_block) - per_block, end - per_block
+    if first < end:
+      slots = xrange(first / per_block, (end - 1) / per_block + 1)
+      if inode.double_indirect == 0:
+        n += 1 + len(slots)
+      else:
+        outer = self.read_pointer_block(inode.double_indirect)
+        n += sum(1 for i in slots if outer[i] == 0)
+    return n
+  
+  def free_blocks_from(self, inode, first):
+    # free the inode's data blocks from logical block `first` on, along with the pointer
+    # blocks that no longer point at anything; caller writes the inode
+    for n in xrange(first, NUM_POINTERS):
+      if inode.blocks[n] != 0:
+        self.free_block(inode.blocks[n])
+        inode.blocks[n] = 0
+    per_block = self.pointers_per_block
+    first = max(0, first - NUM_POINTERS)
+    if inode.indirect != 0 and self.free_pointed_to(inode.indirect, first):
+      inode.indirect = 0
+    first = max(0, first - per_block)
+    if inode.double_indirect != 0:
+      outer = self.read_pointer_block(inode.double_indirect)
+      for i in xrange(first / per_block, per_block):
+        if outer[i] != 0 and self.free_pointed_to(outer[i], max(0, first - i * per_block)):
+          self.write_pointer(inode.double_indirect, i, 0)
+      if first == 0:
+        self.free_block(inode.double_indirect)
+        inode.double_indirect = 0
+  
+  def pointer_blocks_of(self, inode):
+    # the indirect and double-indirect blocks the inode's pointers are kept in
+    ans = [b for b in (inode.indirect, inode.double_indirect) if b != 0]
+    if inode.double_indirect != 0:
+      ans.extend(b for b in self.read_pointer_block(inode.double_indirect) if b != 0)
+    return ans
+  
+  def free_pointed_to(self, block_ind, first):
+    # free the blocks pointer block `block_ind` points to from entry `first` on;
+    # if that's all of them, free the pointer block too and return True
+    pointers = self.read_pointer_block(block_ind)
+    for i in xrange(first, len(pointers)):
+      if pointers[i] != 0:
+        self.free_block(pointers[i])
+        if first != 0:
+          self.write_pointer(block_ind, i, 0)
+    if first == 0:
+      self.free_block(block_ind)
+      return True
+    return False
+  
+  def cached_inode(self, block_ind):
+    # Inodes are shared: while anything holds on to an Inode, reading its block again gives
+    # back that same object, so changes made through one handle are seen by all of them.
+    # On top of that the most recently used ones are kept alive in a bounded LRU.
+    with self.cache_lock:
+      inode = self.live_inodes.get(block_ind)
+      if inode is not None:
+        self.inode_lru.pop(block_ind, None)
+        self.lru_add(inode)
+      return inode
+  
+  def remember_inode(self, inode):
+    with self.cache_lock:
+      self.live_inodes[inode.block_ind] = inode
+      self.lru_add(inode)
+  
+  def lru_add(self, inode):
+    # (caller holds cache_lock)
+    self.inode_lru[inode.block_ind] = inode
+    if len(self.inode_lru) > self.inode_cache_size:
+      self.inode_lru.popitem(last=False)
+  
+  def forget_inode(self, block_ind):
+    with self.cache_lock:
+      self.live_inodes.pop(block_ind, None)
+      self.inode_lru.pop(block_ind, None)
+  
+  def cached_dentry(self, dir_ind, name):
+    # (True, inode block of the entry or None if there's no such entry) if the lookup of name
+    # in the directory at dir_ind is cached; otherwise (False, None)
+    key = (dir_ind, name)
+    with self.cache_lock:
+      try:
+        child_ind = self.dentries.pop(key)
+      except KeyError:
+        return False, None
+      self.dentries[key] = child_ind
+      return True, child_ind
+  
+  def remember_dentry(self, dir_ind, name, child_ind):
+    # DirHandle keeps these current as entries are created, removed and renamed
+    key = (dir_ind, name)
+    with self.cache_lock:
+      self.dentries.pop(key, None)
+      self.dentries[key] = child_ind
+      if len(self.dentries) > self.dentry_cache_size:
+        self.dentries.popitem(last=False)
+  
+  def cached_chunk(self, key):
+    # decompressed chunk (inode block, chunk ind) of a compressed file, or None
+    with self.cache_lock:
+      data = self.chunks.pop(key, None)
+      if data is not None:
+        self.chunks[key] = data
+      return data
+  
+  def remember_chunk(self, key, data):
+    with self.cache_lock:
+      self.chunks.pop(key, None)
+      self.chunks[key] = data
+      if len(self.chunks) > self.chunk_cache_size:
+        self.chunks.popitem(last=False)
+  
+  def forget_chunks(self, block_ind, first, end):
+    with self.cache_lock:
+      for i in xrange(first, end):
+        self.chunks.pop((block_ind, i), None)
+  
+  def open_io(self, block_ind, mode='r'):
+    # the file whose inode is at block_ind as a HandleIO (a raw, unbuffered file object)
+    inode = self.read_inode(block_ind)
+    if inode.is_dir:
+      raise NotAFile(inode.name)
+    return HandleIO(handle_for(self, inode), mode)
+  
+  def new_inode(self, block_ind, name, is_dir, codec=0):
+    # a fresh, empty Inode for block_ind (the caller writes it). It gets its first block
+    # straight away, unless its contents can be inline. With a codec it's a compressed file,
+    # and gets an empty chunk table too.
+    blocks = [0] * NUM_POINTERS
+    if self.has_inline_data and not codec:
+      return Inode(block_ind, name, is_dir, 0, blocks, inline='')
+    blocks[0] = self.alloc_block()
+    inode = Inode(block_ind, name, is_dir, 0, blocks)
+    if codec:
+      inode.compressed = True
+      inode.index = self.new_chunk_table(codec, self.chunk_size)
+    return inode
+  
+  def new_chunk_table(self, codec, chunk_size):
+    # returns its inode block
+    table = self.new_inode(self.alloc_block(), '', False)
+    self.write_inode(table)
+    h = FileHandle(self, table)
+    h.metadata = True
+    h.write(CHUNK_TABLE_HEADER_STRUCT.pack(codec, chunk_size))
+    return table.block_ind
+  
+  def codec_for(self, compress):
+    # the codec id a new file gets: compress is a codec name, True (the image's default codec,
+    # or DEFAULT_CODEC), False (none), or None (whatever the image does by default)
+    if compress is None:
+      return self.compress_codec
+    if not compress:
+      return 0
+    if not self.has_compression:
+      raise ValueError("%s can't hold compressed files (no compression feature)" % self.handle.name)
+    if compress is True and self.compress_codec:
+      return self.compress_codec
+    return codec_id(compress)
+  
+  def inline_room(self, name):
+    # how many bytes of contents an inode called name can keep inline
+    return max(0, self.MAX_NAME_LENGTH - len(name) - 1)
   
   def read_inode(self, block_ind):
+    inode = self.cached_inode(block_ind)
+    if self.stats is not None:
+      self.stats.count('inode_reads' if inode is None else 'inode_cache_hits')
+    if inode is not None:
+      return inode
     # Inode disk layout:
-    # | is_dir (1 byte) | length (4) | pointers (4 * 12 = 48 bytes) | name (rest; null-terminated) |
-    self.seek_to_block(block_ind)
-    is_dir = struct.unpack('?', self.handle.read(1))[0]
-    length = struct.unpack('i', self.handle.read(4))[0]
-    blocks = []
-    for i in xrange(NUM_POINTERS):
-      blocks.append(struct.unpack('i', self.handle.read(4))[0])
-    name = ''
-    for i in xrange(self.block_size - INODE_HEADER_SIZE):
-      b = self.handle.read(1)
-      if b == '\x00':
-        break
-      else:
-        name += b
-    return Inode(block_ind, name, is_dir, length, blocks)
+    # | is_dir (1 byte; flags INODE_DIR | INODE_INLINE with FEATURE_INLINE_DATA) | length (4) |
+    #   pointers (4 * 12 = 48 bytes) | indirect (4, v1.1+) | double indirect (4, v1.1+) |
+    #   index (4, FEATURE_DIR_INDEX) | stored length (4, FEATURE_COMPRESSION) |
+    #   name (rest; null-terminated, then the contents if inline) |
+    fields = self.inode_struct.unpack_from(self.view_block(block_ind))
+    flags, length, raw_name = fields[0], fields[1], fields[-1]
+    name = strip_name(raw_name)
+    inode = Inode(block_ind, name, bool(flags & INODE_DIR), length,
+                  list(fields[2:2 + NUM_POINTERS]))
+    if flags & INODE_INLINE:
+      inode.inline = inline_data(raw_name, name, length)
+    extra = list(fields[2 + NUM_POINTERS:-1])
+    if self.has_compression:
+      inode.stored = extra.pop()
+      inode.compressed = bool(flags & INODE_COMPRESSED)
+    if self.has_indirect:
+      inode.indirect, inode.double_indirect = extra[:2]
+    if self.has_dir_index:
+      inode.index = extra[-1]
+    with self.cache_lock:
+      # another thread may have read it meanwhile; everyone has to share the one Inode
+      # (and so its lock)
+      existing = self.live_inodes.get(block_ind)
+      if existing is not None:
+        return existing
+      self.live_inodes[block_ind] = inode
+      self.lru_add(inode)
+    return inode
+  
+  def read_name(self, block_ind):
+    # just the name from an inode block, without decoding (or caching) the rest of the inode
+    inode = self.cached_inode(block_ind)
+    if inode is not None:
+      return inode.name
+    raw = self.name_struct.unpack_from(self.view_block(block_ind), self.block_size - self.MAX_NAME_LENGTH)[0]
+    return strip_name(raw)
   
   def write_inode(self, inode):
-    self.seek_to_block(inode.block_ind)
-    self.handle.write(struct.pack('?', inode.is_dir))
-    self.handle.write(struct.pack('i', inode.length))
     assert len(inode.blocks) == NUM_POINTERS, 'len(inode.blocks) must be 12'
-    for b in inode.blocks:
-      self.handle.write(struct.pack('i', b))
     assert len(inode.name) <= self.MAX_NAME_LENGTH, 'name %s is too long' % inode.name
-    self.handle.write(inode.name)
-    for i in xrange(self.MAX_NAME_LENGTH - len(inode.name)):
-      self.handle.write('\x00')
+    flags = inode.is_dir
+    name = inode.name
+    if self.has_inline_data or self.has_compression:
+      flags = INODE_DIR if inode.is_dir else 0
+      if inode.compressed:
+        flags |= INODE_COMPRESSED
+      if inode.inline is not None:
+        assert len(inode.inline) <= self.inline_room(name), 'inline contents too long'
+        flags |= INODE_INLINE
+        name += '\x00' + inode.inline
+    values = [flags, inode.length] + inode.blocks
+    if self.has_indirect:
+      values += [inode.indirect, inode.double_indirect]
+    if self.has_dir_index:
+      values.append(inode.index)
+    if self.has_compression:
+      values.append(inode.stored)
+    values.append(name)
+    # the name field is NUL-padded by the struct, so this rewrites the whole block
+    self.dev.pack_into(self.inode_struct, inode.block_ind * self.block_size, *values)
+    if self.stats is not None:
+      self.stats.count('inode_writes')
+    with self.cache_lock:
+      if self.live_inodes.get(inode.block_ind) is not inode:
+        self.inode_lru.pop(inode.block_ind, None)
+        self.live_inodes[inode.block_ind] = inode
+        self.lru_add(inode)
   
 
 class Inode:
   
-  def __init__(self, block_ind, name, is_dir, length, blocks=None):
+  def __init__(self, block_ind, name, is_dir, length, blocks=None, indirect=0, double_indirect=0,
+               index=0, inline=None):
     self.block_ind = block_ind
     self.name = name
     self.is_dir = is_dir
     self.length = length
     assert len(blocks) == NUM_POINTERS
     self.blocks = blocks
+    self.indirect = indirect
+    self.double_indirect = double_indirect
+    self.index = index
+    self.inline = inline # the contents, if they're in the inode block (FEATURE_INLINE_DATA)
+    # FEATURE_COMPRESSION: whether the contents are stored compressed, how many bytes that
+    # takes, and the decoded chunk table (a ChunkTable, read when it's first needed)
+    self.compressed = False
+    self.stored = 0
+    self.chunks = None
+    self.lock = RWLock()
+    self.version = 0 # goes up whenever the contents change (so read-ahead knows it's stale)
   
   def __repr__(self):
-    return "<Inode %d '%s' (%s) len=%d blocks=%s>" % (self.block_ind, self.name,
-                                                      'dir' if self.is_dir else 'file',
-                                                      self.length, str(self.blocks))
+    return "<Inode %d '%s' (%s) len=%d blocks=%s%s>" % (self.block_ind, self.name,
+                                                        'dir' if self.is_dir else 'file',
+                                                        self.length, str(self.blocks),
+                                                        self.extra_repr())
+  
+  def extra_repr(self):
+    ans = ''
+    if self.indirect != 0 or self.double_indirect != 0:
+      ans += ' indirect=%d double_indirect=%d' % (self.indirect, self.double_indirect)
+    if self.index != 0:
+      ans += ' index=%d' % self.index
+    if self.inline is not None:
+      ans += ' inline'
+    if self.compressed:
+      ans += ' compressed stored=%d' % self.stored
+    return ans
   
 
+def operation(method):
+  # for FSWalker methods: what they do is counted against them, if the FS is instrumented
+  name = method.__name__
+  @functools.wraps(method)
+  def counted(self, *args, **kwargs):
+    stats = self.fs.stats
+    if stats is None or not stats.begin(name):
+      return method(self, *args, **kwargs)
+    try:
+      return method(self, *args, **kwargs)
+    finally:
+      stats.end()
+  return counted
+
 class FSWalker:
+  # Paths can be absolute ('/a/b') or relative to the current directory ('b', '../c').
+  # Each step of resolving one is a dentry cache lookup once it's been done before.
   
   def __init__(self, fs):
     self.fs = fs
     self.stack = []
     # anchor self at root inode
-    root_inode = fs.read_inode(2)
+    root_inode = fs.read_inode(ROOT_INODE_BLOCK)
     root_handle = DirHandle(fs, root_inode)
     self.stack.append(root_handle)
   
@@ -167,25 +967,94 @@ class FSWalker:
     else:
       return '/'.join([d.name for d in self.stack])
   
-  def exists(self, name):
-    return self.cur_dir().exists(name)
+  def resolve(self, path):
+    # inode blocks of the directories leading down to path, and of path itself. DoesNotExist
+    # names the part of path that doesn't.
+    if path.startswith('/'):
+      chain = [ROOT_INODE_BLOCK]
+    else:
+      chain = [d.inode.block_ind for d in self.stack]
+    names = path.split('/')
+    for i, name in enumerate(names):
+      if name in ('', '.'):
+        continue
+      if name == '..':
+        if len(chain) > 1:
+          chain.pop()
+        continue
+      found, child_ind = self.fs.cached_dentry(chain[-1], name)
+      if not found:
+        parent = self.fs.read_inode(chain[-1])
+        if not parent.is_dir:
+          raise NotADir(parent.name)
+        child_ind = DirHandle(self.fs, parent).lookup_block(name)
+      if child_ind is None:
+        raise DoesNotExist('/'.join(names[:i + 1]))
+      chain.append(child_ind)
+    return chain
+  
+  def split_path(self, path):
+    # (inode blocks leading down to path's parent directory, path's last component)
+    head, sep, name = path.rstrip('/').rpartition('/')
+    if name in ('', '.', '..'):
+      raise InvalidName(path)
+    if sep:
+      return self.resolve(head or '/'), name
+    return [d.inode.block_ind for d in self.stack], name
+  
+  def dir_at(self, chain, path):
+    handle = handle_for(self.fs, self.fs.read_inode(chain[-1]))
+    if not handle.is_dir():
+      raise NotADir(path)
+    return handle
+  
+  def parent_dir(self, path):
+    # (DirHandle for path's parent directory, path's last component)
+    chain, name = self.split_path(path)
+    return self.dir_at(chain, path), name
+  
+  @operation
+  def open(self, path):
+    return handle_for(self.fs, self.fs.read_inode(self.resolve(path)[-1]))
+  
+  def lookup(self, path):
+    # like open, but None if there's nothing there
+    try:
+      return self.open(path)
+    except (DoesNotExist, NotADir):
+      return None
+  
+  def exists(self, path):
+    return self.lookup(path) is not None
+  
+  @operation
+  def stat(self, path):
+    block_ind = self.resolve(path)[-1]
+    inode = self.fs.read_inode(block_ind)
+    return DirEntry(inode.name, block_ind, inode.is_dir, inode.length)
+  
+  @operation
+  def listdir(self, path='.'):
+    return list(self.dir_at(self.resolve(path), path).iter_entries(names_only=True))
   
   def get_entries(self):
     return self.cur_dir().get_entries()
   
+  def iter_entries(self, names_only=False):
+    return self.cur_dir().iter_entries(names_only)
+  
   def cur_dir(self):
     return self.stack[-1]
   
-  def enter_dir(self, dirname):
-    entries = self.cur_dir().get_entries()
-    try:
-      new_dir = entries[dirname]
-      if new_dir.is_dir():
-        self.stack.append(new_dir)
-      else:
-        raise NotADir(dirname)
-    except KeyError:
-      raise DoesNotExist(dirname)
+  @operation
+  def enter_dir(self, path):
+    chain = self.resolve(path)
+    if not self.fs.read_inode(chain[-1]).is_dir:
+      raise NotADir(path)
+    # reuse the handles we already have for directories still on the way
+    have = dict((d.inode.block_ind, d) for d in self.stack)
+    self.stack = [have.get(block_ind) or DirHandle(self.fs, self.fs.read_inode(block_ind))
+                  for block_ind in chain]
   
   def cd_up(self):
     if self.at_root():
@@ -193,31 +1062,182 @@ class FSWalker:
     else:
       self.stack.pop()
   
-  def create_dir(self, name):
-    return self.cur_dir().create_dir(name)
+  @operation
+  def create_dir(self, path):
+    parent, name = self.parent_dir(path)
+    return parent.create_dir(name)
   
-  def create_file(self, name):
-    return self.cur_dir().create_file(name)
+  @operation
+  def create_file(self, path, compress=None):
+    parent, name = self.parent_dir(path)
+    return parent.create_file(name, compress)
   
-  def remove(self, name):
-    self.cur_dir().remove(name)
+  def open_io(self, path, mode='r', buffering=-1):
+    """The file at path as a file object, like io.open: mode is 'r', 'w' (creating or
+       emptying it), or 'a' (creating it, writing at the end), plus '+' to read and write;
+       it's always binary ('b' is allowed). buffering=0 gives the raw HandleIO; otherwise it's
+       in an io.BufferedReader, BufferedWriter or BufferedRandom with a buffer that big
+       (io.DEFAULT_BUFFER_SIZE for -1)."""
+    kind = mode.replace('b', '')
+    if kind not in ('r', 'w', 'a', 'r+', 'w+', 'a+'):
+      raise ValueError('invalid mode: %r' % mode)
+    if kind[0] == 'r':
+      handle = self.open(path)
+    else:
+      handle = self.lookup(path) or self.create_file(path)
+    if handle.is_dir():
+      raise NotAFile(path)
+    if kind[0] == 'w':
+      handle.clear()
+    raw = HandleIO(handle, kind)
+    if buffering == 0:
+      return raw
+    size = buffering if buffering > 0 else io.DEFAULT_BUFFER_SIZE
+    if '+' in kind:
+      return io.BufferedRandom(raw, size)
+    if kind == 'r':
+      return io.BufferedReader(raw, size)
+    return io.BufferedWriter(raw, size)
+  
+  @operation
+  def makedirs(self, path):
+    # creates path and any missing directories on the way to it; returns its DirHandle
+    if path.startswith('/'):
+      dirs = [self.stack[0]]
+    else:
+      dirs = list(self.stack)
+    for name in path.split('/'):
+      if name in ('', '.'):
+        continue
+      if name == '..':
+        if len(dirs) > 1:
+          dirs.pop()
+        continue
+      child = dirs[-1].lookup(name)
+      if child is None:
+        child = dirs[-1].create_dir(name)
+      elif not child.is_dir():
+        raise NotADir(name)
+      dirs.append(child)
+    return dirs[-1]
+  
+  @operation
+  def remove(self, path):
+    parent, name = self.parent_dir(path)
+    parent.remove(name)
+  
+  @operation
+  def remove_dir_recursive(self, path):
+    parent, name = self.parent_dir(path)
+    target = parent.lookup(name)
+    if target is None:
+      raise DoesNotExist(path)
+    if not target.is_dir():
+      raise NotADir(path)
+    self.empty_dir(target)
+    parent.remove(name)
   
-  def remove_dir_recursive(self, name):
+  def empty_dir(self, d):
+    # last entry first: removing the last pointer doesn't move any of the others
+    for entry in d.iter_entries(reverse=True):
+      if entry.is_dir:
+        self.empty_dir(DirHandle(self.fs, self.fs.read_inode(entry.block_ind)))
+      d.remove(entry.name)
+  
+  @operation
+  def move(self, src, dst):
+    # moves src to dst, or into dst (keeping its name) if dst is a directory
+    src_parent, name = self.parent_dir(src)
+    handle = src_parent.lookup(name)
+    if handle is None:
+      raise DoesNotExist(src)
     try:
-      self.enter_dir(name)
-      entries = [e for e in self.get_entries().itervalues()]
-      for entry in entries:
-        if entry.is_dir():
-          self.remove_dir_recursive(entry.name)
-        else:
-          self.remove(entry.name)
-      self.cd_up()
-      self.remove(name)
-    except KeyError:
-      raise DoesNotExist(name)
+      dst_chain = self.resolve(dst)
+      newname = name
+    except DoesNotExist:
+      dst_chain, newname = self.split_path(dst)
+    if handle.inode.block_ind in dst_chain:
+      raise InvalidMove("can't move '%s' inside itself" % src)
+    dst_parent = self.dir_at(dst_chain, dst)
+    if dst_parent.inode.block_ind == src_parent.inode.block_ind:
+      if newname != name:
+        src_parent.rename(name, newname)
+      return
+    if not is_valid_name(newname):
+      raise InvalidName(newname)
+    if dst_parent.exists(newname):
+      raise AlreadyExists(newname)
+    inode = handle.inode
+    with self.fs.transaction():
+      src_parent.unlink(inode)
+      if newname != name:
+        handle.make_room_for_name(newname)
+        inode.name = newname
+        self.fs.write_inode(inode)
+      dst_parent.link(inode)
   
 
+def reading(method):
+  # runs the Handle method holding its inode's lock for reading (and, if the FS is
+  # instrumented, as an operation of that name unless it's part of one already)
+  name = method.__name__
+  @functools.wraps(method)
+  def locked(self, *args, **kwargs):
+    if self.write_buffer_len:
+      self.flush_writes() # (first: a reader can't take the lock for writing)
+    stats = self.fs.stats
+    started = stats is not None and stats.begin(name)
+    lock = self.inode.lock
+    lock.acquire_read()
+    try:
+      return method(self, *args, **kwargs)
+    finally:
+      lock.release_read()
+      if started:
+        stats.end()
+  return locked
+
+def writing(method):
+  # runs the Handle method holding its inode's lock for writing (an operation, like reading)
+  name = method.__name__
+  @functools.wraps(method)
+  def locked(self, *args, **kwargs):
+    stats = self.fs.stats
+    started = stats is not None and stats.begin(name)
+    lock = self.inode.lock
+    lock.acquire_write()
+    try:
+      return method(self, *args, **kwargs)
+    finally:
+      lock.release_write()
+      if started:
+        stats.end()
+  return locked
+
+def journaled(method):
+  # runs the Handle method as one journal transaction; goes outside the inode locks, since
+  # starting a transaction can wait for the ones in progress to finish. (As the outermost
+  # wrapper, it also starts the operation, so a commit at its end counts towards it.)
+  name = method.__name__
+  @functools.wraps(method)
+  def in_transaction(self, *args, **kwargs):
+    if self.fs.journal is None:
+      with self.fs.transaction():
+        return method(self, *args, **kwargs)
+    stats = self.fs.stats
+    started = stats is not None and stats.begin(name)
+    try:
+      with self.fs.transaction():
+        return method(self, *args, **kwargs)
+    finally:
+      if started:
+        stats.end()
+  return in_transaction
+
 class Handle:
+  # A Handle (its cursor) belongs to one thread at a time; threads sharing a file each open
+  # their own. Reads of an inode's contents can go on in parallel, writes exclude everything
+  # else on that inode.
   
   def __init__(self, fs, inode):
     self.name = inode.name
@@ -225,19 +1245,38 @@ class Handle:
     self.inode = inode
     self.cursor = 0
     self.real_cursor = [0, 0] # (block ind, byte ind within block)
+    # read-ahead: (file offset, data, inode version then) of what was last read ahead
+    self.readahead = None
+    self.readahead_window = 0 # blocks
+    self.last_read_end = 0 # (so a first read from the start counts as sequential)
+    self.readahead_hits = 0 # sequential reads served from what was read ahead
+    self.readahead_misses = 0 # sequential reads that went to the image
+    # while coalescing (a list): writes gathered but not made yet, from write_buffer_start on
+    self.write_buffer = None
+    self.write_buffer_start = 0
+    self.write_buffer_len = 0
+    self.write_buffer_max = 0
   
   def length(self):
+    if self.write_buffer_len:
+      return max(self.inode.length, self.write_buffer_start + self.write_buffer_len)
     return self.inode.length
   
   def seek_abs(self, new_ind):
+    if self.write_buffer_len:
+      self.flush_writes()
     if new_ind >= 0 and new_ind <= self.length():
-      self.cursor = new_ind
-      block_size = self.fs.block_size
-      self.real_cursor[0] = self.cursor / block_size
-      self.real_cursor[1] = self.cursor % block_size
+      self.set_cursor(new_ind)
     else:
       raise SeekOutOfBounds('seeked to %d, file length %d' % (new_ind, self.length()))
   
+  def set_cursor(self, new_ind):
+    # no bounds check; write uses this to move past the old end of the file
+    self.cursor = new_ind
+    block_size = self.fs.block_size
+    self.real_cursor[0] = self.cursor / block_size
+    self.real_cursor[1] = self.cursor % block_size
+  
   def seek_rel(self, amt):
     self.seek_abs(self.cursor + amt)
   
@@ -256,25 +1295,104 @@ class Handle:
   def read_one(self):
     if self.at_end():
       raise ReadOutOfBounds()
-    if self.at_block_border():
-      self.real_cursor[0] += 1
-      self.real_cursor[1] = 0
-      self.seek_to_real_cursor()
-    c = self.fs.handle.read(1)
-    self.cursor += 1
-    self.real_cursor[1] += 1
-    return c
+    return self.read(1)
   
+  @reading
   def read(self, amt=None):
-    self.seek_to_real_cursor()
-    buf = ''
+    # A read that picks up where the last one left off is sequential. A sequential read that
+    # has to go to the image reads on to the end of the block readahead_window blocks further
+    # (doubling the window each time), and the reads after it are served from that.
+    remaining = self.length() - self.cursor
     if amt is None:
-      while not self.at_end():
-        buf += self.read_one()
+      amt = remaining
+    elif amt > remaining:
+      raise ReadOutOfBounds()
+    start = self.cursor
+    sequential = start == self.last_read_end
+    self.last_read_end = start + amt
+    have = ''
+    ahead = self.readahead
+    if ahead is not None and ahead[0] <= start < ahead[0] + len(ahead[1]):
+      if ahead[2] == self.inode.version:
+        have = ahead[1][start - ahead[0]:start - ahead[0] + amt]
+        if len(have) == amt:
+          self.count_readahead(True)
+          self.set_cursor(start + amt)
+          return have
+      else:
+        self.readahead = None
+    block_size = self.fs.block_size
+    if sequential and self.fs.readahead_blocks:
+      self.readahead_window = min(max(self.readahead_window * 2, READAHEAD_MIN_BLOCKS),
+                                  self.fs.readahead_blocks)
+      self.count_readahead(False)
+    else:
+      self.readahead_window = 0
+    self.set_cursor(start + len(have))
+    want = amt - len(have)
+    if self.readahead_window and want < self.readahead_window * block_size:
+      end = min(self.length(), ((start + amt) / block_size + self.readahead_window) * block_size)
+      data = self.read_span(end - self.cursor)
+      self.readahead = (start + len(have), data, self.inode.version)
+      self.set_cursor(start + amt)
+      return have + data[:want]
+    return have + self.read_span(want)
+  
+  def read_span(self, amt):
+    # amt bytes from the image, from the cursor on (moving it past them)
+    start = self.cursor
+    if self.inode.inline is not None:
+      self.set_cursor(start + amt)
+      return self.inode.inline[start:start + amt]
+    block_size = self.fs.block_size
+    buf = bytearray(amt)
+    done = 0
+    while done < amt:
+      # read the rest of the current block, and on through any blocks that follow it on disk
+      pointer_ind, offset = self.real_cursor
+      block_ind, seg = self.contiguous_segment(pointer_ind, offset, amt - done)
+      buf[done:done + seg] = self.fs.read_at(block_ind * block_size + offset, seg)
+      done += seg
+      self.set_cursor(self.cursor + seg)
+    return str(buf)
+  
+  def count_readahead(self, hit):
+    if hit:
+      self.readahead_hits += 1
     else:
-      for i in xrange(amt):
-        buf += self.read_one()
-    return buf
+      self.readahead_misses += 1
+    if self.fs.stats is not None:
+      self.fs.stats.count('readahead_hits' if hit else 'readahead_misses')
+  
+  def readahead_stats(self):
+    reads = self.readahead_hits + self.readahead_misses
+    return {'hits': self.readahead_hits, 'misses': self.readahead_misses,
+            'hit_rate': float(self.readahead_hits) / reads if reads else 0.0,
+            'window': self.readahead_window}
+  
+  @reading
+  def readinto(self, buf):
+    # like read, into buf (a bytearray, memoryview, or anything else writable with the buffer
+    # interface): as much as fits, or as is left. Returns how much that was. Each run of
+    # adjacent blocks is copied straight from the device's view of it into buf; there's no
+    # read-ahead (whoever passes buf is buffering already).
+    view = memoryview(buf)
+    amt = min(len(view), self.length() - self.cursor)
+    if self.inode.inline is not None:
+      view[:amt] = self.inode.inline[self.cursor:self.cursor + amt]
+      self.set_cursor(self.cursor + amt)
+      self.last_read_end = self.cursor
+      return amt
+    block_size = self.fs.block_size
+    done = 0
+    while done < amt:
+      pointer_ind, offset = self.real_cursor
+      block_ind, seg = self.contiguous_segment(pointer_ind, offset, amt - done)
+      view[done:done + seg] = self.fs.view(block_ind * block_size + offset, seg)
+      done += seg
+      self.set_cursor(self.cursor + seg)
+    self.last_read_end = self.cursor
+    return amt
   
   def read_int(self):
     return struct.unpack('i', self.read(4))[0]
@@ -282,73 +1400,351 @@ class Handle:
   def write_int(self, val):
     self.write(struct.pack('i', val))
   
-  def at_block_border(self):
-    return self.real_cursor[1] == self.fs.block_size
-  
-  def add_block_and_seek(self):
-    next_pointer_ind = self.real_cursor[0] + 1
-    new_block_ind = self.fs.alloc_block()
-    self.inode.blocks[next_pointer_ind] = new_block_ind
-    self.real_cursor[0] += 1
-    self.real_cursor[1] = 0
-    self.fs.seek_to_block(new_block_ind)
+  def contiguous_segment(self, pointer_ind, offset, amt):
+    # where the data at (pointer_ind, offset) lives, and how much of the next amt bytes can be
+    # moved with one read/write: the rest of this block plus any that follow it on disk
+    block_size = self.fs.block_size
+    block_ind = self.fs.get_block_ptr(self.inode, pointer_ind)
+    seg = min(block_size - offset, amt)
+    last = block_ind
+    while seg < amt:
+      pointer_ind += 1
+      next_ind = self.fs.get_block_ptr(self.inode, pointer_ind)
+      if next_ind != last + 1:
+        break
+      last = next_ind
+      seg = min(seg + block_size, amt)
+    return block_ind, seg
   
-  def seek_to_real_cursor(self):
-    block_ind = self.inode.blocks[self.real_cursor[0]]
-    ind = block_ind * self.fs.block_size + self.real_cursor[1]
-    self.fs.handle.seek(ind, SEEK_SET)
+  def blocks_used(self):
+    # every file keeps at least its first block, unless its contents are inline
+    if self.inode.inline is not None:
+      return 0
+    block_size = self.fs.block_size
+    return max(1, (self.length() + block_size - 1) / block_size)
   
   def write(self, data):
-    self.seek_to_real_cursor()
+    if self.write_buffer is not None and self.buffer_write(data):
+      return
+    self.write_through(data)
+  
+  @journaled
+  @writing
+  def write_through(self, data):
+    # write, never gathered up by coalescing
+    self.inode.version += 1
+    end = self.cursor + len(data)
+    if end > self.fs.MAX_FILE_LENGTH:
+      raise FileFull()
     inode_dirty = False
-    for c in data:
-      if self.at_end(): # we're appending
-        appending = True
-        self.inode.length += 1
+    if self.inode.inline is not None:
+      if end <= self.fs.inline_room(self.inode.name):
+        self.write_inline(data)
+        return
+      self.spill()
+      inode_dirty = True
+    block_size = self.fs.block_size
+    try:
+      inode_dirty = self.reserve_blocks(end) or inode_dirty
+    except FSFull:
+      if inode_dirty: # (spilled: put them back)
+        self.unspill()
+      raise
+    done = 0
+    while done < len(data):
+      pointer_ind, offset = self.real_cursor
+      if self.fs.get_block_ptr(self.inode, pointer_ind) == 0: # hole left by an older version
+        self.fs.set_block_ptr(self.inode, pointer_ind, self.fs.alloc_block())
         inode_dirty = True
-        if self.length() > self.fs.MAX_FILE_LENGTH:
-          raise FileFull()
+      block_ind, seg = self.contiguous_segment(pointer_ind, offset, len(data) - done)
+      if self.metadata:
+        self.fs.write_at(block_ind * block_size + offset, data[done:done + seg])
       else:
-        appending = False
-      if self.at_block_border():
-        if appending:
-          self.add_block_and_seek()
-        else:
-          self.real_cursor[0] += 1
-          self.real_cursor[1] = 0
-      self.fs.handle.write(c)
-      self.cursor += 1
-      self.real_cursor[1] += 1
+        self.fs.write_data(block_ind * block_size + offset, data[done:done + seg])
+      done += seg
+      self.set_cursor(self.cursor + seg)
+    if end > self.length():
+      self.inode.length = end
+      inode_dirty = True
     if inode_dirty:
       self.fs.write_inode(self.inode)
   
+  def write_inline(self, data):
+    start = self.cursor
+    inline = self.inode.inline
+    self.inode.inline = inline[:start] + data + inline[start + len(data):]
+    self.inode.length = len(self.inode.inline)
+    self.set_cursor(start + len(data))
+    self.fs.write_inode(self.inode)
+  
+  def spill(self):
+    # moves inline contents out to a block of their own, next to the inode if that's free
+    # (the caller holds the lock for writing, and writes the inode)
+    fs = self.fs
+    inode = self.inode
+    data = inode.inline
+    inode.blocks[0] = fs.alloc_blocks(1, inode.block_ind + 1)[0]
+    inode.inline = None
+    if data:
+      if self.metadata:
+        fs.write_at(inode.blocks[0] * fs.block_size, data)
+      else:
+        fs.write_data(inode.blocks[0] * fs.block_size, data)
+  
+  def unspill(self):
+    # brings contents small enough back into the inode, freeing their block (the caller holds
+    # the lock for writing, and writes the inode)
+    inode = self.inode
+    data = self.fs.read_at(inode.blocks[0] * self.fs.block_size, inode.length) if inode.length else ''
+    self.fs.free_blocks_from(inode, 0)
+    inode.inline = data
+  
+  @journaled
+  @writing
+  def make_room_for_name(self, name):
+    # a longer name leaves less room for inline contents: if they won't fit alongside name,
+    # moves them out first
+    inode = self.inode
+    if inode.inline is not None and inode.length > self.fs.inline_room(name):
+      self.spill()
+      self.fs.write_inode(inode)
+  
+  def reserve_blocks(self, end):
+    # allocates the blocks for everything up to byte `end` that the file doesn't have yet, as
+    # one extent right after its current last block if there's room. Returns whether it did
+    # (the caller writes the inode). Raises FSFull, having allocated nothing, if there isn't
+    # room for them and the pointer blocks they need.
+    fs = self.fs
+    block_size = fs.block_size
+    have = self.blocks_used()
+    need = (end + block_size - 1) / block_size
+    if need <= have:
+      return False
+    if need - have + fs.pointer_blocks_needed(self.inode, have, need) > fs.num_free:
+      raise FSFull()
+    near = fs.get_block_ptr(self.inode, have - 1) + 1
+    blocks = fs.alloc_blocks(need - have, near)
+    try:
+      for i, block_ind in enumerate(blocks):
+        fs.set_block_ptr(self.inode, have + i, block_ind)
+    except FSFull:
+      # another thread took the pointer blocks' room: give it all back
+      fs.free_blocks_from(self.inode, have)
+      for block_ind in blocks[i:]:
+        fs.free_block(block_ind)
+      raise
+    return True
+  
+  @journaled
+  @writing
+  def allocate(self, length, zero=True):
+    # grows the file to `length` bytes of zeroes, allocating all its blocks in one go (so
+    # they're as contiguous as free space allows). zero=False skips the zeroes, leaving the
+    # new bytes as whatever the blocks held: only for a caller about to write all of them.
+    if self.write_buffer_len:
+      self.flush_writes()
+    if length > self.fs.MAX_FILE_LENGTH:
+      raise FileFull()
+    start = self.length()
+    if length <= start:
+      return
+    if self.inode.inline is not None:
+      if length <= self.fs.inline_room(self.inode.name):
+        self.inode.inline += '\x00' * (length - self.inode.length)
+        self.inode.length = length
+        self.fs.write_inode(self.inode)
+        return
+      self.spill()
+      try:
+        self.reserve_blocks(length)
+      except FSFull:
+        self.unspill()
+        raise
+    else:
+      self.reserve_blocks(length)
+    # (blocks freed by other files keep their old contents, as does the rest of our last one)
+    if zero:
+      self.write_zeroes(start, length)
+    self.inode.length = length
+    self.fs.write_inode(self.inode)
+  
+  def write_zeroes(self, start, end):
+    # zeroes bytes [start, end) of the file's blocks, a contiguous run at a time (the caller
+    # has reserved them, and writes the inode)
+    fs = self.fs
+    block_size = fs.block_size
+    zeroes = '\x00' * min(end - start, ZERO_CHUNK_SIZE)
+    while start < end:
+      pointer_ind, offset = divmod(start, block_size)
+      if fs.get_block_ptr(self.inode, pointer_ind) == 0: # hole left by an older version
+        fs.set_block_ptr(self.inode, pointer_ind, fs.alloc_block())
+      block_ind, seg = self.contiguous_segment(pointer_ind, offset, min(end - start, len(zeroes)))
+      if self.metadata:
+        fs.write_at(block_ind * block_size + offset, zeroes[:seg])
+      else:
+        fs.write_data(block_ind * block_size + offset, zeroes[:seg])
+      start += seg
+  
+  @journaled
+  @writing
   def shrink(self, amt):
+    if self.write_buffer_len:
+      self.flush_writes()
+    self.inode.version += 1
     if amt > self.length():
-      raise ShrinkOutOfBounds(self.length, amt)
+      raise ShrinkOutOfBounds(self.length(), amt)
     self.inode.length -= amt
     # move cursor if necessary
     if self.cursor > self.length():
       self.seek_to_end() # updates cursor & real_cursor
-    if amt > self.real_cursor[1]:
-      # shrinking more than just within current block (don't have to do anything otherwise)
-      shrink_in_first_block = amt - self.real_cursor[1]
-      shrink_in_last_block = (amt - shrink_in_first_block) % self.fs.block_size
-      num_blocks_to_free = (amt - shrink_in_first_block - shrink_in_last_block) / self.fs.block_size
-      pointer_ind = self.cursor / self.fs.block_size
-      # free rest of blocks
-      if num_blocks_to_free >= 1:
-        for i in xrange(num_blocks_to_free + 1):
-          self.fs.free_block(self.inode.blocks[pointer_ind])
-          self.inode.blocks[pointer_ind] = 0
-          pointer_ind -= 1
-    self.fs.write_inode(self.inode)
+    inode = self.inode
+    if inode.inline is not None:
+      inode.inline = inode.inline[:inode.length]
+    else:
+      # keep the blocks still holding data
+      self.fs.free_blocks_from(inode, self.blocks_used())
+      # back inline once it's down to half the room there (not all of it, so that something
+      # hovering around the limit doesn't keep moving in and out)
+      if self.fs.has_inline_data and inode.length <= self.fs.inline_room(inode.name) / 2:
+        self.unspill()
+    self.fs.write_inode(inode)
   
   def clear(self):
     self.shrink(self.length())
   
+  def drop_index(self):
+    # frees the index inode (a directory's name index, a compressed file's chunk table) and
+    # its blocks; the caller is about to free this inode
+    if self.inode.index != 0:
+      index = self.fs.read_inode(self.inode.index)
+      self.fs.free_blocks_from(index, 0)
+      self.fs.free_block(index.block_ind)
+      self.inode.index = 0
+  
+  @contextmanager
+  def coalescing(self, max_bytes=None):
+    """Inside this, writes through this handle are gathered up and made max_bytes (default
+       COALESCE_BLOCKS blocks) at a time, cut at a block boundary, so many small writes
+       become a few big ones. Anything else done with the handle (a read, a seek, shrink...)
+       makes what's gathered first, as does leaving; until then, other handles on the file
+       don't see it."""
+    if self.write_buffer is not None: # coalescing already
+      yield self
+      return
+    self.write_buffer = []
+    self.write_buffer_max = max_bytes or self.fs.block_size * COALESCE_BLOCKS
+    try:
+      yield self
+    finally:
+      try:
+        self.flush_writes()
+      finally:
+        self.write_buffer = None
+  
+  def buffer_write(self, data):
+    # gathers up data, unless it's big enough to write as it is; returns whether it did
+    if not self.write_buffer_len:
+      if len(data) >= self.write_buffer_max:
+        return False
+      self.write_buffer_start = self.cursor
+    elif len(data) >= self.write_buffer_max:
+      self.flush_writes()
+      return False
+    self.write_buffer.append(data)
+    self.write_buffer_len += len(data)
+    self.set_cursor(self.cursor + len(data))
+    if self.write_buffer_len >= self.write_buffer_max:
+      self.flush_writes(whole_blocks=True)
+    return True
+  
+  def flush_writes(self, whole_blocks=False):
+    # makes the gathered writes (with whole_blocks, only up to the last block boundary in
+    # them, keeping the rest gathered)
+    if not self.write_buffer_len:
+      return
+    data = ''.join(self.write_buffer)
+    start = self.write_buffer_start
+    cut = len(data)
+    if whole_blocks:
+      block_size = self.fs.block_size
+      cut = (start + len(data)) / block_size * block_size - start
+      if cut <= 0:
+        cut = len(data)
+    rest = data[cut:]
+    # (empty while writing, so length() is the file's own)
+    self.write_buffer[:] = []
+    self.write_buffer_len = 0
+    cursor = self.cursor
+    self.set_cursor(start)
+    try:
+      self.write_through(data[:cut])
+    finally:
+      self.set_cursor(cursor)
+      if rest:
+        self.write_buffer.append(rest)
+        self.write_buffer_start = start + cut
+        self.write_buffer_len = len(rest)
+  
+  @reading
+  def block_list(self):
+    # the blocks holding the contents, in order (0 for a hole)
+    return [self.fs.get_block_ptr(self.inode, n) for n in xrange(self.blocks_used())]
+  
+  @journaled
+  @writing
+  def relocate(self, near=None):
+    # moves the contents into one run of free blocks (the first big enough at or after
+    # `near`, else the first anywhere) and rebuilds the pointer blocks, which end up wherever
+    # alloc_block puts them. Returns the run's first block, or None if there's no run big
+    # enough, or the contents are inline (and nothing has changed).
+    if self.write_buffer_len:
+      self.flush_writes()
+    if self.inode.inline is not None:
+      return None
+    fs = self.fs
+    block_size = fs.block_size
+    old = [fs.get_block_ptr(self.inode, n) for n in xrange(self.blocks_used())]
+    old_pointer_blocks = fs.pointer_blocks_of(self.inode)
+    try:
+      start = fs.alloc_extent(len(old), near)
+    except FSFull:
+      return None
+    # copy the contents over, reading runs of adjacent blocks with one read
+    for first in xrange(0, len(old), RELOCATE_CHUNK_BLOCKS):
+      chunk = old[first:first + RELOCATE_CHUNK_BLOCKS]
+      parts = []
+      n = 0
+      while n < len(chunk):
+        run = 1
+        while n + run < len(chunk) and chunk[n + run] == chunk[n] + run:
+          run += 1
+        if chunk[n] == 0:
+          parts.append('\x00' * block_size)
+          run = 1
+        else:
+          parts.append(fs.read_at(chunk[n] * block_size, run * block_size))
+        n += run
+      data = ''.join(parts)
+      if self.metadata:
+        fs.write_at((start + first) * block_size, data)
+      else:
+        fs.write_data((start + first) * block_size, data)
+    inode = self.inode
+    inode.blocks = [0] * NUM_POINTERS
+    inode.indirect = inode.double_indirect = 0
+    for n in xrange(len(old)):
+      fs.set_block_ptr(inode, n, start + n)
+    fs.write_inode(inode)
+    for block_ind in old + old_pointer_blocks:
+      if block_ind != 0:
+        fs.free_block(block_ind)
+    return start
+  
 
 class FileHandle(Handle):
   
+  metadata = False # file data, which the journal leaves alone (a dir index is the exception)
+  
   def __repr__(self):
     return "<FileHandle '%s' length=%d cursor=%d>" % (self.name, self.length(), self.cursor)
   
@@ -356,8 +1752,385 @@ class FileHandle(Handle):
     return False
   
 
+class ChunkTable:
+  # a compressed file's chunk table, decoded
+  
+  def __init__(self, codec, chunk_size, entries):
+    self.codec = codec # what changed chunks are compressed with
+    self.chunk_size = chunk_size
+    self.entries = entries # per chunk: (offset in the stored stream, stored length, codec)
+    self.live = sum(entry[1] for entry in entries) # bytes of the stream chunks are using
+  
+
+class CompressedFileHandle(FileHandle):
+  """A file stored compressed (FEATURE_COMPRESSION). Its contents are cut into chunks of
+     chunk_size bytes, each compressed on its own (or kept as is, if that doesn't make it
+     smaller), and its blocks hold the stream of stored chunks, inode.stored bytes of it.
+     Its index inode holds the chunk table, saying where in the stream each chunk is, so a
+     read anywhere decompresses just the chunks it touches; FS10 keeps the most recently
+     used ones decompressed. A rewritten chunk goes back where it was if it fits (or was last
+     in the stream), otherwise at the end; once more than half the stream is space left
+     behind like that, the stream is compacted into new blocks. With a journal, a chunk only
+     goes back where it was if it's the same bytes stored as they are, so that until the new
+     table is committed the old one still finds every chunk it points to."""
+  
+  def __repr__(self):
+    return "<CompressedFileHandle '%s' length=%d stored=%d cursor=%d>" % (
+      self.name, self.length(), self.inode.stored, self.cursor)
+  
+  def blocks_used(self):
+    # the stored stream's (at least the first, like any file)
+    block_size = self.fs.block_size
+    return max(1, (self.inode.stored + block_size - 1) / block_size)
+  
+  def table_handle(self):
+    try:
+      if self.table_file.inode.block_ind == self.inode.index:
+        return self.table_file
+    except AttributeError:
+      pass
+    self.table_file = FileHandle(self.fs, self.fs.read_inode(self.inode.index))
+    self.table_file.metadata = True
+    return self.table_file
+  
+  def chunk_table(self):
+    # read once, and kept on the Inode (which all handles on the file share)
+    if self.inode.chunks is None:
+      table = self.table_handle()
+      table.seek_to_beg()
+      raw = table.read()
+      codec, chunk_size = CHUNK_TABLE_HEADER_STRUCT.unpack_from(raw)
+      start = CHUNK_TABLE_HEADER_STRUCT.size
+      entries = [CHUNK_ENTRY_STRUCT.unpack_from(raw, offset)
+                 for offset in xrange(start, len(raw), CHUNK_ENTRY_STRUCT.size)]
+      self.inode.chunks = ChunkTable(codec, chunk_size, entries)
+    return self.inode.chunks
+  
+  def compression_ratio(self):
+    # stored bytes per byte of contents
+    return float(self.inode.stored) / self.length() if self.length() else 1.0
+  
+  def chunk(self, i):
+    # chunk i of the contents, decompressed
+    key = (self.inode.block_ind, i)
+    data = self.fs.cached_chunk(key)
+    if data is None:
+      offset, length, codec = self.chunk_table().entries[i]
+      data = self.read_stored(offset, length)
+      if codec:
+        try:
+          data = CODECS[codec].decompress(data)
+        except KeyError:
+          raise UnsupportedVersion("'%s' has chunks compressed with codec %d, which isn't "
+                                   "registered" % (self.name, codec))
+      self.fs.remember_chunk(key, data)
+    return data
+  
+  def read_span(self, amt):
+    start = self.cursor
+    end = start + amt
+    chunk_size = self.chunk_table().chunk_size
+    parts = []
+    pos = start
+    while pos < end:
+      i = pos / chunk_size
+      chunk_start = i * chunk_size
+      parts.append(self.chunk(i)[pos - chunk_start:end - chunk_start])
+      pos = min(end, chunk_start + chunk_size)
+    self.set_cursor(end)
+    return ''.join(parts)
+  
+  def readinto(self, buf):
+    # (decompressing makes a copy anyway)
+    view = memoryview(buf)
+    data = self.read(min(len(view), self.length() - self.cursor))
+    view[:len(data)] = data
+    return len(data)
+  
+  def read_stored(self, offset, amt):
+    # amt bytes of the stored stream, from offset
+    block_size = self.fs.block_size
+    parts = []
+    while amt > 0:
+      block_ind, seg = self.contiguous_segment(offset / block_size, offset % block_size, amt)
+      parts.append(self.fs.read_at(block_ind * block_size + offset % block_size, seg))
+      offset += seg
+      amt -= seg
+    return ''.join(parts)
+  
+  def write_stored(self, offset, data):
+    # (the caller sets inode.stored, and writes the inode)
+    end = offset + len(data)
+    if end > self.fs.MAX_FILE_LENGTH:
+      raise FileFull()
+    self.reserve_blocks(end)
+    block_size = self.fs.block_size
+    done = 0
+    while done < len(data):
+      pos = offset + done
+      block_ind, seg = self.contiguous_segment(pos / block_size, pos % block_size, len(data) - done)
+      self.fs.write_data(block_ind * block_size + pos % block_size, data[done:done + seg])
+      done += seg
+  
+  def store_chunk(self, i, data):
+    # compresses data as chunk i (which may be a new last chunk) and puts it in the stream
+    table = self.chunk_table()
+    codec = table.codec
+    stored = CODECS[codec].compress(data) if codec else data
+    if len(stored) >= len(data):
+      codec, stored = 0, data
+    inode = self.inode
+    offset = inode.stored
+    last_in_stream = False
+    if i < len(table.entries):
+      old_offset, old_length, old_codec = table.entries[i]
+      table.live -= old_length
+      # (last in the stream, it can grow or shrink where it is)
+      last_in_stream = old_offset + old_length == inode.stored
+      if self.fs.journal is not None:
+        if codec == old_codec == 0 and len(stored) == old_length:
+          offset = old_offset
+      elif last_in_stream or len(stored) <= old_length:
+        offset = old_offset
+    self.write_stored(offset, stored)
+    # (never lower here: blocks_used goes by it, and chunks_changed frees what's past the end)
+    inode.stored = max(inode.stored, offset + len(stored))
+    entry = (offset, len(stored), codec)
+    if i < len(table.entries):
+      table.entries[i] = entry
+    else:
+      table.entries.append(entry)
+    table.live += len(stored)
+    self.fs.remember_chunk((inode.block_ind, i), data)
+  
+  def chunks_changed(self, first, last):
+    # after chunks first..last (or ones past the end) have changed: cuts the stream off after
+    # its last chunk and frees the blocks it no longer reaches, compacts it if it's mostly
+    # space left behind, and writes the table and the inode
+    inode = self.inode
+    table = self.chunk_table()
+    inode.stored = max([offset + length for offset, length, codec in table.entries] or [0])
+    self.fs.free_blocks_from(inode, self.blocks_used())
+    garbage = inode.stored - table.live
+    if garbage > max(inode.stored / 2, self.fs.block_size) and self.compact():
+      first, last = 0, len(table.entries) - 1
+    size = CHUNK_TABLE_HEADER_STRUCT.size + len(table.entries) * CHUNK_ENTRY_STRUCT.size
+    index = self.table_handle()
+    if index.length() > size:
+      index.shrink(index.length() - size)
+    if first <= last:
+      index.seek_abs(CHUNK_TABLE_HEADER_STRUCT.size + first * CHUNK_ENTRY_STRUCT.size)
+      index.write(''.join(CHUNK_ENTRY_STRUCT.pack(*entry) for entry in table.entries[first:last + 1]))
+    self.fs.write_inode(inode)
+  
+  def compact(self):
+    # copies the chunks up against each other, in the order they're in the stream, into new
+    # blocks, and frees the old ones (like relocate: nothing the committed chunk table points
+    # at is written over). Returns whether it did; it doesn't if there isn't the room.
+    fs = self.fs
+    block_size = fs.block_size
+    inode = self.inode
+    entries = self.chunk_table().entries
+    order = sorted(xrange(len(entries)), key=lambda i: entries[i][0])
+    n = max(1, (sum(entries[i][1] for i in order) + block_size - 1) / block_size)
+    old = [fs.get_block_ptr(inode, b) for b in xrange(self.blocks_used())]
+    old_pointer_blocks = fs.pointer_blocks_of(inode)
+    pointers = (inode.blocks, inode.indirect, inode.double_indirect)
+    inode.blocks = [0] * NUM_POINTERS
+    inode.indirect = inode.double_indirect = 0
+    try:
+      if n + fs.pointer_blocks_needed(inode, 0, n) > fs.num_free:
+        raise FSFull()
+      blocks = fs.alloc_blocks(n)
+      try:
+        for b, block_ind in enumerate(blocks):
+          fs.set_block_ptr(inode, b, block_ind)
+      except FSFull:
+        # another thread took the pointer blocks' room: give it all back
+        fs.free_blocks_from(inode, 0)
+        for block_ind in blocks[b:]:
+          fs.free_block(block_ind)
+        raise
+    except FSFull:
+      inode.blocks, inode.indirect, inode.double_indirect = pointers
+      return False
+    pos = 0
+    for i in order:
+      offset, length, codec = entries[i]
+      # (read from the old blocks, a run of adjacent ones at a time)
+      parts = []
+      end = offset + length
+      while offset < end:
+        b = offset / block_size
+        run = 1
+        while b + run < len(old) and old[b + run] == old[b] + run:
+          run += 1
+        seg = min(end, (b + run) * block_size) - offset
+        parts.append(fs.read_at(old[b] * block_size + offset % block_size, seg))
+        offset += seg
+      self.write_stored(pos, ''.join(parts))
+      entries[i] = (pos, length, codec)
+      pos += length
+    inode.stored = pos
+    for block_ind in old + old_pointer_blocks:
+      if block_ind != 0:
+        fs.free_block(block_ind)
+    return True
+  
+  @journaled
+  @writing
+  def write_through(self, data):
+    if not data:
+      return
+    self.inode.version += 1
+    inode = self.inode
+    start = self.cursor
+    end = start + len(data)
+    if end > self.fs.MAX_FILE_LENGTH:
+      raise FileFull()
+    chunk_size = self.chunk_table().chunk_size
+    first, last = start / chunk_size, (end - 1) / chunk_size
+    for i in xrange(first, last + 1):
+      chunk_start = i * chunk_size
+      old = self.chunk(i) if chunk_start < inode.length else ''
+      lo, hi = max(start, chunk_start), min(end, chunk_start + chunk_size)
+      self.store_chunk(i, old[:lo - chunk_start] + data[lo - start:hi - start] + old[hi - chunk_start:])
+    inode.length = max(inode.length, end)
+    self.set_cursor(end)
+    self.chunks_changed(first, last)
+  
+  @journaled
+  @writing
+  def allocate(self, length, zero=True):
+    # (there's nothing to reserve ahead of time: this just writes zeroes, whatever `zero` says)
+    if self.write_buffer_len:
+      self.flush_writes()
+    if length > self.fs.MAX_FILE_LENGTH:
+      raise FileFull()
+    cursor = self.cursor
+    chunk_size = self.chunk_table().chunk_size
+    while self.length() < length:
+      self.set_cursor(self.length())
+      self.write_through('\x00' * min(chunk_size, length - self.length()))
+    self.set_cursor(cursor)
+  
+  @journaled
+  @writing
+  def shrink(self, amt):
+    if self.write_buffer_len:
+      self.flush_writes()
+    if amt > self.length():
+      raise ShrinkOutOfBounds(self.length(), amt)
+    self.inode.version += 1
+    inode = self.inode
+    table = self.chunk_table()
+    chunk_size = table.chunk_size
+    inode.length -= amt
+    if self.cursor > inode.length:
+      self.seek_to_end()
+    keep = (inode.length + chunk_size - 1) / chunk_size
+    self.fs.forget_chunks(inode.block_ind, keep, len(table.entries))
+    for offset, length, codec in table.entries[keep:]:
+      table.live -= length
+    del table.entries[keep:]
+    last = keep - 1
+    if keep and inode.length % chunk_size:
+      self.store_chunk(last, self.chunk(last)[:inode.length - last * chunk_size])
+    self.chunks_changed(max(0, last), last)
+  
+  def drop_index(self):
+    table = self.chunk_table()
+    self.fs.forget_chunks(self.inode.block_ind, 0, len(table.entries))
+    self.inode.chunks = None
+    FileHandle.drop_index(self)
+  
+
+class HandleIO(io.RawIOBase):
+  """A FileHandle as a raw file object (io.RawIOBase), for code that wants one: wrap it in
+     an io.BufferedReader etc. (FSWalker.open_io does), or hand it to shutil.copyfileobj.
+     seek and tell are the handle's cursor, truncate shrinks (or zero-fills) the file.
+     Files can't have gaps, so seeking past the end is an error, not a way to make one."""
+  
+  def __init__(self, handle, mode='r'):
+    io.RawIOBase.__init__(self)
+    self.handle = handle
+    self.name = handle.name
+    self.mode = mode
+    self.can_read = mode[0] == 'r' or '+' in mode
+    self.can_write = mode[0] in 'wa' or '+' in mode
+    self.appending = mode[0] == 'a'
+  
+  def __repr__(self):
+    return "<HandleIO '%s' mode='%s'>" % (self.name, self.mode)
+  
+  def readable(self):
+    self._checkClosed()
+    return self.can_read
+  
+  def writable(self):
+    self._checkClosed()
+    return self.can_write
+  
+  def seekable(self):
+    self._checkClosed()
+    return True
+  
+  def readinto(self, buf):
+    self._checkReadable()
+    return self.handle.readinto(buf)
+  
+  def readall(self):
+    self._checkReadable()
+    return self.handle.read()
+  
+  def write(self, buf):
+    self._checkWritable()
+    data = memoryview(buf).tobytes()
+    if self.appending:
+      self.handle.seek_to_end()
+    self.handle.write(data)
+    return len(data)
+  
+  def seek(self, pos, whence=os.SEEK_SET):
+    self._checkClosed()
+    if whence not in (os.SEEK_SET, os.SEEK_CUR, os.SEEK_END):
+      raise ValueError('invalid whence: %r' % whence)
+    try:
+      if whence == os.SEEK_SET:
+        self.handle.seek_abs(pos)
+      elif whence == os.SEEK_CUR:
+        self.handle.seek_abs(self.handle.cursor + pos)
+      else:
+        self.handle.seek_from_end(-pos)
+    except SeekOutOfBounds as e:
+      raise IOError(errno.EINVAL, str(e))
+    return self.handle.cursor
+  
+  def tell(self):
+    self._checkClosed()
+    return self.handle.cursor
+  
+  def truncate(self, size=None):
+    self._checkWritable()
+    if size is None:
+      size = self.handle.cursor
+    if size < 0:
+      raise IOError(errno.EINVAL, 'negative size: %d' % size)
+    length = self.handle.length()
+    if size < length:
+      self.handle.shrink(length - size) # (moves the cursor back to the end if it's past it)
+    elif size > length:
+      cursor = self.handle.cursor
+      self.handle.seek_to_end()
+      self.handle.write('\x00' * (size - length))
+      self.handle.seek_abs(cursor)
+    return size
+  
+
 class DirHandle(Handle):
   
+  metadata = True
+  
   def __repr__(self):
     return "<DirHandle '%s' entries=%d>" % (self.name, self.num_entries())
   
@@ -368,104 +2141,357 @@ class DirHandle(Handle):
     return self.num_entries() == 0
   
   def get_pointers(self):
-    pointers = []
-    self.seek_to_beg()
-    while not self.at_end():
-      pointers.append(self.read_int())
-    return pointers
+    return list(self.iter_pointers())
   
-  def get_entries(self):
-    try:
-      return self.entries
-    except AttributeError:
-      entries = {}
-      for ptr in self.get_pointers():
+  def iter_pointers(self, reverse=False):
+    # the pointer list, read a block at a time. Seeks before each read, so the handle can be
+    # used in between; with reverse=True, entries can be removed as they're yielded.
+    per_block = self.fs.pointers_per_block
+    num_entries = self.num_entries()
+    if reverse:
+      starts = xrange((num_entries - 1) / per_block * per_block, -1, -per_block)
+    else:
+      starts = xrange(0, num_entries, per_block)
+    for start in starts:
+      count = min(per_block, num_entries - start)
+      self.seek_abs(start * 4)
+      pointers = struct.unpack('=%di' % count, self.read(count * 4))
+      if reverse:
+        pointers = reversed(pointers)
+      for ptr in pointers:
+        yield ptr
+  
+  def iter_entries(self, names_only=False, reverse=False):
+    # yields a DirEntry (or with names_only, just the name) per entry as the pointer list is
+    # read, without building handles or holding the whole directory in memory
+    for ptr in self.iter_pointers(reverse):
+      if names_only:
+        yield self.fs.read_name(ptr)
+      else:
         inode = self.fs.read_inode(ptr)
-        if inode.is_dir:
-          entry = DirHandle(self.fs, inode)
-        else:
-          entry = FileHandle(self.fs, inode)
-        entries[inode.name] = entry
-      self.entries = entries
-      return entries
+        yield DirEntry(inode.name, ptr, inode.is_dir, inode.length)
+  
+  def get_entries(self):
+    # a fresh dict of name => handle each time (so it's never stale)
+    entries = {}
+    for ptr in self.iter_pointers():
+      entry = self.make_entry(self.fs.read_inode(ptr))
+      entries[entry.name] = entry
+    return entries
+  
+  def make_entry(self, inode):
+    return handle_for(self.fs, inode)
+  
+  def lookup(self, name):
+    # handle for the entry called name, or None
+    child_ind = self.lookup_block(name)
+    if child_ind is None:
+      return None
+    return self.make_entry(self.fs.read_inode(child_ind))
+  
+  @reading
+  def lookup_block(self, name):
+    # inode block of the entry called name, or None; cached in the FS's dentry cache
+    found, child_ind = self.fs.cached_dentry(self.inode.block_ind, name)
+    if not found:
+      child_ind = self.find_entry(name)
+      self.fs.remember_dentry(self.inode.block_ind, name, child_ind)
+    return child_ind
+  
+  def find_entry(self, name):
+    # Large directories answer this from their hash index, without reading the whole directory
+    if self.inode.index == 0:
+      stats = self.fs.stats
+      if stats is not None:
+        stats.count('dir_scans')
+      for i, ptr in enumerate(self.iter_pointers()):
+        if self.fs.read_name(ptr) == name:
+          if stats is not None:
+            stats.count('dir_entries_scanned', i + 1)
+          return ptr
+      if stats is not None:
+        stats.count('dir_entries_scanned', self.num_entries())
+      return None
+    found = self.index_find(name)
+    if found is None:
+      return None
+    return found[1]
   
   def exists(self, entry_name):
-    return entry_name in self.get_entries()
+    return self.lookup(entry_name) is not None
   
   def is_dir(self):
     return True
   
-  def create_child_inode(self, name, is_dir):
+  @journaled
+  @writing
+  def create_child_inode(self, name, is_dir, codec=0):
     if not is_valid_name(name):
       raise InvalidName(name)
-    if name in self.get_entries():
+    if self.exists(name):
       raise AlreadyExists(name)
-    inode_ind = self.fs.alloc_block()
-    first_block = self.fs.alloc_block()
-    blocks = [first_block]
-    blocks.extend([0 for i in xrange(NUM_POINTERS - 1)])
-    inode = Inode(inode_ind, name, is_dir, 0, blocks)
+    inode = self.fs.new_inode(self.fs.alloc_block(), name, is_dir, codec)
     self.fs.write_inode(inode)
-    self.seek_to_end()
-    self.write_int(inode_ind)
+    self.link(inode)
     return inode
   
   def create_dir(self, name):
     inode = self.create_child_inode(name, True)
-    handle = DirHandle(self.fs, inode)
-    self.entries[name] = handle
-    return handle
+    return DirHandle(self.fs, inode)
   
-  def create_file(self, name):
-    inode = self.create_child_inode(name, False)
-    handle = FileHandle(self.fs, inode)
-    self.entries[name] = handle
-    return handle
+  def create_file(self, name, compress=None):
+    # compress: a codec name, True or False; None does what the image does (see FS10.codec_for)
+    inode = self.create_child_inode(name, False, self.fs.codec_for(compress))
+    return handle_for(self.fs, inode)
   
-  def remove(self, name):
-    try:
-      handle = self.get_entries()[name]
-    except KeyError:
-      raise DoesNotExist(name)
-    if handle.is_dir():
-      if not handle.is_empty():
-        raise DirNotEmpty()
-    inode = handle.inode
-    # remove inode pointer from dir's contents
-    pointers = self.get_pointers()
-    ptr_ind = pointers.index(inode.block_ind)
-    if ptr_ind == len(pointers)-1: # last pointer
-      self.shrink(4)
+  @journaled
+  @writing
+  def link(self, inode):
+    # add a pointer to inode at the end of this directory's contents
+    pos = self.num_entries()
+    self.seek_to_end()
+    self.write_int(inode.block_ind)
+    self.fs.remember_dentry(self.inode.block_ind, inode.name, inode.block_ind)
+    if self.inode.index != 0:
+      self.index_insert(inode.name, inode.block_ind, pos)
+    elif self.fs.has_dir_index and self.num_entries() > self.fs.pointers_per_block:
+      self.build_index()
+  
+  @journaled
+  @writing
+  def unlink(self, inode):
+    # remove the pointer to inode from this directory's contents (by moving the last pointer
+    # into its place). Doesn't free anything.
+    last_ind = self.num_entries() - 1
+    self.seek_abs(last_ind * 4)
+    last_ptr = self.read_int()
+    slot = None
+    if self.inode.index != 0:
+      slot, ptr, ptr_ind = self.index_find(inode.name)
+    elif last_ptr == inode.block_ind:
+      ptr_ind = last_ind
     else:
-      self.seek_from_end(4)
-      last_ptr = self.read_int()
+      ptr_ind = self.get_pointers().index(inode.block_ind)
+    if ptr_ind != last_ind:
       self.seek_abs(ptr_ind * 4)
       self.write_int(last_ptr)
-      self.shrink(4)
-    # free the entry's blocks
-    for block_pointer in inode.blocks:
-      if block_pointer == 0:
-        break
-      self.fs.free_block(block_pointer)
-    self.fs.free_block(inode.block_ind)
-    del self.entries[name]
+      if slot is not None:
+        self.index_move(last_ptr, ptr_ind)
+    self.shrink(4)
+    if slot is not None:
+      self.index_delete(slot, hash_name(inode.name))
+    self.fs.remember_dentry(self.inode.block_ind, inode.name, None)
+  
+  @journaled
+  @writing
+  def remove(self, name):
+    handle = self.lookup(name)
+    if handle is None:
+      raise DoesNotExist(name)
+    # parent before child, like everywhere else that takes two inode locks
+    lock = handle.inode.lock
+    lock.acquire_write()
+    try:
+      if handle.is_dir() and not handle.is_empty():
+        raise DirNotEmpty()
+      handle.drop_index()
+      inode = handle.inode
+      self.unlink(inode)
+      # free the entry's blocks
+      self.fs.free_blocks_from(inode, 0)
+      self.fs.free_block(inode.block_ind)
+    finally:
+      lock.release_write()
   
+  @journaled
+  @writing
   def rename(self, name, newname):
-    if self.exists(name):
-      if not self.exists(newname):
-        h = self.get_entries()[name]
-        inode = h.inode
-        inode.name = newname
-        self.fs.write_inode(inode)
-      else:
-        raise AlreadyExists()      
-    else:
+    h = self.lookup(name)
+    if h is None:
       raise DoesNotExist()
+    if self.exists(newname):
+      raise AlreadyExists()
+    if not is_valid_name(newname):
+      raise InvalidName(newname)
+    inode = h.inode
+    h.make_room_for_name(newname)
+    if self.inode.index != 0:
+      slot, ptr, ptr_ind = self.index_find(name)
+      self.index_delete(slot, hash_name(name))
+      self.index_insert(newname, ptr, ptr_ind)
+    inode.name = newname
+    self.fs.write_inode(inode)
+    h.name = newname
+    self.fs.remember_dentry(self.inode.block_ind, name, None)
+    self.fs.remember_dentry(self.inode.block_ind, newname, inode.block_ind)
   
+  # Name-hash index (FEATURE_DIR_INDEX). It lives in the data of an inode of its own, which
+  # isn't linked into any directory:
+  # | capacity (4 bytes) | used slots (4) | slots (capacity * 12 bytes) |
+  # slot: | name hash (4) | entry's inode block (4; 0 = empty, -1 = deleted) |
+  #       | entry's position in the directory's pointer list (4) |
+  # Open addressing with linear probing; capacity is a power of two, and the table is
+  # rebuilt (dropping deleted slots) before more than half of it is in use.
+  
+  def index_handle(self):
+    try:
+      if self.index_file.inode.block_ind == self.inode.index:
+        return self.index_file
+    except AttributeError:
+      pass
+    self.index_file = FileHandle(self.fs, self.fs.read_inode(self.inode.index))
+    self.index_file.metadata = True
+    return self.index_file
+  
+  def index_header(self, index):
+    index.seek_to_beg()
+    return INDEX_HEADER_STRUCT.unpack(index.read(INDEX_HEADER_STRUCT.size))
+  
+  def index_probe(self, index, name_hash, capacity):
+    # yields (slot, hash, inode block, position) along name_hash's probe sequence,
+    # up to and including the first empty slot
+    slot = name_hash & (capacity - 1)
+    for i in xrange(capacity):
+      index.seek_abs(INDEX_HEADER_STRUCT.size + slot * INDEX_SLOT_STRUCT.size)
+      slot_hash, ptr, ptr_ind = INDEX_SLOT_STRUCT.unpack(index.read(INDEX_SLOT_STRUCT.size))
+      yield slot, slot_hash, ptr, ptr_ind
+      if ptr == 0:
+        return
+      slot = (slot + 1) & (capacity - 1)
+  
+  def write_index_slot(self, index, slot, name_hash, ptr, ptr_ind):
+    index.seek_abs(INDEX_HEADER_STRUCT.size + slot * INDEX_SLOT_STRUCT.size)
+    index.write(INDEX_SLOT_STRUCT.pack(name_hash, ptr, ptr_ind))
+  
+  def index_find(self, name):
+    # (slot, inode block, position in pointer list) of the entry called name, or None
+    index = self.index_handle()
+    capacity, used = self.index_header(index)
+    name_hash = hash_name(name)
+    for slot, slot_hash, ptr, ptr_ind in self.index_probe(index, name_hash, capacity):
+      if ptr > 0 and slot_hash == name_hash and self.fs.read_inode(ptr).name == name:
+        return slot, ptr, ptr_ind
+    return None
+  
+  def index_insert(self, name, ptr, ptr_ind):
+    index = self.index_handle()
+    capacity, used = self.index_header(index)
+    if (used + 1) * 2 > capacity:
+      capacity, used = self.rebuild_index(index, capacity)
+    name_hash = hash_name(name)
+    for slot, slot_hash, slot_ptr, slot_ptr_ind in self.index_probe(index, name_hash, capacity):
+      if slot_ptr <= 0:
+        break
+    self.write_index_slot(index, slot, name_hash, ptr, ptr_ind)
+    if slot_ptr == 0: # (reusing a deleted slot doesn't use up another one)
+      index.seek_to_beg()
+      index.write(INDEX_HEADER_STRUCT.pack(capacity, used + 1))
+  
+  def index_delete(self, slot, name_hash):
+    self.write_index_slot(self.index_handle(), slot, name_hash, -1, 0)
+  
+  def index_move(self, ptr, ptr_ind):
+    # the entry whose inode is at ptr has moved to position ptr_ind in the pointer list
+    name = self.fs.read_inode(ptr).name
+    slot = self.index_find(name)[0]
+    self.write_index_slot(self.index_handle(), slot, hash_name(name), ptr, ptr_ind)
+  
+  def rebuild_index(self, index, capacity):
+    index.seek_abs(INDEX_HEADER_STRUCT.size)
+    table = index.read(capacity * INDEX_SLOT_STRUCT.size)
+    live = []
+    for slot in xrange(capacity):
+      name_hash, ptr, ptr_ind = INDEX_SLOT_STRUCT.unpack_from(table, slot * INDEX_SLOT_STRUCT.size)
+      if ptr > 0:
+        live.append((name_hash, ptr, ptr_ind))
+    return self.write_index(index, live)
+  
+  def write_index(self, index, live):
+    # write out a fresh table holding the (hash, inode block, position)s in live
+    capacity = INDEX_MIN_CAPACITY
+    while capacity < 4 * (len(live) + 1):
+      capacity *= 2
+    mask = capacity - 1
+    table = bytearray(INDEX_HEADER_STRUCT.size + capacity * INDEX_SLOT_STRUCT.size)
+    INDEX_HEADER_STRUCT.pack_into(table, 0, capacity, len(live))
+    for name_hash, ptr, ptr_ind in live:
+      slot = name_hash & mask
+      while INDEX_SLOT_STRUCT.unpack_from(table, INDEX_HEADER_STRUCT.size + slot * INDEX_SLOT_STRUCT.size)[1] != 0:
+        slot = (slot + 1) & mask
+      INDEX_SLOT_STRUCT.pack_into(table, INDEX_HEADER_STRUCT.size + slot * INDEX_SLOT_STRUCT.size,
+                                  name_hash, ptr, ptr_ind)
+    if index.length() > len(table):
+      index.shrink(index.length() - len(table))
+    index.seek_to_beg()
+    index.write(str(table))
+    return capacity, len(live)
+  
+  def build_index(self):
+    index_ind = self.fs.alloc_block()
+    self.fs.write_inode(self.fs.new_inode(index_ind, '', False))
+    self.inode.index = index_ind
+    self.fs.write_inode(self.inode)
+    live = []
+    for ptr_ind, ptr in enumerate(self.get_pointers()):
+      live.append((hash_name(self.fs.read_inode(ptr).name), ptr, ptr_ind))
+    self.write_index(self.index_handle(), live)
+  
+
+# what DirHandle.iter_entries yields: enough to list a directory without opening anything
+DirEntry = namedtuple('DirEntry', 'name block_ind is_dir length')
+
+def handle_for(fs, inode):
+  if inode.is_dir:
+    return DirHandle(fs, inode)
+  elif inode.compressed:
+    return CompressedFileHandle(fs, inode)
+  else:
+    return FileHandle(fs, inode)
+
+# Codecs for compressed files, by the id the chunk tables store (so an id must never change
+# meaning). More can be added with register_codec; 0 means stored as is.
+Codec = namedtuple('Codec', 'name compress decompress')
+CODECS = {} # id => Codec
+CODEC_IDS = {} # name => id
+DEFAULT_CODEC = 'zlib'
+
+def register_codec(codec_id, name, compress, decompress):
+  CODECS[codec_id] = Codec(name, compress, decompress)
+  CODEC_IDS[name] = codec_id
+
+register_codec(1, 'zlib', lambda data: zlib.compress(data, 6), zlib.decompress)
+
+def codec_id(codec):
+  # codec name (or True for DEFAULT_CODEC, or a false value for none) => its id
+  if not codec:
+    return 0
+  if codec is True:
+    codec = DEFAULT_CODEC
+  try:
+    return CODEC_IDS[codec]
+  except KeyError:
+    raise ValueError('unknown codec %r (have: %s)' % (codec, ', '.join(sorted(CODEC_IDS))))
 
 def is_valid_name(name):
   return VALID_NAME_RE.match(name) is not None
 
+def feature_names(features):
+  return [name for flag, name in FEATURE_NAMES if features & flag]
+
+def inline_data(raw, name, length):
+  # inline contents from an inode's raw name field, which holds the name and then them
+  return raw[len(name) + 1:len(name) + 1 + length]
+
+def strip_name(raw):
+  # names are NUL-terminated (unless they fill the whole field)
+  end = raw.find('\x00')
+  if end != -1:
+    return raw[:end]
+  return raw
+
+def hash_name(name):
+  return zlib.crc32(name) & 0xffffffff
+
 class FSException(Exception):
   pass
 
@@ -509,6 +2535,133 @@ class FileFull(FSException):
 class FSFull(FSException):
   pass
 
+class UnsupportedVersion(FSException):
+  pass
+
+class InvalidMove(FSException):
+  pass
+
+class RWLock:
+  """Many readers or one writer. The writer can take it again (for reading or writing)
+     while it holds it; a reader can't upgrade. Readers are preferred over waiting writers:
+     a new reader gets in while others hold it, so a writer can be starved by readers that
+     keep one inode busy without a break. (That's what lets a thread already reading take
+     it again without deadlocking against a waiting writer.)
+  """
+  
+  def __init__(self):
+    self.mutex = threading.Lock() # guards readers
+    self.readers = 0
+    self.exclusive = threading.Lock() # held by the writer, or on behalf of all the readers
+    self.owner = None # thread id of the writer
+    self.depth = 0
+  
+  def acquire_read(self):
+    if self.owner == get_ident():
+      self.depth += 1
+      return
+    with self.mutex:
+      self.readers += 1
+      if self.readers == 1:
+        self.exclusive.acquire()
+  
+  def release_read(self):
+    if self.owner == get_ident():
+      self.depth -= 1
+      return
+    with self.mutex:
+      self.readers -= 1
+      if self.readers == 0:
+        self.exclusive.release()
+  
+  def acquire_write(self):
+    me = get_ident()
+    if self.owner == me:
+      self.depth += 1
+      return
+    self.exclusive.acquire()
+    self.owner = me
+    self.depth = 1
+  
+  def release_write(self):
+    self.depth -= 1
+    if self.depth == 0:
+      self.owner = None
+      self.exclusive.release()
+  
+
+class Gate:
+  """Counts the threads inside (operations that write, for FS10.batch); closed() waits for
+     them all to leave and keeps new ones out while it's held. Threads can go in again while
+     they're inside, and the one holding it closed can go in.
+  """
+  
+  def __init__(self):
+    self.cond = threading.Condition(threading.Lock())
+    self.inside = 0
+    self.closer = None # thread id of the thread holding it closed
+    self.local = threading.local() # .depth: how deeply this thread is inside
+  
+  def enter(self):
+    depth = getattr(self.local, 'depth', 0)
+    if depth == 0:
+      me = get_ident()
+      with self.cond:
+        while self.closer is not None and self.closer != me:
+          self.cond.wait()
+        self.inside += 1
+    self.local.depth = depth + 1
+  
+  def leave(self):
+    self.local.depth -= 1
+    if self.local.depth == 0:
+      with self.cond:
+        self.inside -= 1
+        self.cond.notify_all()
+  
+  @contextmanager
+  def closed(self):
+    me = get_ident()
+    mine = 1 if getattr(self.local, 'depth', 0) else 0 # (the caller may be inside itself)
+    with self.cond:
+      while self.closer is not None:
+        self.cond.wait()
+      self.closer = me
+      while self.inside > mine:
+        self.cond.wait()
+    try:
+      yield
+    finally:
+      with self.cond:
+        self.closer = None
+        self.cond.notify_all()
+  
+
+class Transaction:
+  # what FS10.transaction gives back: the thread is in the FS's writers Gate for the length
+  # of it, and (with a journal) in a journal transaction
+  
+  def __init__(self, fs):
+    self.fs = fs
+  
+  def __enter__(self):
+    self.fs.writers.enter()
+    if self.fs.journal is not None:
+      try:
+        self.fs.journal.begin()
+      except:
+        self.fs.writers.leave()
+        raise
+    return self
+  
+  def __exit__(self, exc_type, exc_value, tb):
+    try:
+      if self.fs.journal is not None:
+        self.fs.journal.end()
+    finally:
+      self.fs.writers.leave()
+  
+
 def bools_to_char(bools):
   assert len(bools) == 8, 'must pass in 8 booleans'
   x = 0
@@ -525,6 +2678,12 @@ def char_to_bools(char):
     x /= 2
   return bools
 
+# index of the lowest clear bit in each byte value (8 for a full byte)
+FIRST_FREE_BIT = [([b for b in xrange(8) if not x & (1 << b)] or [8])[0] for x in xrange(256)]
+
+# number of set bits in each byte value
+POPCOUNT = [bin(x).count('1') for x in xrange(256)]
+
 # from http://blogmag.net/blog/read/38/Print_human_readable_file_size
 def humansize(num):
   for x in ['bytes','KB','MB','GB','TB']:
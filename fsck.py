@@ -0,0 +1,323 @@
+import fs, argparse, struct, sys
+from array import array
+from binascii import hexlify, unhexlify
+from multiprocessing import Pool, cpu_count
+
+# Consistency check of an image: walks the tree from the root inode, works out which blocks
+# are really in use (inodes, data blocks, pointer blocks, directory indexes, the journal), and
+# compares that with the allocation bitmap. Reports
+#  - leaked blocks: marked in use, but nothing refers to them
+#  - unallocated blocks: in use, but marked free (so they'd be handed out again)
+#  - cross-links: blocks (or inodes) that two things refer to
+#  - problems with individual inodes: bad lengths, missing blocks, blocks past the end,
+#    pointers out of range, bad or duplicate names
+# and with repair=True, rewrites the bitmap to match what's in use.
+#
+# The tree is walked a level at a time. Decoding a level's inodes (and their pointer blocks
+# and directory contents) is the expensive part, so big levels are split up among a pool of
+# processes, each reading the image on its own; the main process just merges the results.
+
+# levels with fewer inodes than this are decoded in this process
+PARALLEL_MIN_INODES = 256
+RESERVED = -1 # owner of the header, bitmap and journal blocks
+
+class FsckReport:
+  
+  def __init__(self):
+    self.dirs = 0
+    self.files = 0
+    self.used_blocks = 0
+    self.leaked = [] # block inds
+    self.unallocated = [] # block inds
+    self.cross_links = [] # (block ind, first owner's inode block, second owner's inode block)
+    self.problems = [] # (inode block, path, message)
+    self.paths = {} # inode block => path, of everything reached
+    self.repaired = False
+  
+  def __repr__(self):
+    return '<FsckReport %s>' % ('clean' if self.clean() else '%d errors' % self.num_errors())
+  
+  def num_errors(self):
+    return len(self.leaked) + len(self.unallocated) + len(self.cross_links) + len(self.problems)
+  
+  def clean(self):
+    return self.num_errors() == 0
+  
+  def lines(self):
+    # human-readable report
+    def owner(ind):
+      return 'reserved blocks' if ind == RESERVED else self.paths.get(ind, 'inode %d' % ind)
+    ans = ['%s (inode %d): %s' % (path, ind, msg) for ind, path, msg in self.problems]
+    for block_ind, first, second in self.cross_links:
+      ans.append('block %d: used by both %s and %s' % (block_ind, owner(first), owner(second)))
+    if self.unallocated:
+      ans.append('%d blocks in use but marked free: %s' % (len(self.unallocated), block_list(self.unallocated)))
+    if self.leaked:
+      ans.append('%d blocks marked in use but unused: %s' % (len(self.leaked), block_list(self.leaked)))
+    ans.append('%d dirs, %d files, %d blocks in use; %s%s' %
+               (self.dirs, self.files, self.used_blocks,
+                'clean' if self.clean() else '%d errors' % self.num_errors(),
+                ' (bitmap rebuilt)' if self.repaired else ''))
+    return ans
+  
+
+def block_list(blocks, limit=20):
+  shown = ' '.join(str(b) for b in blocks[:limit])
+  return shown + (' ...' if len(blocks) > limit else '')
+
+def fsck(f, repair=False, workers=None):
+  """checks the FS10 f (see above); returns an FsckReport. workers: processes decoding
+     inodes (default: one per CPU; 1 = do it all in this process)."""
+  f.sync() # the workers read the image itself
+  if workers is None:
+    workers = cpu_count()
+  end = usable_blocks(f)
+  report = FsckReport()
+  owner = array('i', [0]) * end # block ind => inode block of whatever uses it (0 = nothing)
+  def claim(block_ind, ind):
+    if owner[block_ind] == 0:
+      owner[block_ind] = ind
+      return True
+    report.cross_links.append((block_ind, owner[block_ind], ind))
+    return False
+  for block_ind in (0, 1):
+    claim(block_ind, RESERVED)
+  if f.journal is not None:
+    for block_ind in xrange(f.journal.start, f.journal.start + f.journal.num_blocks):
+      claim(block_ind, RESERVED)
+  claim(fs.ROOT_INODE_BLOCK, fs.ROOT_INODE_BLOCK)
+  paths = report.paths
+  parents = {fs.ROOT_INODE_BLOCK: None} # inode block => its directory's (or index's owner's)
+  indexes = set()
+  names = {} # dir inode block => names of its entries
+  level = [fs.ROOT_INODE_BLOCK]
+  pool = None
+  try:
+    while level:
+      if workers > 1 and len(level) >= PARALLEL_MIN_INODES:
+        if pool is None:
+          pool = Pool(workers, init_worker, (f.handle.name, f.block_size, f.num_blocks,
+                                             f.version, f.features))
+        step = max(PARALLEL_MIN_INODES / 4, len(level) / (workers * 4))
+        chunks = [level[i:i + step] for i in xrange(0, len(level), step)]
+        records = [r for chunk in pool.imap(scan_chunk, chunks) for r in chunk]
+      else:
+        records = [scan_inode(f, ind) for ind in level]
+      level = []
+      for ind, is_dir, length, name, data, meta, index, children, problems in records:
+        parent = parents[ind]
+        if parent is None:
+          path = '/'
+          if not is_dir:
+            problems.append('root inode is not a directory')
+        elif ind in indexes:
+          path = paths[parent] + ' (index)'
+          if is_dir:
+            problems.append('directory index is marked as a directory')
+        else:
+          path = paths[parent].rstrip('/') + '/' + name
+          if not fs.is_valid_name(name):
+            problems.append('bad name %r' % name)
+          elif name in names[parent]:
+            problems.append('another entry in the directory has the same name')
+          names[parent].add(name)
+        paths[ind] = path
+        for msg in problems:
+          report.problems.append((ind, path, msg))
+        if is_dir:
+          report.dirs += 1
+          names[ind] = set()
+        elif ind not in indexes:
+          report.files += 1
+        for block_ind in data + meta:
+          claim(block_ind, ind)
+        if index:
+          if not valid_block(index, end):
+            report.problems.append((ind, path, 'index inode %d out of range' % index))
+          elif claim(index, ind):
+            parents[index] = ind
+            indexes.add(index)
+            level.append(index)
+        for child in children:
+          if not valid_block(child, end):
+            report.problems.append((ind, path, 'entry points at block %d, out of range' % child))
+          elif claim(child, child):
+            parents[child] = ind
+            level.append(child)
+  finally:
+    if pool is not None:
+      pool.close()
+      pool.join()
+  compare_bitmap(f, owner, report)
+  if repair and (report.leaked or report.unallocated):
+    rebuild_bitmap(f, owner)
+    report.repaired = True
+  return report
+
+def compare_bitmap(f, owner, report):
+  in_use = used_bitmap(f, owner)
+  report.used_blocks = sum(fs.POPCOUNT[b] for b in in_use)
+  marked = f.written_bitmap()
+  if in_use == marked:
+    return
+  # a bit at a time would be slow on a big bitmap: compare them as two big integers, and
+  # only look at the bytes where they differ
+  a, b = bitmap_int(marked), bitmap_int(in_use)
+  report.leaked = set_bits(a & ~b, len(marked), len(owner))
+  report.unallocated = set_bits(b & ~a, len(marked), len(owner))
+
+def used_bitmap(f, owner):
+  # the bitmap as it should be
+  in_use = bytearray(len(f.bitmap))
+  for block_ind, ind in enumerate(owner):
+    if ind != 0:
+      in_use[block_ind >> 3] |= 1 << (block_ind & 7)
+  return in_use
+
+def bitmap_int(bitmap):
+  # byte 0 as the least significant
+  return int(hexlify(str(bitmap[::-1])) or '0', 16)
+
+def set_bits(x, num_bytes, end):
+  if x == 0:
+    return []
+  raw = bytearray(unhexlify('%0*x' % (num_bytes * 2, x)))[::-1]
+  return [byte_ind * 8 + bit for byte_ind, byte in enumerate(raw) if byte
+          for bit in xrange(8) if byte & (1 << bit) and byte_ind * 8 + bit < end]
+
+def rebuild_bitmap(f, owner):
+  in_use = used_bitmap(f, owner)
+  # (the transaction's end may commit, which takes bitmap_lock)
+  with f.transaction():
+    with f.bitmap_lock:
+      f.write_at(f.block_size, str(in_use))
+      f.load_bitmap()
+  f.sync()
+
+def usable_blocks(f):
+  # blocks the bitmap can cover
+  return min(f.num_blocks, len(f.bitmap) * 8)
+
+def valid_block(block_ind, end):
+  return fs.ROOT_INODE_BLOCK < block_ind < end
+
+def scan_inode(f, ind):
+  """decodes the inode at block ind straight from the image (bypassing the inode and pointer
+     caches): (ind, is_dir, length, name, data blocks, pointer blocks, index inode block,
+     entries if it's a directory, problems)"""
+  end = usable_blocks(f)
+  bs = f.block_size
+  fields = f.inode_struct.unpack_from(f.read_block(ind))
+  flags, length = fields[0], fields[1]
+  is_dir = bool(flags & fs.INODE_DIR)
+  name = fs.strip_name(fields[-1])
+  extra = fields[2 + fs.NUM_POINTERS:-1]
+  stored = None
+  if f.has_compression:
+    stored = extra[-1]
+    extra = extra[:-1]
+  indirect = double_indirect = index = 0
+  if f.has_indirect:
+    indirect, double_indirect = extra[:2]
+  if f.has_dir_index:
+    index = extra[-1]
+  problems = []
+  if not 0 <= length <= f.MAX_FILE_LENGTH:
+    problems.append('bad length %d' % length)
+    length = 0
+  elif is_dir and length % 4 != 0:
+    problems.append('directory length %d is not a whole number of entries' % length)
+  inline = None
+  if flags & fs.INODE_INLINE:
+    inline = fs.inline_data(fields[-1], name, length)
+    if len(inline) != length:
+      problems.append('inline contents (length %d) don\'t fit in the inode' % length)
+      length = len(inline) - len(inline) % 4 if is_dir else len(inline)
+    need = 0
+  elif flags & fs.INODE_COMPRESSED:
+    # (the blocks hold the stored stream, whose chunk table is the index)
+    if not index:
+      problems.append('compressed, but has no chunk table')
+    need = max(1, (stored + bs - 1) / bs)
+  else:
+    need = max(1, (length + bs - 1) / bs) # (every inode has its first block)
+  # (logical block, pointer) for every non-zero pointer the inode has
+  pointers = [(n, ptr) for n, ptr in enumerate(fields[2:2 + fs.NUM_POINTERS]) if ptr != 0]
+  meta = []
+  def pointer_block(block_ind, what):
+    if not valid_block(block_ind, end):
+      problems.append('%s block %d out of range' % (what, block_ind))
+      return []
+    meta.append(block_ind)
+    return f.pointer_block_struct.unpack_from(f.read_block(block_ind))
+  per_block = f.pointers_per_block
+  if indirect:
+    for i, ptr in enumerate(pointer_block(indirect, 'indirect')):
+      if ptr != 0:
+        pointers.append((fs.NUM_POINTERS + i, ptr))
+  if double_indirect:
+    base = fs.NUM_POINTERS + per_block
+    for i, outer in enumerate(pointer_block(double_indirect, 'double indirect')):
+      if outer != 0:
+        for j, ptr in enumerate(pointer_block(outer, 'indirect')):
+          if ptr != 0:
+            pointers.append((base + i * per_block + j, ptr))
+  data = []
+  by_n = {}
+  for n, ptr in pointers:
+    if not valid_block(ptr, end):
+      problems.append('block %d of the contents is %d, out of range' % (n, ptr))
+      continue
+    data.append(ptr)
+    by_n[n] = ptr
+  past = sorted(n for n in by_n if n >= need)
+  if past:
+    problems.append('blocks %s of the contents are past the end (length %d)' % (block_list(past), length))
+  missing = [n for n in xrange(need) if n not in by_n]
+  if missing:
+    problems.append('missing blocks %s of the contents' % block_list(missing))
+  children = []
+  if is_dir and not missing:
+    if inline is not None:
+      raw = inline
+    else:
+      raw = ''.join(f.read_block(by_n[n]) for n in xrange(need))
+    count = length / 4
+    children = list(struct.unpack_from('=%di' % count, raw))
+  return ind, is_dir, length, name, data, meta, index, children, problems
+
+# in each worker process: an FS10 of its own on the image, for reading
+worker_fs = None
+
+def init_worker(path, block_size, num_blocks, version, features):
+  global worker_fs
+  h = open(path, 'rb', 0)
+  worker_fs = fs.FS10(h, block_size, num_blocks, version=version, features=features)
+
+def scan_chunk(inds):
+  return [scan_inode(worker_fs, ind) for ind in inds]
+
+
+def main(image, repair, workers):
+  f = fs.open_fs(image)
+  try:
+    report = fsck(f, repair, workers)
+  finally:
+    f.close()
+  for line in report.lines():
+    print line
+  # like fsck(8): 0 = clean, 1 = errors fixed, 4 = errors left
+  if report.clean():
+    return 0
+  if report.repaired and not report.problems and not report.cross_links:
+    return 1
+  return 4
+
+if __name__ == '__main__':
+  p = argparse.ArgumentParser(description='check a filesystem image for consistency')
+  p.add_argument('image', help='filesystem image')
+  p.add_argument('--repair', '-r', action='store_true',
+                 help='rewrite the allocation bitmap to match the blocks actually in use')
+  p.add_argument('--workers', '-w', type=int, help='processes decoding inodes (default: one per CPU)')
+  ns = p.parse_args(sys.argv[1:])
+  sys.exit(main(**vars(ns)))
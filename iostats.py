@@ -0,0 +1,208 @@
+import threading
+import time
+from collections import defaultdict
+
+# I/O instrumentation (open_fs(..., instrument=True)). An FS10 with an IOStats counts
+#  - at the device, below any cache or journal (CountingDevice): reads and writes issued,
+#    bytes moved, syncs, and the time spent in them
+#  - in FS10: blocks allocated and freed, inodes decoded (and inode cache hits), inodes
+#    written, linear scans of directories (and the entries they went through), and sequential
+#    reads served from read-ahead or not (see Handle.read)
+# each against the operation the thread is in: the outermost FSWalker or Handle method it's
+# running (so a path lookup's reads count towards 'open', not 'read'), or '-' outside of one.
+# Operations also get a count of calls and the time they took.
+#
+# Counting is a dict increment in a dict of the thread's own, so threads don't contend; a
+# snapshot adds them all up. An optional trace hook sees every block the device touches.
+
+OUTSIDE = '-' # the operation counted against outside of any
+
+class IOStats:
+  
+  def __init__(self, block_size, trace=None):
+    self.block_size = block_size
+    # trace(kind, block ind, operation), kind 'read' or 'write', for every block the device
+    # reads or writes; called in the thread doing the I/O
+    self.trace = trace
+    self.local = threading.local()
+    self.lock = threading.Lock() # guards all_counts
+    self.all_counts = [] # every thread's counts: (operation, counter) => value
+  
+  def __repr__(self):
+    return '<IOStats %s>' % ', '.join('%s=%s' % kv for kv in sorted(self.totals().items()))
+  
+  def counts(self):
+    # this thread's
+    try:
+      return self.local.counts
+    except AttributeError:
+      counts = self.local.counts = defaultdict(int)
+      self.local.op = OUTSIDE
+      with self.lock:
+        self.all_counts.append(counts)
+      return counts
+  
+  def operation(self):
+    try:
+      return self.local.op
+    except AttributeError:
+      return OUTSIDE
+  
+  def count(self, counter, n=1):
+    counts = self.counts()
+    counts[self.local.op, counter] += n
+  
+  def begin(self, op):
+    # starts operation op, unless the thread is in one already; returns whether it did
+    self.counts() # (sets up this thread's)
+    if self.local.op is not OUTSIDE:
+      return False
+    self.local.op = op
+    self.local.start = time.time()
+    return True
+  
+  def end(self):
+    counts = self.local.counts
+    op = self.local.op
+    counts[op, 'calls'] += 1
+    counts[op, 'seconds'] += time.time() - self.local.start
+    self.local.op = OUTSIDE
+  
+  def snapshot(self):
+    # everything counted so far: {operation: {counter: value}}
+    with self.lock:
+      all_counts = list(self.all_counts)
+    ans = {}
+    for counts in all_counts:
+      for (op, counter), value in counts.items():
+        by_op = ans.setdefault(op, {})
+        by_op[counter] = by_op.get(counter, 0) + value
+    return ans
+  
+  def totals(self, snapshot=None):
+    # {counter: value} over all operations
+    ans = {}
+    for by_op in (snapshot if snapshot is not None else self.snapshot()).values():
+      for counter, value in by_op.items():
+        if counter != 'calls':
+          ans[counter] = ans.get(counter, 0) + value
+    return ans
+  
+  def reset(self):
+    with self.lock:
+      for counts in self.all_counts:
+        counts.clear()
+  
+
+def delta(before, after):
+  # what was counted between two snapshots
+  ans = {}
+  for op, by_op in after.items():
+    old = before.get(op, {})
+    changed = dict((counter, value - old.get(counter, 0)) for counter, value in by_op.items()
+                   if value != old.get(counter, 0))
+    if changed:
+      ans[op] = changed
+  return ans
+
+# the columns of format_table, in order
+COLUMNS = [('calls', 'calls'), ('seconds', 'ms'), ('dev_reads', 'reads'), ('bytes_read', 'read'),
+           ('dev_writes', 'writes'), ('bytes_written', 'written'), ('dev_syncs', 'syncs'),
+           ('io_seconds', 'io ms'), ('blocks_allocated', 'alloc'), ('blocks_freed', 'freed'),
+           ('inode_reads', 'inodes'), ('inode_cache_hits', 'cached'), ('inode_writes', 'inode w'),
+           ('dir_scans', 'scans'), ('dir_entries_scanned', 'scanned'),
+           ('readahead_hits', 'ra hits'), ('readahead_misses', 'ra miss')]
+
+def format_table(snapshot):
+  # one row per operation, slowest first, then a row of totals
+  def cell(counter, value):
+    if counter in ('seconds', 'io_seconds'):
+      return '%.1f' % (value * 1000)
+    if counter in ('bytes_read', 'bytes_written'):
+      return human_bytes(value)
+    return str(value)
+  ops = sorted(snapshot, key=lambda op: -snapshot[op].get('seconds', 0))
+  totals = {}
+  for by_op in snapshot.values():
+    for counter, value in by_op.items():
+      totals[counter] = totals.get(counter, 0) + value
+  rows = [['op'] + [title for counter, title in COLUMNS]]
+  for op, by_op in [(op, snapshot[op]) for op in ops] + [('total', totals)]:
+    rows.append([op] + [cell(counter, by_op.get(counter, 0)) for counter, title in COLUMNS])
+  widths = [max(len(row[i]) for row in rows) for i in xrange(len(rows[0]))]
+  return '\n'.join('  '.join(c.ljust(w) if i == 0 else c.rjust(w) for i, (c, w) in
+                             enumerate(zip(row, widths))) for row in rows)
+
+def human_bytes(n):
+  for unit in ('B', 'K', 'M', 'G'):
+    if n < 1024 or unit == 'G':
+      return ('%d%s' if unit == 'B' else '%.1f%s') % (n, unit)
+    n /= 1024.0
+
+
+class CountingDevice:
+  """Counts the I/O that goes through it into an IOStats (and calls its trace hook); goes
+     right on top of the FileDevice/MmapDevice."""
+  
+  def __init__(self, dev, stats):
+    self.dev = dev
+    self.name = dev.name
+    self.stats = stats
+  
+  def __repr__(self):
+    return '<CountingDevice over %r>' % self.dev
+  
+  def traced(self, kind, offset, amt):
+    trace = self.stats.trace
+    if trace is not None and amt > 0:
+      bs = self.stats.block_size
+      op = self.stats.operation()
+      for block_ind in xrange(offset / bs, (offset + amt - 1) / bs + 1):
+        trace(kind, block_ind, op)
+  
+  def read_at(self, offset, amt):
+    start = time.time()
+    data = self.dev.read_at(offset, amt)
+    self.counted('dev_reads', 'bytes_read', len(data), start)
+    self.traced('read', offset, amt)
+    return data
+  
+  def view(self, offset, amt):
+    start = time.time()
+    data = self.dev.view(offset, amt)
+    self.counted('dev_reads', 'bytes_read', amt, start)
+    self.traced('read', offset, amt)
+    return data
+  
+  def write_at(self, offset, data):
+    start = time.time()
+    self.dev.write_at(offset, data)
+    self.counted('dev_writes', 'bytes_written', len(data), start)
+    self.traced('write', offset, len(data))
+  
+  def pack_into(self, st, offset, *values):
+    start = time.time()
+    self.dev.pack_into(st, offset, *values)
+    self.counted('dev_writes', 'bytes_written', st.size, start)
+    self.traced('write', offset, st.size)
+  
+  def counted(self, calls, nbytes, amt, start):
+    counts = self.stats.counts()
+    op = self.stats.local.op
+    counts[op, calls] += 1
+    counts[op, nbytes] += amt
+    counts[op, 'io_seconds'] += time.time() - start
+  
+  def flush(self):
+    self.dev.flush()
+  
+  def sync(self):
+    start = time.time()
+    self.dev.sync()
+    counts = self.stats.counts()
+    counts[self.stats.local.op, 'dev_syncs'] += 1
+    counts[self.stats.local.op, 'io_seconds'] += time.time() - start
+  
+  def close(self):
+    self.dev.close()
+  
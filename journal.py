@@ -0,0 +1,414 @@
+import struct
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from blockdev import Overlay, write_runs
+
+# Write-ahead journal (FEATURE_JOURNAL), as a device that sits on top of the real one.
+#
+# Metadata changes (inodes, directory contents, pointer blocks, the bitmap) are made inside
+# transactions; FS10 opens one around each operation that does several of them. Their
+# writes don't go to the image: they change block images held in memory (the overlay), which
+# reads see through. File contents are written in place as usual (like ext3's ordered mode),
+# unless the block is one the journal has an image of. That's only safe as long as no block
+# the committed state still uses gets them: FS10 doesn't reuse a block freed in a
+# transaction until the journal has committed it (see FS10.free_block).
+#
+# Transactions are committed in groups: once enough of them have finished (or enough blocks
+# are dirty, or enough time has passed since the first finished, even if nothing else
+# happens, or on flush/close), new ones wait for the open ones to finish, and then the whole
+# group is written to the journal region as one record with one sequential write, followed
+# by one fsync. Only then are the blocks written in place (the checkpoint). A crash before
+# the fsync loses the group as a whole; a crash after it is repaired by replaying the
+# record, which open_fs does. The checkpoint is made durable before the next record
+# overwrites this one.
+#
+# A group too big for the journal region (a transaction bigger than it, or ones running
+# alongside the one that filled it) has its block images staged in free blocks FS10 lends
+# it instead, and the record just says where they are. That costs two more fsyncs: the
+# checkpoint has to be durable, and the record void, before the blocks go back.
+#
+# Record layout, from the first block of the journal region:
+# | descriptor: magic 'FSJD' (4) | sequence number (4) | block count n (4) | n block inds |
+#   (as many blocks as that takes) | n block images | commit block: magic 'FSJC' (4) |
+#   sequence number (4) | crc32 of descriptor + images (4) |
+# or, with the images staged: | descriptor: magic 'FSJS' (4) | sequence number (4) | n (4) |
+#   n block inds | n blocks holding their images | (as many blocks as that takes) |
+#   commit block (crc32 of descriptor + images) |
+
+DESCRIPTOR_STRUCT = struct.Struct('=4sII')
+COMMIT_STRUCT = struct.Struct('=4sII')
+DESCRIPTOR_MAGIC = 'FSJD'
+STAGED_MAGIC = 'FSJS'
+COMMIT_MAGIC = 'FSJC'
+# commit a group once this many transactions have finished, this many blocks are dirty
+# (capped at half the journal), or the oldest finished transaction is this many seconds old
+GROUP_TRANSACTIONS = 64
+GROUP_BLOCKS = 256
+COMMIT_INTERVAL = 5.0
+
+class JournalDevice:
+  
+  def __init__(self, dev, block_size, start, num_blocks, group_transactions=GROUP_TRANSACTIONS,
+               group_blocks=GROUP_BLOCKS, commit_interval=COMMIT_INTERVAL):
+    self.dev = dev
+    self.name = dev.name
+    self.block_size = block_size
+    self.start = start
+    self.num_blocks = num_blocks
+    # most block images one record can hold
+    self.capacity = 0
+    while self.descriptor_blocks(self.capacity + 1) + self.capacity + 1 + 1 <= num_blocks:
+      self.capacity += 1
+    self.group_transactions = group_transactions
+    self.group_blocks = max(1, min(group_blocks, self.capacity / 2))
+    self.commit_interval = commit_interval
+    # most block images a staged record can point at
+    self.staged_capacity = 0
+    while self.descriptor_blocks(2 * (self.staged_capacity + 1)) + 1 <= num_blocks:
+      self.staged_capacity += 1
+    self.overlay = Overlay(dev, block_size) # blocks as changed by transactions not yet committed
+    self.recorded = set() # blocks with an image in the record on disk (replayed after a crash)
+    self.lock = threading.Lock() # guards overlay and recorded; held for all of a commit
+    self.cond = threading.Condition() # guards the transaction bookkeeping below
+    self.local = threading.local() # .depth: how deeply this thread is nested in transactions
+    self.active = 0 # transactions in progress
+    self.draining = False # a group is due: no new transactions until it's committed
+    self.finished = 0 # transactions finished since the last commit
+    self.first_finished = None
+    self.checkpoint_synced = True
+    self.timer = None # commits the group commit_interval after its first transaction finished
+    self.closed = False
+    # hooks FS10 sets: committed() after each commit (it releases the blocks freed in it);
+    # borrow_blocks(n) => n free blocks to stage a group in (or None), return_blocks(blocks)
+    self.committed = None
+    self.borrow_blocks = None
+    self.return_blocks = None
+    # the BatchDevice on top during FS10.batch: what it's holding is written out into each
+    # group (it's whole operations' worth then, with none in progress)
+    self.batch = None
+    self.seq = 1
+    self.commits = 0
+    self.transactions = 0
+    self.journaled_blocks = 0
+    self.syncs = 0
+    self.staged = 0
+    self.overflows = 0
+    self.replayed = 0
+  
+  def __repr__(self):
+    return '<JournalDevice over %r, blocks %d-%d>' % (self.dev, self.start, self.start + self.num_blocks - 1)
+  
+  def stats(self):
+    return {'commits': self.commits, 'transactions': self.transactions,
+            'journaled_blocks': self.journaled_blocks, 'syncs': self.syncs,
+            'staged': self.staged, 'overflows': self.overflows, 'replayed': self.replayed,
+            'pending_blocks': len(self.overlay), 'pending_transactions': self.finished,
+            'capacity': self.capacity}
+  
+  def descriptor_blocks(self, n):
+    size = DESCRIPTOR_STRUCT.size + 4 * n
+    return (size + self.block_size - 1) / self.block_size
+  
+  # transactions
+  
+  @contextmanager
+  def transaction(self):
+    self.begin()
+    try:
+      yield
+    finally:
+      self.end()
+  
+  def in_transaction(self):
+    return getattr(self.local, 'depth', 0) > 0
+  
+  def begin(self):
+    depth = getattr(self.local, 'depth', 0)
+    if depth == 0:
+      with self.cond:
+        if self.active > 0 and self.pending_blocks() >= self.group_blocks:
+          # the group's full: it's committed once the transactions in it finish, before this
+          # one adds to it (so groups only outgrow the journal if one transaction does)
+          self.draining = True
+        while self.draining:
+          self.cond.wait()
+        self.active += 1
+    self.local.depth = depth + 1
+  
+  def end(self):
+    self.local.depth -= 1
+    if self.local.depth > 0:
+      return
+    with self.cond:
+      self.active -= 1
+      self.finished += 1
+      self.transactions += 1
+      if self.first_finished is None:
+        self.first_finished = time.time()
+        self.start_timer()
+      if not self.draining and self.commit_due():
+        self.draining = True
+      if self.draining and self.active == 0:
+        self.commit_group()
+  
+  def pending_blocks(self):
+    return len(self.overlay) + (len(self.batch.overlay) if self.batch is not None else 0)
+  
+  def commit_due(self):
+    return (self.finished >= self.group_transactions or self.pending_blocks() >= self.group_blocks or
+            time.time() - self.first_finished >= self.commit_interval)
+  
+  def start_timer(self):
+    # (with cond held)
+    if self.commit_interval is None or self.closed:
+      return
+    self.timer = threading.Timer(self.commit_interval, self.timed_commit)
+    self.timer.daemon = True
+    self.timer.start()
+  
+  def timed_commit(self):
+    with self.cond:
+      if self.first_finished is None or self.closed:
+        return
+    self.commit()
+  
+  def commit(self):
+    # commit whatever has finished, waiting for transactions in progress (in other threads)
+    if self.in_transaction():
+      with self.cond:
+        self.draining = True # commits as soon as this thread's transaction ends
+      return
+    with self.cond:
+      self.draining = True
+      while self.active > 0:
+        self.cond.wait()
+      if self.draining:
+        self.commit_group()
+  
+  def commit_group(self):
+    # with cond held and no transactions in progress
+    try:
+      if self.timer is not None:
+        self.timer.cancel() # (kept, for close to wait for)
+      if self.batch is not None:
+        # into the overlay, as if in a transaction
+        depth = getattr(self.local, 'depth', 0)
+        self.local.depth = depth + 1
+        try:
+          self.batch.write_out()
+        finally:
+          self.local.depth = depth
+      spare = None
+      if len(self.overlay) > self.capacity and self.borrow_blocks is not None:
+        # (before taking lock: FS10 takes its bitmap lock, which it holds while writing)
+        spare = self.borrow_blocks(min(len(self.overlay), self.staged_capacity))
+      try:
+        with self.lock:
+          if self.overlay:
+            self.write_group(sorted(self.overlay.images), spare)
+            self.overlay.clear()
+            self.commits += 1
+      finally:
+        if spare:
+          self.return_blocks(spare)
+      if self.committed is not None:
+        self.committed()
+    finally:
+      self.finished = 0
+      self.first_finished = None
+      self.draining = False
+      self.cond.notify_all()
+  
+  def write_group(self, blocks, spare=None):
+    if not self.checkpoint_synced:
+      # the last record is about to be overwritten; its checkpoint has to be on disk first
+      self.sync_dev()
+    if len(blocks) > self.capacity and spare is not None and len(spare) == len(blocks):
+      self.write_staged(blocks, spare)
+      return
+    if len(blocks) > self.capacity:
+      # doesn't fit, and there's no room to stage it (the image is all but full, or it's
+      # too big for even a staged record): write it in place with no protection, after
+      # making sure the old record can't be replayed over it
+      self.overflows += 1
+      self.dev.write_at(self.start * self.block_size, '\x00' * self.block_size)
+      self.sync_dev()
+      self.recorded = set()
+      write_runs(self.dev, self.block_size, blocks, self.overlay.images)
+      self.sync_dev()
+      return
+    self.dev.write_at(self.start * self.block_size, self.encode(blocks))
+    self.sync_dev()
+    write_runs(self.dev, self.block_size, blocks, self.overlay.images)
+    self.checkpoint_synced = False
+    self.recorded = set(blocks)
+    self.journaled_blocks += len(blocks)
+    self.seq += 1
+  
+  def write_staged(self, blocks, spare):
+    # the images go to the spare blocks, the record just lists them; once the checkpoint is
+    # durable the record is voided (so the spare blocks can be reused)
+    bs = self.block_size
+    images = self.overlay.images
+    write_runs(self.dev, bs, spare, dict((spare[i], images[block_ind])
+                                         for i, block_ind in enumerate(blocks)))
+    self.dev.write_at(self.start * bs, self.encode(blocks, spare))
+    self.sync_dev()
+    write_runs(self.dev, bs, blocks, images)
+    self.sync_dev()
+    self.dev.write_at(self.start * bs, '\x00' * bs)
+    self.sync_dev()
+    self.recorded = set()
+    self.staged += 1
+    self.journaled_blocks += len(blocks)
+    self.seq += 1
+  
+  def encode(self, blocks, spare=None):
+    # the record (with spare: the staged one, which doesn't hold the images)
+    n = len(blocks)
+    if spare is None:
+      desc = DESCRIPTOR_STRUCT.pack(DESCRIPTOR_MAGIC, self.seq, n) + struct.pack('=%dI' % n, *blocks)
+      desc += '\x00' * (self.descriptor_blocks(n) * self.block_size - len(desc))
+    else:
+      desc = DESCRIPTOR_STRUCT.pack(STAGED_MAGIC, self.seq, n) + struct.pack('=%dI' % (2 * n), *(blocks + spare))
+      desc += '\x00' * (self.descriptor_blocks(2 * n) * self.block_size - len(desc))
+    images = ''.join([str(self.overlay.images[block_ind]) for block_ind in blocks])
+    crc = zlib.crc32(images, zlib.crc32(desc)) & 0xffffffff
+    commit = COMMIT_STRUCT.pack(COMMIT_MAGIC, self.seq, crc)
+    commit += '\x00' * (self.block_size - len(commit))
+    if spare is None:
+      return desc + images + commit
+    return desc + commit
+  
+  def sync_dev(self):
+    self.dev.sync()
+    self.syncs += 1
+    self.checkpoint_synced = True
+  
+  def replay(self):
+    # if the journal holds a complete record, (re)write its blocks in place; returns how many
+    bs = self.block_size
+    head = self.dev.read_at(self.start * bs, DESCRIPTOR_STRUCT.size)
+    if len(head) < DESCRIPTOR_STRUCT.size:
+      return 0
+    magic, seq, n = DESCRIPTOR_STRUCT.unpack(head)
+    staged = magic == STAGED_MAGIC
+    if not (magic == DESCRIPTOR_MAGIC and n <= self.capacity or staged and n <= self.staged_capacity):
+      return 0
+    desc_blocks = self.descriptor_blocks(2 * n if staged else n)
+    desc = self.dev.read_at(self.start * bs, desc_blocks * bs)
+    if staged:
+      inds = struct.unpack_from('=%dI' % (2 * n), desc, DESCRIPTOR_STRUCT.size)
+      blocks = inds[:n]
+      images = ''.join(self.dev.read_at(block_ind * bs, bs) for block_ind in inds[n:])
+      commit = self.dev.read_at((self.start + desc_blocks) * bs, COMMIT_STRUCT.size)
+    else:
+      blocks = struct.unpack_from('=%dI' % n, desc, DESCRIPTOR_STRUCT.size)
+      images = self.dev.read_at((self.start + desc_blocks) * bs, n * bs)
+      commit = self.dev.read_at((self.start + desc_blocks + n) * bs, COMMIT_STRUCT.size)
+    if len(images) != n * bs or len(commit) != COMMIT_STRUCT.size:
+      return 0
+    commit_magic, commit_seq, crc = COMMIT_STRUCT.unpack(commit)
+    if (commit_magic != COMMIT_MAGIC or commit_seq != seq or
+        crc != zlib.crc32(images, zlib.crc32(desc)) & 0xffffffff):
+      return 0 # torn write: the record never committed
+    if any(self.start <= block_ind < self.start + self.num_blocks for block_ind in blocks):
+      return 0
+    by_block = dict((block_ind, images[i * bs:(i + 1) * bs]) for i, block_ind in enumerate(blocks))
+    write_runs(self.dev, bs, sorted(by_block), by_block)
+    self.sync_dev()
+    if staged:
+      # (the blocks the images were staged in are free, and will be reused)
+      self.dev.write_at(self.start * bs, '\x00' * bs)
+      self.sync_dev()
+      blocks = ()
+    self.recorded = set(blocks)
+    self.seq = seq + 1
+    self.replayed = n
+    return n
+  
+  # device protocol
+  
+  def read_at(self, offset, amt):
+    if not self.overlay:
+      return self.dev.read_at(offset, amt)
+    while True:
+      commits = self.commits
+      data = self.dev.read_at(offset, amt)
+      with self.lock:
+        if self.commits != commits:
+          continue # a checkpoint happened meanwhile; the overlay we'd patch from is gone
+        return self.overlay.patch(offset, amt, data)
+  
+  def view(self, offset, amt):
+    return self.read_at(offset, amt)
+  
+  def write_at(self, offset, data):
+    if self.in_transaction():
+      with self.lock:
+        self.overlay.write(offset, data)
+    else:
+      self.write_data(offset, data)
+  
+  def write_data(self, offset, data):
+    # writes that don't need journaling (file contents, or anything outside a transaction) go
+    # straight to the image, except to blocks the journal has an image of: the journal's copy
+    # would be written back over them
+    bs = self.block_size
+    first, last = offset / bs, (offset + len(data) - 1) / bs
+    with self.lock:
+      covered = [block_ind for block_ind in xrange(first, last + 1)
+                 if block_ind in self.overlay or block_ind in self.recorded]
+      if not covered:
+        direct = True
+      elif len(covered) == last - first + 1:
+        self.overlay.write(offset, data)
+        return
+      else:
+        for block_ind in covered:
+          lo, hi = max(offset, block_ind * bs), min(offset + len(data), (block_ind + 1) * bs)
+          self.overlay.write(lo, data[lo - offset:hi - offset])
+        direct = False
+    if direct:
+      self.dev.write_at(offset, data)
+      return
+    # the rest, a run of uncovered blocks at a time
+    covered = set(covered)
+    block_ind = first
+    while block_ind <= last:
+      if block_ind in covered:
+        block_ind += 1
+        continue
+      run_end = block_ind
+      while run_end + 1 <= last and run_end + 1 not in covered:
+        run_end += 1
+      lo, hi = max(offset, block_ind * bs), min(offset + len(data), (run_end + 1) * bs)
+      self.dev.write_at(lo, data[lo - offset:hi - offset])
+      block_ind = run_end + 1
+  
+  def pack_into(self, st, offset, *values):
+    self.write_at(offset, st.pack(*values))
+  
+  def flush(self):
+    self.commit()
+    self.dev.flush()
+  
+  def sync(self):
+    self.commit()
+    self.dev.sync()
+    self.syncs += 1
+  
+  def close(self):
+    self.commit()
+    with self.cond:
+      self.closed = True
+      timer, self.timer = self.timer, None
+    if timer is not None:
+      timer.cancel()
+      # (a daemon thread still running at exit dies with a confusing error)
+      if timer is not threading.current_thread():
+        timer.join()
+    self.dev.close()
+  
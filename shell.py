@@ -1,5 +1,7 @@
 from fs import *
-import sys, traceback, shlex
+import os, sys, time, traceback, shlex
+import transfer
+from iostats import delta, format_table
 
 def cmd(func):
   func.isCmd = True
@@ -98,46 +100,49 @@ class Shell:
   
   @cmd
   def shrink(self, stdin, name, amt):
+    h = self.walker.lookup(name)
+    if h is None:
+      raise UserError("no such entry: '%s'" % name)
     try:
-      h = self.walker.get_entries()[name]
       h.shrink(int(amt))
-    except KeyError:
-      raise UserError("no such entry: '%s'" % name)
     except ShrinkOutOfBounds as e:
       raise UserError(str(e))
     except ValueError:
       raise UserError('usage: shrink [name] [amount:integer]')
   
   @cmd
-  def cd(self, stdin, dirname):
-    if dirname == '..':
-      self.walker.cd_up()
-    else:
-      self.walker.enter_dir(dirname)
+  def cd(self, stdin, path):
+    try:
+      self.walker.enter_dir(path)
+    except DoesNotExist:
+      raise UserError("no such directory: '%s'" % path)
+    except NotADir:
+      raise UserError("'%s' is not a directory" % path)
   
   @cmd
-  def ls(self, stdin):
-    entries = self.walker.get_entries()
-    names = [e for e in entries]
-    names.sort()
-    def infostr(h):
-      if h.is_dir():
-        return '[%d ent.]' % h.num_entries()
+  def ls(self, stdin, path='.'):
+    def infostr(e):
+      if e.is_dir:
+        return '[%d ent.]' % (e.length / 4)
       else:
-        return '(%s)' % humansize(h.length())
-    return '\n'.join(['%s %s' % (name, infostr(entries[name])) for name in names])
+        return '(%s)' % humansize(e.length)
+    h = self.walker.lookup(path)
+    if h is None:
+      raise UserError("no such directory: '%s'" % path)
+    if not h.is_dir():
+      raise UserError("'%s' is not a directory" % path)
+    entries = sorted(h.iter_entries())
+    return '\n'.join(['%s %s' % (e.name, infostr(e)) for e in entries])
   
   @cmd
   def inode(self, stdin, name=None):
-    try:
-      if name is None:
-        handle = self.walker.cur_dir()
-      else:
-        handle = self.walker.get_entries()[name]
-      inode = handle.inode
-      return str(inode)
-    except KeyError:
-      raise UserError("No such entry: '%s'" % name)
+    if name is None:
+      handle = self.walker.cur_dir()
+    else:
+      handle = self.walker.lookup(name)
+      if handle is None:
+        raise UserError("No such entry: '%s'" % name)
+    return str(handle.inode)
   
   @cmd
   def pointers(self, stdin):
@@ -146,34 +151,76 @@ class Shell:
   @cmd
   def fsstats(self, stdin):
     ans = ''
+    ans += 'format version: %d.%d\n' % self.fs.version
+    ans += 'features: %s\n' % (', '.join(feature_names(self.fs.features)) or 'none')
     ans += 'max file length: %s\n' % humansize(self.fs.MAX_FILE_LENGTH)
     ans += 'max dir entries: %d\n' % self.fs.MAX_DIR_ENTRIES
     ans += 'max name length: %d\n' % self.fs.MAX_NAME_LENGTH
     ans += 'capacity: %s' % humansize(self.fs.CAPACITY)
+    if self.fs.has_compression:
+      codec = CODECS[self.fs.compress_codec].name if self.fs.compress_codec else 'none'
+      ans += '\nnew files compressed with: %s (in %s chunks)' % (codec, humansize(self.fs.chunk_size))
+    if self.fs.cache is not None:
+      stats = self.fs.cache.stats()
+      ans += '\ncache: %(cached)d/%(capacity)d blocks, %(hits)d hits, %(misses)d misses, ' \
+             '%(evictions)d evictions, %(dirty)d dirty' % stats
+    if self.fs.journal is not None:
+      stats = self.fs.journal.stats()
+      ans += '\njournal: %(commits)d commits of %(transactions)d transactions, ' \
+             '%(journaled_blocks)d blocks journaled, %(syncs)d syncs, ' \
+             '%(pending_transactions)d transactions pending' % stats
     return ans
   
+  @cmd
+  def stats(self, stdin, what=None):
+    # I/O and the work behind it, per operation, since the start (or the last reset)
+    stats = self.io_stats()
+    if what == 'reset':
+      stats.reset()
+    elif what is None:
+      return format_table(stats.snapshot())
+    else:
+      raise UserError('usage: stats [reset]')
+  
+  @cmd
+  def time(self, stdin, *args):
+    # runs a command, then shows how long it took and what it did
+    if not args:
+      raise UserError('usage: time <command> [args...]')
+    stats = self.io_stats()
+    before = stats.snapshot()
+    start = time.time()
+    out = self.eval_cmd(args[0], stdin, list(args[1:]))
+    elapsed = time.time() - start
+    report = '%s: %.1f ms\n%s' % (args[0], elapsed * 1000, format_table(delta(before, stats.snapshot())))
+    if out:
+      return '%s\n%s' % (out, report)
+    return report
+  
+  def io_stats(self):
+    if self.fs.stats is None:
+      raise UserError('this filesystem was opened without instrumentation')
+    return self.fs.stats
+  
   @cmd
   def echo(self, stdin, *args):
     return ' '.join(args)
   
   @cmd
   def read(self, stdin, filename):
-    try:
-      h = self.walker.get_entries()[filename]
-      if h.is_dir():
-        raise UserError("'%s' is a directory" % filename)
-      h.seek_to_beg()
-      ans = h.read()
-      h.seek_to_beg()
-      return ans
-    except KeyError:
+    h = self.walker.lookup(filename)
+    if h is None:
       raise UserError('no such file: %s' % filename)
+    if h.is_dir():
+      raise UserError("'%s' is a directory" % filename)
+    h.seek_to_beg()
+    return h.read()
   
   @cmd
   def write(self, stdin, filename, newcontents=None):
     def do_write(filename, data):
-      if self.walker.exists(filename):
-        h = self.get_entries()[filename]
+      h = self.walker.lookup(filename)
+      if h is not None:
         if h.is_dir():
           raise UserError("'%s' is a directory" % filename)
         else:
@@ -212,24 +259,58 @@ class Shell:
       except IOError as e:
         raise UserError(str(e))
   
+  @cmd
+  def importdir(self, stdin, host_dir, path='.'):
+    if not os.path.isdir(host_dir):
+      raise UserError("no such host directory: '%s'" % host_dir)
+    try:
+      stats = transfer.import_tree(self.fs, host_dir, self.abs_path(path))
+    except (NotADir, NotAFile) as e:
+      raise UserError("'%s' is in the way" % e)
+    return '%d dirs, %d files, %s' % (stats.dirs, stats.files, humansize(stats.bytes))
+  
+  @cmd
+  def exportdir(self, stdin, path, host_dir):
+    try:
+      stats = transfer.export_tree(self.fs, self.abs_path(path), host_dir)
+    except DoesNotExist:
+      raise UserError("no such directory: '%s'" % path)
+    except NotADir:
+      raise UserError("'%s' is not a directory" % path)
+    except (IOError, OSError) as e:
+      raise UserError(str(e))
+    return '%d dirs, %d files, %s' % (stats.dirs, stats.files, humansize(stats.bytes))
+  
+  def abs_path(self, path):
+    if path.startswith('/'):
+      return path
+    return self.walker.cur_path().rstrip('/') + '/' + path
+  
   @cmd
   def mkdir(self, stdin, name):
     if self.walker.exists(name):
       raise UserError("entry '%s' already exists" % name)
     else:
-      self.walker.cur_dir().create_dir(name)
+      self.walker.create_dir(name)
+  
+  @cmd
+  def mkdirs(self, stdin, path):
+    try:
+      self.walker.makedirs(path)
+    except NotADir as e:
+      raise UserError("'%s' is not a directory" % e)
   
   @cmd
   def touch(self, stdin, name):
     if self.walker.exists(name):
       raise UserError("entry '%s' already exists" % name)
     else:
-      self.walker.cur_dir().create_file(name)
+      self.walker.create_file(name)
   
   @cmd
   def rm(self, stdin, name):
     try:
-      self.walker.cur_dir().remove(name)
+      self.walker.remove(name)
     except DoesNotExist:
       raise UserError("no such entry: '%s'" % name)
     except DirNotEmpty:
@@ -244,6 +325,17 @@ class Shell:
     except AlreadyExists:
       raise UserError("already exists: '%s'" % newname)
   
+  @cmd
+  def mv(self, stdin, src, dst):
+    try:
+      self.walker.move(src, dst)
+    except DoesNotExist as e:
+      raise UserError("no such entry: '%s'" % (str(e) or src))
+    except AlreadyExists:
+      raise UserError("already exists: '%s'" % dst)
+    except InvalidMove as e:
+      raise UserError(str(e))
+  
   @cmd
   def rmr(self, stdin, name):
     try:
@@ -257,8 +349,8 @@ class Shell:
   def tree(self, stdin):
     def t(ans, depth):
       indent = '  ' * depth
-      for entry in self.walker.get_entries().itervalues():
-        if entry.is_dir():
+      for entry in self.walker.iter_entries():
+        if entry.is_dir:
           ans.append('%s%s/' % (indent, entry.name))
           self.walker.enter_dir(entry.name)
           t(ans, depth + 1)
@@ -275,7 +367,11 @@ def main():
     print 'usage: python shell.py [fs_path]'
   path = sys.argv[1]
   try:
-    fs = open_fs(path)
+    fs = open_fs(path, instrument=True)
+  except IOError as e:
+    print str(e)
+    return
+  try:
     shell = Shell(fs)
     shell.run()
   except IOError as e:
@@ -284,6 +380,8 @@ def main():
     print
   except EOFError:
     print
+  finally:
+    fs.close()
 
 if __name__ == '__main__':
   main()
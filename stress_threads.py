@@ -0,0 +1,159 @@
+import fs, fsck, argparse, os, random, sys, tempfile, threading, time
+
+# stress test: many threads reading (and a few writing) one FS10 at once. Every read is
+# checked against what was written, and the image is fsck'd at the end.
+#
+# The readers and writers never lock the same inode, so with readers running the writers
+# slow down only because they get a smaller share of the interpreter (the GIL), not because
+# of the locks. (RWLock prefers readers, though: writers to an inode readers keep busy
+# without a break would starve.)
+
+def random_data(rnd, size):
+  return ''.join(chr(rnd.randrange(256)) for i in xrange(size))
+
+def setup(f, num_files, rnd):
+  w = fs.FSWalker(f)
+  w.makedirs('/data')
+  w.makedirs('/scratch')
+  expected = {}
+  for i in xrange(num_files):
+    # mostly small files, some big enough to need indirect blocks
+    size = rnd.choice([rnd.randrange(1, 2000), rnd.randrange(1, 40000)])
+    path = '/data/f%04d' % i
+    expected[path] = random_data(rnd, size)
+    w.create_file(path).write(expected[path])
+  return expected
+
+def reader(f, expected, stop, counts, seed):
+  rnd = random.Random(seed)
+  w = fs.FSWalker(f)
+  paths = sorted(expected)
+  n = 0
+  while not stop.is_set():
+    path = rnd.choice(paths)
+    h = w.open(path)
+    data = expected[path]
+    start = rnd.randrange(len(data))
+    amt = rnd.randrange(len(data) - start + 1)
+    h.seek_abs(start)
+    got = h.read(amt)
+    if got != data[start:start + amt]:
+      raise AssertionError('%s: bytes %d-%d differ' % (path, start, start + amt))
+    n += 1
+  counts.append(n)
+
+def writer(f, stop, counts, seed):
+  # grows and shrinks a file of its own, and creates/removes entries in a shared directory
+  rnd = random.Random(seed)
+  w = fs.FSWalker(f)
+  path = '/scratch/w%d' % seed
+  h = w.create_file(path)
+  mine = ''
+  names = []
+  n = 0
+  while not stop.is_set():
+    if rnd.random() < 0.5 or not mine:
+      chunk = random_data(rnd, rnd.randrange(1, 3000))
+      h.seek_to_end()
+      h.write(chunk)
+      mine += chunk
+    else:
+      amt = rnd.randrange(len(mine) + 1)
+      h.shrink(amt)
+      mine = mine[:len(mine) - amt]
+    h.seek_to_beg()
+    if h.read() != mine:
+      raise AssertionError('%s: contents differ' % path)
+    if names and rnd.random() < 0.4:
+      w.remove('/scratch/' + names.pop(rnd.randrange(len(names))))
+    else:
+      name = 'e%d-%d' % (seed, n)
+      w.create_file('/scratch/' + name).write(name)
+      names.append(name)
+    n += 1
+  for name in names:
+    w.remove('/scratch/' + name)
+  w.remove(path)
+  counts.append(n)
+
+def run_threads(targets, stop):
+  errors = []
+  def guarded(target, args):
+    try:
+      target(*args)
+    except Exception:
+      errors.append(sys.exc_info())
+      stop.set() # and everyone else
+  threads = [threading.Thread(target=guarded, args=t) for t in targets]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  return errors
+
+def used_blocks(f):
+  return sum(fs.POPCOUNT[b] for b in f.bitmap)
+
+def check(f, when):
+  # whether f is consistent (fsck clean, num_free matching the bitmap); prints why not
+  report = fsck.fsck(f)
+  if not report.clean():
+    print 'FAILED: %s:\n  %s' % (when, '\n  '.join(report.lines()))
+    return False
+  if f.num_free != f.num_blocks - used_blocks(f):
+    print 'FAILED: %s: num_free %d, bitmap says %d' % (when, f.num_free, f.num_blocks - used_blocks(f))
+    return False
+  return True
+
+def main(threads, writers, seconds, num_files, backend, cache_blocks, journal_blocks, seed):
+  fd, path = tempfile.mkstemp(suffix='.fs')
+  os.close(fd)
+  try:
+    # as many blocks as one bitmap block covers
+    f = fs.create_fs(path, 1024, 8192, journal_blocks=journal_blocks)
+    expected = setup(f, num_files, random.Random(seed))
+    f.close()
+    f = fs.open_fs(path, backend=backend, cache_blocks=cache_blocks)
+    stop = threading.Event()
+    read_counts, write_counts = [], []
+    targets = [(reader, (f, expected, stop, read_counts, seed + i)) for i in xrange(threads)]
+    targets += [(writer, (f, stop, write_counts, seed + threads + i)) for i in xrange(writers)]
+    timer = threading.Timer(seconds, stop.set)
+    timer.start()
+    start = time.time()
+    errors = run_threads(targets, stop)
+    elapsed = time.time() - start
+    timer.cancel()
+    if errors:
+      import traceback
+      traceback.print_exception(*errors[0])
+      print 'FAILED: %d thread(s) raised' % len(errors)
+      return 1
+    print '%d readers: %10.0f reads/sec' % (threads, sum(read_counts) / elapsed)
+    print '%d writers: %10.0f writes/sec' % (writers, sum(write_counts) / elapsed)
+    # everything the writers allocated and let go of should have been freed (a raw count of
+    # blocks in use wouldn't do: /scratch may have grown an index, which it keeps)
+    if not check(f, 'after the run'):
+      return 1
+    f.close()
+    f = fs.open_fs(path)
+    if not check(f, 'reopened'):
+      return 1
+    f.close()
+    print 'ok'
+    return 0
+  finally:
+    os.remove(path)
+
+if __name__ == '__main__':
+  p = argparse.ArgumentParser(description='multi-threaded stress test of one FS10')
+  p.add_argument('--threads', '-t', type=int, help='reader threads', default=8)
+  p.add_argument('--writers', '-w', type=int, help='writer threads', default=2)
+  p.add_argument('--seconds', '-s', type=float, help='how long to run', default=5)
+  p.add_argument('--num-files', '-n', type=int, help='files for the readers', default=200)
+  p.add_argument('--backend', choices=sorted(fs.BACKENDS), default='file')
+  p.add_argument('--cache-blocks', type=int, help='put a BlockCache of this many blocks in front')
+  p.add_argument('--journal-blocks', type=int, help='give the image a journal this big', default=0)
+  p.add_argument('--seed', type=int, default=0)
+  ns = p.parse_args(sys.argv[1:])
+  sys.exit(main(**vars(ns)))
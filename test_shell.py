@@ -0,0 +1,41 @@
+import os, tempfile, unittest
+import fs
+from shell import Shell
+
+# python -m unittest test_shell
+
+class ShellTest(unittest.TestCase):
+  
+  def open_shell(self, **kwargs):
+    fd, self.path = tempfile.mkstemp(suffix='.fs')
+    os.close(fd)
+    self.fs = fs.create_fs(self.path, 1024, 2048, **kwargs)
+    return Shell(self.fs)
+  
+  def tearDown(self):
+    self.fs.close()
+    os.remove(self.path)
+  
+  def test_fsstats(self):
+    out = self.open_shell().eval_cmd('fsstats', None, [])
+    self.assertIn('format version', out)
+    self.assertNotIn('compressed with', out)
+  
+  def test_fsstats_compressed(self):
+    out = self.open_shell(compression='zlib').eval_cmd('fsstats', None, [])
+    self.assertIn('new files compressed with: zlib', out)
+  
+  def test_dot_names(self):
+    # '.' and '..' in a path mean the directory and its parent, so no entry can have them
+    shell = self.open_shell()
+    root = shell.walker.cur_dir()
+    self.assertRaises(fs.InvalidName, root.create_file, '.')
+    self.assertRaises(fs.InvalidName, root.create_dir, '..')
+    root.create_dir('.d')
+    root.create_file('...')
+    self.assertRaises(fs.InvalidName, root.rename, '...', '..')
+    self.assertEqual(shell.eval_cmd('tree', None, []), '.d/\n...')
+  
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,162 @@
+import fs, argparse, os, sys
+from multiprocessing.pool import ThreadPool
+
+# Bulk copies between a directory tree on the host and one in an FS image.
+#
+# import_tree first creates the whole tree in the image (in one FS10.batch, so all that
+# metadata goes out in a few large writes) and gives every file all of its blocks at once,
+# which keeps each file contiguous where free space allows. Then a pool of threads copies
+# the contents in, a chunk at a time: each chunk is one read of the host file and, since the
+# blocks are already there, one write to the image.
+#
+# export_tree does the reverse, also a chunk at a time on a pool of threads, so memory use
+# is bounded by workers * chunk_size however big the files are.
+
+DEFAULT_WORKERS = 4
+CHUNK_SIZE = 1 << 20
+
+class TransferStats:
+  
+  def __init__(self):
+    self.dirs = 0
+    self.files = 0
+    self.bytes = 0
+  
+  def __repr__(self):
+    return '<TransferStats %d dirs, %d files, %s>' % (self.dirs, self.files, fs.humansize(self.bytes))
+  
+
+def import_tree(f, host_dir, fs_path='/', workers=DEFAULT_WORKERS, chunk_size=CHUNK_SIZE):
+  """copies the contents of host_dir into directory fs_path of the image (created if need
+     be). Existing files in the way are overwritten; returns a TransferStats."""
+  walker = fs.FSWalker(f)
+  stats = TransferStats()
+  copies = [] # (host path, inode block, size)
+  with f.batch():
+    walker.makedirs(fs_path)
+    for dirpath, dirnames, filenames in os.walk(host_dir):
+      rel = os.path.relpath(dirpath, host_dir)
+      dest = fs_path if rel == '.' else join(fs_path, *rel.split(os.sep))
+      d = walker.makedirs(dest)
+      stats.dirs += 1
+      for name in sorted(filenames):
+        host_path = os.path.join(dirpath, name)
+        if not os.path.isfile(host_path):
+          continue # sockets, fifos, dangling links...
+        size = os.path.getsize(host_path)
+        h = d.lookup(name)
+        if h is None:
+          h = d.create_file(name)
+        elif h.is_dir():
+          raise fs.NotAFile(join(dest, name))
+        else:
+          h.clear()
+        if not h.inode.compressed: # (nothing to reserve: allocating would compress zeroes)
+          h.allocate(size, zero=False) # (copy_in writes every byte)
+        copies.append((host_path, h.inode.block_ind, size))
+      dirnames.sort()
+  started = set() # inode blocks of the files copy_in has got to
+  def copy_in((host_path, block_ind, size)):
+    started.add(block_ind)
+    h = fs.handle_for(f, f.read_inode(block_ind))
+    done = 0
+    src = open(host_path, 'rb')
+    try:
+      while True:
+        chunk = src.read(chunk_size)
+        if not chunk:
+          break
+        h.write(chunk) # (if it grew since we looked, this just grows the file further)
+        done += len(chunk)
+    finally:
+      src.close()
+      # it shrank since we looked, or reading it failed: either way, cut off what wasn't
+      # written (which holds whatever the blocks did before)
+      if h.length() > done:
+        h.shrink(h.length() - done)
+    return done
+  stats.files = len(copies)
+  try:
+    stats.bytes = sum(run_pool(copy_in, copies, workers))
+  finally:
+    # if one failed, the ones never got to (on one thread, map stops there) are emptied, not
+    # left holding whatever their blocks did before
+    for host_path, block_ind, size in copies:
+      if block_ind not in started:
+        fs.handle_for(f, f.read_inode(block_ind)).clear()
+  return stats
+
+def export_tree(f, fs_path, host_dir, workers=DEFAULT_WORKERS, chunk_size=CHUNK_SIZE):
+  """copies directory fs_path of the image into host_dir (created if need be); returns a
+     TransferStats."""
+  walker = fs.FSWalker(f)
+  stats = TransferStats()
+  copies = [] # (inode block, host path)
+  def walk(d, host_path):
+    if not os.path.isdir(host_path):
+      os.makedirs(host_path)
+    stats.dirs += 1
+    for entry in d.iter_entries():
+      child_path = os.path.join(host_path, entry.name)
+      if entry.is_dir:
+        walk(fs.DirHandle(f, f.read_inode(entry.block_ind)), child_path)
+      else:
+        copies.append((entry.block_ind, child_path))
+  root = walker.open(fs_path)
+  if not root.is_dir():
+    raise fs.NotADir(fs_path)
+  walk(root, host_dir)
+  def copy_out((block_ind, host_path)):
+    h = fs.handle_for(f, f.read_inode(block_ind))
+    dst = open(host_path, 'wb')
+    try:
+      done = 0
+      while done < h.length():
+        h.seek_abs(done)
+        chunk = h.read(min(chunk_size, h.length() - done))
+        dst.write(chunk)
+        done += len(chunk)
+    finally:
+      dst.close()
+    return done
+  stats.files = len(copies)
+  stats.bytes = sum(run_pool(copy_out, copies, workers))
+  return stats
+
+def run_pool(func, items, workers):
+  if workers <= 1 or len(items) <= 1:
+    return map(func, items)
+  pool = ThreadPool(min(workers, len(items)))
+  try:
+    return pool.map(func, items, chunksize=1)
+  finally:
+    pool.close()
+    pool.join()
+
+def join(*parts):
+  # FS paths always use '/'
+  return '/'.join([parts[0].rstrip('/')] + [p for p in parts[1:] if p and p != '.'])
+
+
+def main(cmd, image, src, dest, workers, chunk_size):
+  f = fs.open_fs(image)
+  try:
+    if cmd == 'import':
+      stats = import_tree(f, src, dest or '/', workers, chunk_size)
+    else:
+      stats = export_tree(f, src, dest or '.', workers, chunk_size)
+  finally:
+    f.close()
+  print '%d dirs, %d files, %s' % (stats.dirs, stats.files, fs.humansize(stats.bytes))
+
+if __name__ == '__main__':
+  p = argparse.ArgumentParser(description='copy directory trees into or out of a filesystem image')
+  p.add_argument('cmd', choices=['import', 'export'])
+  p.add_argument('image', help='filesystem image')
+  p.add_argument('src', help='host directory to import, or image directory to export')
+  p.add_argument('dest', nargs='?',
+                 help='image directory to import into (default /), or host directory to export to (default .)')
+  p.add_argument('--workers', '-w', type=int, help='threads copying file contents', default=DEFAULT_WORKERS)
+  p.add_argument('--chunk-size', type=int, help='bytes per read/write', default=CHUNK_SIZE)
+  ns = p.parse_args(sys.argv[1:])
+  main(**vars(ns))